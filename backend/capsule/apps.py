@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CapsuleConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "capsule"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections, transaction
+from .connection_pool import PooledConnection
+from .domain_limits import DomainScheduler
+from .rendering import CapsuleEmailRenderer
+from .services import DeliveryClaim, MailDelivery
+from .staging import DeliveryStaging
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+logger = logging.getLogger(__name__)
+
+SMTP_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+
+# Tells a session worker that no more batches are coming
+_DONE = object()
+
+
+class AioSMTPSession():
+    """
+    One SMTP session on the event loop, reused for many messages and
+    recycled after `max_messages` like PooledConnection.
+    Every SMTP command, and each send as a whole, gives up after `timeout`
+    seconds; a session that timed out is dropped without waiting for QUIT.
+    """
+
+    def __init__(self, max_messages, timeout):
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.client = None
+        self.sent_count = 0
+
+    async def open(self):
+        self.client = aiosmtplib.SMTP(
+            hostname=settings.EMAIL_HOST,
+            port=int(settings.EMAIL_PORT),
+            username=settings.EMAIL_HOST_USER or None,
+            password=settings.EMAIL_HOST_PASSWORD or None,
+            use_tls=settings.EMAIL_USE_SSL,
+            start_tls=settings.EMAIL_USE_TLS,
+            timeout=self.timeout,
+        )
+        await self.client.connect()
+        self.sent_count = 0
+
+    async def close(self):
+        if self.client is None:
+            return
+        client, self.client = self.client, None
+        try:
+            await asyncio.wait_for(client.quit(), self.timeout)
+        except Exception as e:
+            logger.warning(f"Error closing mail connection: {e!r}")
+            client.close()
+
+    def drop(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    async def send(self, msg):
+        try:
+            await asyncio.wait_for(self._send(msg), self.timeout)
+        except BaseException:
+            # the session may be mid-command, the next send starts a new one
+            self.drop()
+            raise
+
+    async def _send(self, msg):
+        if self.client is None:
+            await self.open()
+        elif self.sent_count >= self.max_messages:
+            await self.close()
+            await self.open()
+
+        message = msg.message()
+        try:
+            await self.client.send_message(message, sender=msg.from_email, recipients=msg.recipients())
+        except aiosmtplib.SMTPServerDisconnected:
+            logger.info("Mail connection dropped, reconnecting")
+            self.client = None
+            await self.open()
+            await self.client.send_message(message, sender=msg.from_email, recipients=msg.recipients())
+        self.sent_count += 1
+
+
+class ThreadedSession():
+    """
+    A Django mail backend connection driven from a worker thread. Used when
+    aiosmtplib is not installed or EMAIL_BACKEND is not the SMTP backend.
+    The connection is only ever used from one thread at a time, so the
+    timeout is the backend's own socket timeout: the outcome of a send is
+    always known before the capsule is recorded.
+    """
+
+    def __init__(self, max_messages, timeout, executor):
+        self.connection = PooledConnection(max_messages, timeout=timeout)
+        self.executor = executor
+
+    async def close(self):
+        if self.connection.is_open:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.connection.close)
+
+    async def send(self, msg):
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.connection.send_messages, [msg])
+        except Exception:
+            # the thread is done with the connection, so it can be closed
+            await self.close()
+            raise
+
+
+def uses_aiosmtplib():
+    return aiosmtplib is not None and settings.EMAIL_BACKEND == SMTP_BACKEND
+
+
+class AsyncMailDelivery():
+    """
+    Delivery engine that keeps many SMTP sessions in flight from a single
+    worker process (CAPSULE_DELIVERY_ENGINE = "capsule.async_delivery.AsyncMailDelivery").
+    - a loader thread streams the claimed capsules, orders them by
+      recipient domain (see DomainScheduler) and builds their emails
+    - up to CAPSULE_ASYNC_DELIVERY_CONCURRENCY sessions on the event loop
+      send the batches, each message within CAPSULE_ASYNC_DELIVERY_TIMEOUT_SECONDS
+      (which must stay below CAPSULE_DELIVERY_LEASE_SECONDS)
+    - results are written by a database thread, so the loop never waits
+      on the database
+    Capsules end up exactly as with MailDelivery.send_capsules.
+    """
+
+    @classmethod
+    def send_capsules(cls, claim: DeliveryClaim):
+        return asyncio.run(cls._send_capsules(MailDelivery.claimed_capsules(claim)))
+
+    @classmethod
+    async def _send_capsules(cls, capsules):
+        concurrency = getattr(settings, "CAPSULE_ASYNC_DELIVERY_CONCURRENCY", 100)
+        timeout = getattr(settings, "CAPSULE_ASYNC_DELIVERY_TIMEOUT_SECONDS", 60)
+        max_messages = getattr(settings, "CAPSULE_MAIL_MAX_MESSAGES_PER_CONNECTION", 100)
+
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue(maxsize=concurrency)
+        summary = {"sent": 0, "failed": 0, "deferred": 0}
+        renderer = CapsuleEmailRenderer()
+
+        loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capsule-delivery-loader")
+        database = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capsule-delivery-db")
+        transport = None if uses_aiosmtplib() else ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="capsule-delivery-smtp"
+        )
+
+        def new_session():
+            if transport is None:
+                return AioSMTPSession(max_messages, timeout)
+            return ThreadedSession(max_messages, timeout, transport)
+
+        def record(result, capsule):
+            with transaction.atomic():
+                result(capsule)
+
+        # Runs in the loader thread; batches wait on the queue so emails are
+        # only built as fast as they are sent.
+        def load():
+            scheduler = DomainScheduler(MailDelivery.stream_capsules(capsules))
+            failed = 0
+            for domain, batch in scheduler.batches():
+                prepared = []
+                for capsule in batch:
+                    try:
+                        prepared.append((capsule, DeliveryStaging.load(capsule) or renderer.render(capsule)))
+                    except Exception as e:
+                        logger.warning(f"Failed to build the email of capsule {capsule.pk}: {e}")
+                        MailDelivery._record_failure(capsule)
+                        failed += 1
+                if prepared:
+                    asyncio.run_coroutine_threadsafe(batches.put(prepared), loop).result()
+            return scheduler.deferred, failed
+
+        async def send_batches():
+            session = new_session()
+            try:
+                while (batch := await batches.get()) is not _DONE:
+                    for capsule, msg in batch:
+                        # the lease is extended for the send, which the
+                        # timeout keeps shorter than the lease
+                        if not await loop.run_in_executor(database, MailDelivery._hold_lease, capsule):
+                            logger.warning(f"Lost the claim on capsule {capsule.pk}, not sending it")
+                            continue
+
+                        sent = False
+                        try:
+                            await session.send(msg)
+                            sent = True
+                        except Exception as e:
+                            logger.warning(f"Failed to send capsule {capsule.pk}: {e!r}")
+
+                        result = MailDelivery._record_success if sent else MailDelivery._record_failure
+                        try:
+                            await loop.run_in_executor(database, record, result, capsule)
+                        except Exception as e:
+                            # the capsule's lease expires and it is claimed again
+                            logger.error(f"Could not record the delivery of capsule {capsule.pk}: {e}")
+                        summary["sent" if sent else "failed"] += 1
+            finally:
+                await session.close()
+
+        workers = [asyncio.create_task(send_batches()) for _ in range(concurrency)]
+        try:
+            try:
+                deferred, failed = await loop.run_in_executor(loader, load)
+            finally:
+                for _ in workers:
+                    await batches.put(_DONE)
+                await asyncio.gather(*workers)
+
+            await loop.run_in_executor(database, MailDelivery._defer, deferred)
+        finally:
+            # the threads' database connections are not reused after the run
+            for executor in (loader, database):
+                await loop.run_in_executor(executor, connections.close_all)
+                executor.shutdown()
+            if transport is not None:
+                transport.shutdown()
+
+        summary["failed"] += failed
+        summary["deferred"] = len(deferred)
+        summary["render_seconds"] = renderer.timings.total_seconds
+        logger.info(f"Rendered capsule emails: {renderer.timings.as_dict()}")
+        return summary
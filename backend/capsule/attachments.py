@@ -0,0 +1,142 @@
+import mimetypes
+import os
+from email import encoders
+from email.mime.base import MIMEBase
+from django.conf import settings
+from django.core.files.storage import default_storage
+from .models import Capsule, CapsuleItem
+
+
+# Reads a stored file in chunks, giving up as soon as it grows past `limit`
+# bytes so that an oversized file is never fully loaded into memory.
+# Returns None if the file does not fit.
+def read_within_limit(name, limit, chunk_size):
+    data = bytearray()
+    with default_storage.open(name, "rb") as f:
+        while chunk := f.read(chunk_size):
+            if len(data) + len(chunk) > limit:
+                return None
+            data += chunk
+    return bytes(data)
+
+
+# Size of `size` bytes once base64 encoded for the email
+def base64_size(size):
+    return 4 * ((size + 2) // 3)
+
+
+# Url of a stored file that can be opened from an email. Storages that sign
+# their urls (S3) get a link that expires after `expire` seconds.
+def signed_url(name, expire):
+    if getattr(default_storage, "querystring_auth", False):
+        url = default_storage.url(name, expire=expire)
+    else:
+        url = default_storage.url(name)
+
+    if not url.startswith(("http://", "https://")):
+        url = f"{settings.SITE_URL.rstrip('/')}{url}"
+    return url
+
+
+class CapsuleAttachments():
+    """
+    Media of a capsule prepared for a notification email.
+    - inline: items embedded in the email, referenced by their content id
+    - linked: videos and items too large for the email, reachable through a signed link
+    - parts: the MIME parts to attach for the inline items
+    """
+
+    def __init__(self):
+        self.inline = []
+        self.linked = []
+        self.parts = []
+
+
+class CapsuleAttachmentBuilder():
+    """
+    Embeds the image, GIF and audio items of a capsule as CID-inline parts.
+    Videos are linked, with their pre-generated poster thumbnail inlined.
+    Files are streamed from storage in chunks and the email has a total
+    size budget, counted in base64 encoded bytes as sent; items that do not
+    fit fall back to signed links.
+    """
+    INLINE_KINDS = (
+        CapsuleItem.Kind.IMAGE,
+        CapsuleItem.Kind.GIF,
+        CapsuleItem.Kind.AUDIO,
+    )
+    MEDIA_KINDS = INLINE_KINDS + (CapsuleItem.Kind.VIDEO,)
+
+    def __init__(self, budget_bytes=None, chunk_size=None, link_expiry=None):
+        self.budget_bytes = budget_bytes or getattr(
+            settings, "CAPSULE_MAIL_INLINE_BUDGET_BYTES", 10 * 1024 * 1024
+        )
+        self.chunk_size = chunk_size or getattr(
+            settings, "CAPSULE_MAIL_READ_CHUNK_BYTES", 256 * 1024
+        )
+        self.link_expiry = link_expiry or getattr(
+            settings, "CAPSULE_MAIL_LINK_EXPIRY_SECONDS", 7 * 24 * 60 * 60
+        )
+        self.poster_variant = getattr(settings, "CAPSULE_MAIL_POSTER_VARIANT", "640.jpg")
+
+    def build(self, capsule: Capsule):
+        attachments = CapsuleAttachments()
+        remaining = self.budget_bytes
+
+        # capsule_items is prefetched by the delivery workers
+        items = sorted(capsule.capsule_items.all(), key=lambda item: item.position)
+        for item in items:
+            if item.kind not in self.MEDIA_KINDS or not item.file:
+                continue
+
+            if item.kind == CapsuleItem.Kind.VIDEO:
+                # thumbnails are generated when the item is uploaded, so the
+                # poster is only read here, never transcoded
+                poster = item.thumbnails.get(self.poster_variant)
+                if poster:
+                    remaining -= self._add_inline(
+                        attachments, item, poster, "", f"capsule-item-{item.pk}-poster", remaining
+                    )
+                self._add_link(attachments, item)
+                continue
+
+            fits = item.size_in_bytes is None or base64_size(item.size_in_bytes) <= remaining
+            added = 0
+            if fits:
+                added = self._add_inline(
+                    attachments, item, item.file.name, item.mime_type, f"capsule-item-{item.pk}", remaining
+                )
+            if not added:
+                self._add_link(attachments, item)
+            remaining -= added
+
+        return attachments
+
+    def _add_link(self, attachments: CapsuleAttachments, item: CapsuleItem):
+        attachments.linked.append({
+            "item": item,
+            "url": signed_url(item.file.name, self.link_expiry),
+        })
+
+    # Attaches the stored file if it fits in the remaining budget once
+    # encoded. Returns the number of encoded bytes attached.
+    def _add_inline(self, attachments: CapsuleAttachments, item: CapsuleItem, name, mime_type, cid, remaining):
+        data = read_within_limit(name, remaining // 4 * 3, self.chunk_size)
+        if data is None:
+            return 0
+
+        attachments.parts.append(self._inline_part(name, mime_type, data, cid))
+        attachments.inline.append({"item": item, "cid": cid})
+        return base64_size(len(data))
+
+    def _inline_part(self, name, mime_type, data, cid):
+        filename = os.path.basename(name)
+        mime_type = mime_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        maintype, subtype = mime_type.split("/", 1)
+
+        part = MIMEBase(maintype, subtype)
+        part.set_payload(data)
+        encoders.encode_base64(part)
+        part.add_header("Content-ID", f"<{cid}>")
+        part.add_header("Content-Disposition", "inline", filename=filename)
+        return part
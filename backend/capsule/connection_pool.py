@@ -0,0 +1,132 @@
+import logging
+import queue
+import smtplib
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection():
+    """
+    A long-lived mail backend connection that is reused for many messages.
+    The connection is recycled once it has carried `max_messages` messages
+    so that a single SMTP session is never held open indefinitely.
+    """
+
+    def __init__(self, max_messages, timeout=None):
+        self.max_messages = max_messages
+        # None falls back to EMAIL_TIMEOUT
+        self.backend = get_connection(fail_silently=False, timeout=timeout)
+        self.sent_count = 0
+        self.is_open = False
+
+    def open(self):
+        self.backend.open()
+        self.is_open = True
+        self.sent_count = 0
+
+    def close(self):
+        try:
+            self.backend.close()
+        except Exception as e:
+            logger.warning(f"Error closing mail connection: {e}")
+        finally:
+            self.is_open = False
+            self.sent_count = 0
+
+    def reconnect(self):
+        self.close()
+        self.open()
+
+    def send_messages(self, messages):
+        """
+        Sends the messages over this connection, opening or recycling the
+        session as needed. Messages go to the backend one at a time, so when
+        the session drops only the message in flight is retried, once, on a
+        new session; the ones accepted before it are not sent again.
+        """
+        return sum(self._send_message(message) for message in messages)
+
+    def _send_message(self, message):
+        if not self.is_open:
+            self.open()
+        elif self.sent_count >= self.max_messages:
+            self.reconnect()
+
+        try:
+            sent = self.backend.send_messages([message])
+        except smtplib.SMTPServerDisconnected:
+            logger.info("Mail connection dropped, reconnecting")
+            self.reconnect()
+            sent = self.backend.send_messages([message])
+
+        self.sent_count += 1
+        return sent or 0
+
+
+class MailConnectionPool():
+    """
+    A small, thread-safe pool of long-lived mail connections shared by a
+    delivery batch. Connections are opened lazily and closed together when
+    the pool is closed.
+
+    Usage:
+        with MailConnectionPool() as pool:
+            pool.send_messages([msg])
+    """
+
+    def __init__(self, size=None, max_messages_per_connection=None):
+        self.size = size or getattr(settings, "CAPSULE_MAIL_POOL_SIZE", 2)
+        self.max_messages_per_connection = max_messages_per_connection or getattr(
+            settings, "CAPSULE_MAIL_MAX_MESSAGES_PER_CONNECTION", 100
+        )
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Reuse an idle connection, create a new one while under the pool size,
+    # otherwise wait for one to be released.
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = PooledConnection(self.max_messages_per_connection)
+                self._all.append(conn)
+                return conn
+
+        return self._idle.get()
+
+    def _release(self, conn):
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def send_messages(self, messages):
+        with self.connection() as conn:
+            return conn.send_messages(messages)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                if conn.is_open:
+                    conn.close()
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.db import connections
+
+
+def pool_stats(alias="default"):
+    """
+    Usage counters of this process's connection pool for `alias` (size,
+    available and waiting connections, wait times...), or None when the
+    database is not pooled.
+    """
+    pool = getattr(connections[alias], "pool", None)
+    if pool is None:
+        return None
+    return {"role": getattr(settings, "DB_POOL_ROLE", "web"), **pool.get_stats()}
@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+import redis
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+BUCKET_KEY = "capsule:mail-domain-bucket:{}"
+
+# Refills the bucket for the time elapsed since it was last used, then takes
+# up to ARGV[3] tokens. Returns the tokens granted and, when none could be,
+# the seconds until the next token is available.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated_at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+
+local wait = 0
+if granted == 0 then
+    wait = (1 - tokens) / rate
+end
+return {granted, tostring(wait)}
+"""
+
+_client = None
+
+
+def get_client():
+    """
+    Redis client shared by every delivery worker, or None when no limiter
+    store is configured (each process then keeps its own buckets).
+    """
+    global _client
+    url = getattr(settings, "CAPSULE_MAIL_DOMAIN_LIMITS_REDIS_URL", None)
+    if not url:
+        return None
+    if _client is None:
+        _client = redis.Redis.from_url(url)
+    return _client
+
+
+def recipient_domain(capsule):
+    return capsule.delivery_email.rsplit("@", 1)[-1].lower()
+
+
+class LocalTokenBuckets():
+    """
+    Per-process token buckets with the same semantics as the Redis script.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, domain, rate, burst, requested):
+        with self._lock:
+            now = self.clock()
+            tokens, updated_at = self._buckets.get(domain, (burst, now))
+            tokens = min(burst, tokens + max(0, now - updated_at) * rate)
+
+            granted = min(requested, int(tokens))
+            tokens -= granted
+            self._buckets[domain] = (tokens, now)
+        wait = 0.0 if granted else (1 - tokens) / rate
+        return granted, wait
+
+
+_local_buckets = LocalTokenBuckets()
+
+
+class DomainRateLimiter():
+    """
+    Token bucket per recipient domain, so that a delivery run never sends
+    a provider more than it accepts. Buckets live in Redis and are shared
+    by all workers; without Redis, or while it is unreachable, each process
+    falls back to its own buckets.
+    Rates are messages per minute with a burst size, configured per domain
+    in CAPSULE_MAIL_DOMAIN_RATES and otherwise from the defaults.
+    """
+
+    def __init__(self, local_buckets: LocalTokenBuckets | None = None):
+        self.local_buckets = local_buckets or _local_buckets
+        self.rates = getattr(settings, "CAPSULE_MAIL_DOMAIN_RATES", {})
+        self.default_rate = (
+            getattr(settings, "CAPSULE_MAIL_DOMAIN_RATE_PER_MINUTE", 600),
+            getattr(settings, "CAPSULE_MAIL_DOMAIN_BURST", 50),
+        )
+        self._script = None
+        for domain, (per_minute, burst) in [("default", self.default_rate), *self.rates.items()]:
+            if not per_minute > 0 or not burst >= 1:
+                raise ImproperlyConfigured(
+                    f"Mail domain rate for {domain} must be over 0 per minute with a burst of "
+                    f"at least 1, not {per_minute}/min and {burst}"
+                )
+
+    def rate(self, domain):
+        per_minute, burst = self.rates.get(domain, self.default_rate)
+        return per_minute / 60, burst
+
+    def acquire(self, domain, requested=1):
+        """
+        Takes up to `requested` tokens for the domain without waiting.
+        Returns the number granted and, when it is 0, the seconds until a
+        token is available.
+        """
+        rate, burst = self.rate(domain)
+        client = get_client()
+        if client is not None:
+            try:
+                if self._script is None:
+                    self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+                granted, wait = self._script(keys=[BUCKET_KEY.format(domain)], args=[rate, burst, requested])
+                return int(granted), float(wait)
+            except redis.RedisError as e:
+                logger.warning(f"Could not reach the mail domain limiter, using local buckets: {e}")
+
+        return self.local_buckets.take(domain, rate, burst, requested)
+
+
+class DeferredCapsule():
+    """
+    What is kept of a capsule held back by the rate limits: enough to
+    release its claim, without its items.
+    """
+    __slots__ = ("pk", "claim_token", "owner_id")
+
+    def __init__(self, capsule):
+        self.pk = capsule.pk
+        self.claim_token = capsule.claim_token
+        self.owner_id = capsule.owner_id
+
+
+class DomainScheduler():
+    """
+    Orders a delivery chunk so that recipient domains take turns: each turn
+    hands out up to `batch_size` capsules of one domain, as far as its rate
+    allows, so a large provider cannot hold up the others and its messages
+    can share one connection.
+    When every remaining domain is limited the scheduler sleeps until the
+    next token; capsules that would wait longer than `max_wait` seconds in
+    total are left in `deferred` as DeferredCapsule, with the seconds until
+    they may be retried.
+    Capsules are read from `capsules` as they are needed, at most `window`
+    at a time, so a streamed chunk is never held in memory as a whole.
+    """
+
+    def __init__(self, capsules, limiter: DomainRateLimiter | None = None, batch_size=None,
+                 max_wait=None, sleep=time.sleep, clock=time.monotonic, window=None):
+        self.limiter = limiter or DomainRateLimiter()
+        self.batch_size = batch_size or getattr(settings, "CAPSULE_MAIL_DOMAIN_BATCH_SIZE", 10)
+        self.max_wait = max_wait if max_wait is not None else getattr(
+            settings, "CAPSULE_MAIL_DOMAIN_MAX_WAIT_SECONDS", 60
+        )
+        self.window = window or getattr(settings, "CAPSULE_MAIL_DOMAIN_WINDOW_SIZE", 200)
+        self.sleep = sleep
+        self.clock = clock
+        self.deferred = []
+
+        self._capsules = iter(capsules)
+        self._queues = OrderedDict()
+        self._queued = 0
+
+    # Reads capsules until the window is full or the chunk is exhausted
+    def _fill(self):
+        while self._queued < self.window:
+            capsule = next(self._capsules, None)
+            if capsule is None:
+                return
+            self._queues.setdefault(recipient_domain(capsule), deque()).append(capsule)
+            self._queued += 1
+
+    def batches(self):
+        """
+        Yields (domain, capsules) turns until every capsule was handed out
+        or deferred.
+        """
+        deadline = self.clock() + self.max_wait
+        self._fill()
+        while self._queues:
+            handed_out = False
+            next_token = None
+            for domain in list(self._queues):
+                queue = self._queues[domain]
+                granted, wait = self.limiter.acquire(domain, min(len(queue), self.batch_size))
+                if not granted:
+                    next_token = wait if next_token is None else min(next_token, wait)
+                    continue
+
+                handed_out = True
+                batch = [queue.popleft() for _ in range(granted)]
+                self._queued -= granted
+                if not queue:
+                    del self._queues[domain]
+                yield domain, batch
+
+            self._fill()
+            if handed_out:
+                continue
+            if self.clock() + next_token > deadline:
+                self._defer_remaining(next_token)
+                return
+            self.sleep(next_token)
+
+    def _defer_remaining(self, wait):
+        # spread the leftovers of a domain over the time its bucket needs to
+        # send them
+        positions = {}
+
+        def defer(domain, capsule):
+            rate, _ = self.limiter.rate(domain)
+            position = positions.get(domain, 0)
+            positions[domain] = position + 1
+            self.deferred.append((DeferredCapsule(capsule), wait + position / rate))
+
+        for domain, queue in self._queues.items():
+            for capsule in queue:
+                defer(domain, capsule)
+        self._queues.clear()
+        self._queued = 0
+        for capsule in self._capsules:
+            defer(recipient_domain(capsule), capsule)
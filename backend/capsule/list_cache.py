@@ -0,0 +1,74 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+from .versioning import list_version
+
+STATS_PREFIX = "capsule:list-cache:stats"
+STATS = ("hits", "misses", "coalesced")
+
+
+class ListResponseCache():
+    """
+    Caches the serialized capsule and item lists of each user. Keys include
+    the user's list version, so writes invalidate every cached list of their
+    owner at once and stale entries simply expire.
+    Only one request per key renders a missing entry; concurrent requests
+    wait for its result instead of all querying the database.
+    """
+
+    @classmethod
+    def key(cls, user_id, path):
+        digest = hashlib.md5(path.encode()).hexdigest()
+        return f"capsule:list-cache:{user_id}:{list_version(user_id)}:{digest}"
+
+    @classmethod
+    def get_or_render(cls, user_id, path, render):
+        key = cls.key(user_id, path)
+        data = cache.get(key)
+        if data is not None:
+            cls._count("hits")
+            return data
+
+        cls._count("misses")
+        lock_key = f"{key}:lock"
+        lock_seconds = getattr(settings, "CAPSULE_LIST_CACHE_LOCK_SECONDS", 10)
+        if cache.add(lock_key, 1, timeout=lock_seconds):
+            try:
+                data = render()
+                cache.set(key, data, timeout=getattr(settings, "CAPSULE_LIST_CACHE_SECONDS", 300))
+            finally:
+                cache.delete(lock_key)
+            return data
+
+        # another request is rendering this list, wait for its result
+        deadline = time.monotonic() + getattr(settings, "CAPSULE_LIST_CACHE_WAIT_SECONDS", 2)
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            data = cache.get(key)
+            if data is not None:
+                cls._count("coalesced")
+                return data
+        return render()
+
+    @classmethod
+    def stats(cls):
+        counts = cache.get_many([f"{STATS_PREFIX}:{name}" for name in STATS])
+        stats = {name: counts.get(f"{STATS_PREFIX}:{name}", 0) for name in STATS}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    @classmethod
+    def reset_stats(cls):
+        cache.delete_many([f"{STATS_PREFIX}:{name}" for name in STATS])
+
+    @classmethod
+    def _count(cls, name):
+        key = f"{STATS_PREFIX}:{name}"
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the counter was evicted between add() and incr()
+            cache.set(key, 1, timeout=None)
@@ -0,0 +1,140 @@
+import random
+import statistics
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from capsule.models import Capsule
+from capsule.services import MailDelivery
+
+LEGACY_INDEX = "capsule_benchmark_legacy_idx"
+
+
+class BenchmarkRollback(Exception):
+    pass
+
+
+# Times the due-capsule scan against a synthetic history of delivered
+# capsules, with the partial due-scan index and with the composite
+# (deliver_on, status) index it replaced.
+# Everything runs in one transaction that is rolled back at the end.
+# Dropping the partial index locks the capsule table until then, so the
+# command only runs with DEBUG or when told it may lock the table.
+class Command(BaseCommand):
+    help = 'benchmarks the due-capsule scan on synthetic data, leaving the database unchanged'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--capsules', type=int, default=100000, help='total capsules to generate')
+        parser.add_argument('--due', type=int, default=100, help='how many of them are due')
+        parser.add_argument('--pending-ratio', type=float, default=0.05,
+                            help='share of the capsules still waiting for a future date')
+        parser.add_argument('--runs', type=int, default=20, help='timed scans per index')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--i-know-this-locks-the-table', action='store_true', dest='lock_table',
+                            help='run without DEBUG, locking the capsule table for the whole benchmark')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['lock_table']:
+            raise CommandError(
+                "The benchmark locks the capsule table while it runs. "
+                "Use it with DEBUG or pass --i-know-this-locks-the-table."
+            )
+
+        # a throwaway account, so no benchmark capsule is ever attached to a real one
+        self.owner_username = f"benchmark-{uuid.uuid4().hex}"
+        try:
+            with transaction.atomic():
+                self._populate(options)
+                results = [("partial index", self._measure(options))]
+
+                # the old index is recreated inside a savepoint, so the
+                # partial one comes back when it is rolled back
+                with transaction.atomic():
+                    self._use_legacy_index()
+                    results.append(("composite (deliver_on, status)", self._measure(options)))
+                    transaction.set_rollback(True)
+
+                self._report(options, results)
+                raise BenchmarkRollback()
+        except BenchmarkRollback:
+            pass
+        finally:
+            get_user_model().objects.filter(username=self.owner_username).delete()
+
+    def _populate(self, options):
+        self.stdout.write(f"Generating {options['capsules']} capsules...")
+        owner = get_user_model().objects.create(
+            username=self.owner_username,
+            email=f"{self.owner_username}@benchmark.invalid",
+            password="!",
+            timezone="UTC",
+        )
+        now = timezone.now()
+        pending = int(options['capsules'] * options['pending_ratio'])
+
+        batch = []
+        for i in range(options['capsules']):
+            if i < options['due']:
+                status, deliver_on = Capsule.Status.PENDING, now - timedelta(minutes=random.randint(1, 60))
+            elif i < options['due'] + pending:
+                status, deliver_on = Capsule.Status.PENDING, now + timedelta(days=random.randint(1, 3650))
+            else:
+                status, deliver_on = Capsule.Status.SENT, now - timedelta(days=random.randint(1, 3650))
+            batch.append(Capsule(
+                owner=owner, title="benchmark", status=status,
+                deliver_on=deliver_on, delivery_email=owner.email,
+            ))
+            if len(batch) == options['batch_size']:
+                Capsule.objects.bulk_create(batch)
+                batch = []
+        Capsule.objects.bulk_create(batch)
+        self._analyze()
+
+    def _analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {connection.ops.quote_name(Capsule._meta.db_table)}")
+
+    def _use_legacy_index(self):
+        table = connection.ops.quote_name(Capsule._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX capsule_due_scan_idx")
+            cursor.execute(f"CREATE INDEX {LEGACY_INDEX} ON {table} (deliver_on, status)")
+        self._analyze()
+
+    # The read part of claim_due_capsules
+    def _scan(self, limit):
+        return (
+            MailDelivery.due_capsules()
+            .order_by('deliver_on', 'id')
+            .values_list('id', flat=True)[:limit]
+        )
+
+    def _measure(self, options):
+        limit = options['due']
+        found = len(list(self._scan(limit)))  # warm up
+        timings = []
+        for _ in range(options['runs']):
+            started = time.perf_counter()
+            list(self._scan(limit))
+            timings.append((time.perf_counter() - started) * 1000)
+        return {
+            "found": found,
+            "median_ms": statistics.median(timings),
+            "max_ms": max(timings),
+            "plan": self._scan(limit).explain(),
+        }
+
+    def _report(self, options, results):
+        self.stdout.write(
+            f"\n{options['capsules']} capsules, {options['due']} due, {options['runs']} runs"
+        )
+        for name, result in results:
+            self.stdout.write(self.style.SUCCESS(
+                f"{name}: median {result['median_ms']:.2f} ms, max {result['max_ms']:.2f} ms, "
+                f"{result['found']} due found"
+            ))
+            self.stdout.write(f"{result['plan']}\n")
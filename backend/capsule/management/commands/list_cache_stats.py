@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from capsule.list_cache import ListResponseCache
+
+# Reports how often capsule and item lists were served from the cache
+class Command(BaseCommand):
+    help = 'shows hit and miss counts of the capsule list response cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='reset the counters afterwards')
+
+    def handle(self, *args, **options):
+        stats = ListResponseCache.stats()
+        self.stdout.write(
+            f"hits: {stats['hits']}, misses: {stats['misses']}, "
+            f"coalesced: {stats['coalesced']}, hit rate: {stats['hit_rate']:.1%}"
+        )
+
+        if options['reset']:
+            ListResponseCache.reset_stats()
+            self.stdout.write(self.style.SUCCESS("Counters reset"))
@@ -0,0 +1,51 @@
+import logging
+import time
+import redis
+from django.core.management.base import BaseCommand, CommandError
+from capsule.tasks import deliver_scheduled_capsules_task
+from capsule.timers import DeliveryTimers, get_client
+
+logger = logging.getLogger(__name__)
+
+# Hands capsules to the delivery workers as soon as their timer is due.
+# Between deliveries it only asks Redis when the next capsule is due, and
+# sleeps until then (or at most --max-sleep, to notice new timers).
+class Command(BaseCommand):
+    help = 'dispatches capsules from the delivery timer index as soon as they are due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-sleep', type=float, default=1.0,
+                            help='longest pause between checks, in seconds')
+        parser.add_argument('--once', action='store_true', help='check once and exit')
+
+    def handle(self, *args, **options):
+        if get_client() is None:
+            raise CommandError("CAPSULE_TIMERS_REDIS_URL is not set")
+
+        self.stdout.write("Delivery scheduler started")
+        while True:
+            try:
+                wait = self._tick(options['max_sleep'])
+            except redis.RedisError as e:
+                logger.warning(f"Delivery scheduler could not reach Redis: {e}")
+                wait = options['max_sleep']
+
+            if options['once']:
+                return
+            time.sleep(wait)
+
+    # Dispatches the due capsules and returns how long to sleep
+    def _tick(self, max_sleep):
+        capsule_ids = DeliveryTimers.pop_due()
+        if capsule_ids:
+            try:
+                deliver_scheduled_capsules_task.delay(capsule_ids)
+            except Exception as e:
+                # the broker is unreachable; the timers are retried next check
+                logger.warning(f"Delivery scheduler could not queue {len(capsule_ids)} capsules: {e}")
+                DeliveryTimers.restore(capsule_ids)
+                return max_sleep
+            self.stdout.write(f"Dispatched {len(capsule_ids)} due capsules")
+
+        wait = DeliveryTimers.seconds_until_next()
+        return max_sleep if wait is None else min(wait, max_sleep)
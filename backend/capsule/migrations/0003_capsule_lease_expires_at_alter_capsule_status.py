@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0002_alter_capsule_status_alter_customuser_timezone"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="capsule",
+            name="lease_expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="capsule",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("sending", "Sending"),
+                    ("sent", "Sent"),
+                    ("failed", "Failed"),
+                    ("draft", "Draft"),
+                ],
+                default="draft",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0003_capsule_lease_expires_at_alter_capsule_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="capsuleitem",
+            name="thumbnails",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
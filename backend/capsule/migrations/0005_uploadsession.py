@@ -0,0 +1,78 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:45
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0004_capsuleitem_thumbnails"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadSession",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("text", "Text"),
+                            ("image", "Image"),
+                            ("video", "Video"),
+                            ("audio", "Audio / Voice Note"),
+                            ("gif", "GIF"),
+                            ("music_link", "Music Streaming App track link"),
+                        ],
+                        max_length=50,
+                    ),
+                ),
+                ("filename", models.CharField(max_length=255)),
+                ("mime_type", models.CharField(blank=True, max_length=50)),
+                ("file_name", models.CharField(max_length=255)),
+                ("storage_upload_id", models.CharField(blank=True, max_length=255)),
+                ("parts", models.JSONField(blank=True, default=dict)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("open", "Open"),
+                            ("complete", "Complete"),
+                            ("aborted", "Aborted"),
+                        ],
+                        default="open",
+                        max_length=10,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "capsule",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="upload_sessions",
+                        to="capsule.capsule",
+                    ),
+                ),
+                (
+                    "item",
+                    models.OneToOneField(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="capsule.capsuleitem",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:48
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+# Start each capsule's counter after its last existing item
+def backfill_next_item_position(apps, schema_editor):
+    Capsule = apps.get_model("capsule", "Capsule")
+    CapsuleItem = apps.get_model("capsule", "CapsuleItem")
+    last_position = (
+        CapsuleItem.objects.filter(capsule=OuterRef("pk"))
+        .order_by("-position")
+        .values("position")[:1]
+    )
+    Capsule.objects.update(next_item_position=Coalesce(Subquery(last_position) + 1, 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0005_uploadsession"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="capsule",
+            name="next_item_position",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_next_item_position, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0006_capsule_next_item_position"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="capsule",
+            name="capsule_cap_deliver_4cd053_idx",
+        ),
+        migrations.AddIndex(
+            model_name="capsule",
+            index=models.Index(
+                condition=models.Q(("status", "pending")),
+                fields=["deliver_on", "id"],
+                name="capsule_due_scan_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="capsule",
+            index=models.Index(
+                condition=models.Q(("status", "sending")),
+                fields=["lease_expires_at"],
+                name="capsule_lease_scan_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0007_capsule_delivery_scan_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="capsule",
+            name="delivery_attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="capsule",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0008_capsule_delivery_attempts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StagedDelivery",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("file_name", models.CharField(max_length=255)),
+                ("fingerprint", models.CharField(max_length=64)),
+                ("subject", models.CharField(max_length=255)),
+                ("from_email", models.CharField(max_length=255)),
+                ("recipients", models.JSONField(default=list)),
+                ("staged_at", models.DateTimeField(auto_now=True)),
+                (
+                    "capsule",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="staged_delivery",
+                        to="capsule.capsule",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("capsule", "0009_stageddelivery"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="capsule",
+            name="claim_token",
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+    ]
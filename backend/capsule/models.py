@@ -1,6 +1,8 @@
 import uuid
 from django.utils import timezone
 from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
@@ -26,10 +28,16 @@ class Capsule(models.Model):
     - deliver_on: target date for delivery
     - delivered_at: when delivery happened
     - status: state of the capsule
+    - lease_expires_at: when a delivery worker's claim on a sending capsule runs out
+    - claim_token: identifies the claim a sending capsule belongs to
+    - delivery_attempts: failed delivery attempts so far
+    - next_attempt_at: when a capsule whose delivery failed may be retried
+    - next_item_position: position the next appended capsule item gets
     - spotify_url: an optional track to add to the capsule
     """
     class Status(models.TextChoices):
         PENDING = "pending", "Pending"
+        SENDING = "sending", "Sending"
         SENT = "sent", "Sent"
         FAILED = "failed", "Failed"
         DRAFT = "draft", "Draft"
@@ -44,6 +52,11 @@ class Capsule(models.Model):
             max_length=10,
         choices=Status.choices,
         default=Status.DRAFT)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    claim_token = models.UUIDField(null=True, blank=True, editable=False)
+    delivery_attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    next_item_position = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     view_token = models.UUIDField(
         default=uuid.uuid4,
@@ -51,10 +64,21 @@ class Capsule(models.Model):
         unique=True
     )
 
-    # index the fields that would be queried for better performance
+    # index the fields that would be queried for better performance.
+    # The delivery scans only look at pending and sending capsules, so their
+    # indexes leave out the delivered history and stay the size of the queue.
     class Meta:
         indexes = [
-            models.Index(fields=["deliver_on", "status"])
+            models.Index(
+                fields=["deliver_on", "id"],
+                condition=models.Q(status="pending"),
+                name="capsule_due_scan_idx",
+            ),
+            models.Index(
+                fields=["lease_expires_at"],
+                condition=models.Q(status="sending"),
+                name="capsule_lease_scan_idx",
+            ),
         ]
 
     def clean(self):
@@ -69,18 +93,62 @@ class Capsule(models.Model):
 
         return super().save(*args, **kwargs)
 
+    @classmethod
+    def reserve_item_positions(cls, capsule_id, count):
+        """
+        Reserves `count` contiguous item positions at the end of the capsule
+        and returns the first one. Must run inside a transaction: the capsule
+        row stays locked until it commits, so concurrent uploads to the same
+        capsule always get different positions.
+        """
+        cls.objects.filter(pk=capsule_id).update(
+            next_item_position=F("next_item_position") + count
+        )
+        next_position = cls.objects.filter(pk=capsule_id).values_list(
+            "next_item_position", flat=True
+        ).get()
+        return next_position - count
+
 
 
 # Helper method to get path of a capsule file if it's an attatchment.
 def path_to_capsule_item_file(instance, filename):
     return "capsules/{}/{}".format(instance.capsule_id, filename)
 
+class CapsuleItemManager(models.Manager):
+
+    @transaction.atomic
+    def bulk_append(self, capsule, items):
+        """
+        Appends `items` to the end of `capsule`. Their positions are reserved
+        with a single update and the items are inserted with one bulk_create.
+        Signals are not sent, as with any bulk_create.
+        """
+        items = list(items)
+        if not items:
+            return []
+
+        first_position = Capsule.reserve_item_positions(capsule.pk, len(items))
+        for offset, item in enumerate(items):
+            item.capsule = capsule
+            item.position = first_position + offset
+            if item.file and not item.size_in_bytes:
+                item.size_in_bytes = item.file.size
+            # the capsule is locked and the positions are fresh, so the
+            # per-item capsule and uniqueness lookups can be skipped
+            item.full_clean(exclude=["capsule"], validate_unique=False, validate_constraints=False)
+
+        return self.bulk_create(items)
+
+
 class CapsuleItem(models.Model):
     """
     - File attached to a capsule: must be a picture, video, or audio clip
     - Stored file metadata for validation
     - Notes position of item in capsule
-    - Generates a video thumbnail to be  used inline for mail delivery on save.
+    - Video and GIF items get thumbnails generated in the background after
+      they are created, to be used inline for mail delivery.
+      `thumbnails` maps each variant (e.g. "320.webp") to its stored file.
     """
 
     class Kind(models.TextChoices):
@@ -100,9 +168,12 @@ class CapsuleItem(models.Model):
                             blank=True)
     mime_type = models.CharField(blank=True, max_length=50)
     size_in_bytes = models.BigIntegerField(null=True, blank=True)
+    thumbnails = models.JSONField(default=dict, blank=True)
     position = models.PositiveIntegerField(default=0)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CapsuleItemManager()
+
     # ensures that two items cannot have the same position
     class Meta:
         constraints = [
@@ -128,17 +199,18 @@ class CapsuleItem(models.Model):
             if self.url or self.text:
                 raise ValidationError("A {} cannot contain a text or url".format(self.kind))
 
-    #set's position if capsule item is new and position is not set
+    #set's position if capsule item is new and position is not set,
+    #using the capsule's position counter
     def _set_position(self):
-        if self._state.adding and self.position == 0:
-            max_position = CapsuleItem.objects.filter(capsule=self.capsule).aggregate(
-                max_position=models.Max("position")
-            ).get('max_position')
-
-            if max_position is None:
-                self.position = 0
-            else:
-                self.position = max_position + 1
+        if not self._state.adding:
+            return
+        if self.position == 0:
+            self.position = Capsule.reserve_item_positions(self.capsule_id, 1)
+        else:
+            # keep the counter past explicitly chosen positions
+            Capsule.objects.filter(pk=self.capsule_id).update(
+                next_item_position=Greatest(F("next_item_position"), self.position + 1)
+            )
 
     @transaction.atomic
     def save(self, *args, **kwargs):
@@ -154,6 +226,53 @@ class CapsuleItem(models.Model):
 
 
 
+class UploadSession(models.Model):
+    """
+    A resumable upload of a large capsule item file sent in numbered chunks.
+    - file_name: storage name the assembled file is written to
+    - storage_upload_id: id of the storage backend's multipart upload (S3)
+    - parts: chunks received so far, chunk number -> size and etag
+    - item: the capsule item created when the upload is completed
+    """
+    class Status(models.TextChoices):
+        OPEN = "open", "Open"
+        COMPLETE = "complete", "Complete"
+        ABORTED = "aborted", "Aborted"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    capsule = models.ForeignKey(Capsule, on_delete=models.CASCADE, related_name="upload_sessions")
+    kind = models.CharField(max_length=50, choices=CapsuleItem.Kind.choices)
+    filename = models.CharField(max_length=255)
+    mime_type = models.CharField(blank=True, max_length=50)
+    file_name = models.CharField(max_length=255)
+    storage_upload_id = models.CharField(max_length=255, blank=True)
+    parts = models.JSONField(default=dict, blank=True)
+    status = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.OPEN)
+    item = models.OneToOneField(CapsuleItem, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class StagedDelivery(models.Model):
+    """
+    The complete notification email of a capsule, built ahead of its
+    delivery date so that only the SMTP send is left when it is due.
+    - file_name: storage name of the raw MIME message
+    - fingerprint: digest of the capsule content the message was built from;
+      the message is only used while the capsule still matches it
+    - from_email/recipients: the SMTP envelope
+    """
+    capsule = models.OneToOneField(Capsule, on_delete=models.CASCADE, related_name="staged_delivery")
+    file_name = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    subject = models.CharField(max_length=255)
+    from_email = models.CharField(max_length=255)
+    recipients = models.JSONField(default=list)
+    staged_at = models.DateTimeField(auto_now=True)
+
+
 class DeliveryLog(models.Model):
     """
     History of delivery attempts for a capsule
@@ -0,0 +1,103 @@
+import time
+from functools import lru_cache
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import get_template
+from django.urls import reverse
+from .attachments import CapsuleAttachmentBuilder
+from .models import Capsule
+
+
+# Compiled templates are loaded once per process and reused for every email
+@lru_cache(maxsize=None)
+def compiled_template(template_name):
+    return get_template(template_name)
+
+
+@receiver(setting_changed)
+def _clear_compiled_templates(*, setting, **kwargs):
+    if setting == "TEMPLATES":
+        compiled_template.cache_clear()
+
+
+class RenderTimings():
+    """
+    Accumulates how long rendering took over a delivery batch.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    @property
+    def average_seconds(self):
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": self.total_seconds,
+            "average_seconds": self.average_seconds,
+            "max_seconds": self.max_seconds,
+        }
+
+
+class CapsuleEmailRenderer():
+    """
+    Builds capsule notification emails for a delivery batch.
+    The compiled templates and the parts shared by every email of the batch
+    (the open-capsule url and the sender) are prepared once, so each email
+    only pays for rendering its own capsule and attaching its media.
+    """
+    HTML_TEMPLATE = "emails/capsule_notification.html"
+    TEXT_TEMPLATE = "emails/capsule_notification.txt"
+
+    def __init__(self, attachment_builder: CapsuleAttachmentBuilder | None = None):
+        self.attachment_builder = attachment_builder or CapsuleAttachmentBuilder()
+        self.html_template = compiled_template(self.HTML_TEMPLATE)
+        self.text_template = compiled_template(self.TEXT_TEMPLATE)
+
+        relative_url = reverse('capsule_api:register')
+        self.url = f"{settings.SITE_URL}{relative_url}"
+        self.from_email = settings.DEFAULT_FROM_EMAIL
+        self.timings = RenderTimings()
+
+    def render(self, capsule: Capsule):
+        started = time.perf_counter()
+
+        attachments = self.attachment_builder.build(capsule)
+        context = {
+            'capsule': capsule,
+            'url': self.url,
+            'inline_media': attachments.inline,
+            'linked_media': attachments.linked,
+        }
+        html_content = self.html_template.render(context)
+        text_content = self.text_template.render(context)
+
+        capsule_date = capsule.created_at.strftime('%B %d %Y')
+        subject = f"Your time capsule from {capsule_date} has arrived: {capsule.title}"
+        msg = EmailMultiAlternatives(
+            subject=subject,
+            body=text_content,
+            to=[capsule.delivery_email],
+            from_email=self.from_email
+        )
+        msg.attach_alternative(html_content, "text/html")
+
+        # inline parts are referenced from the html by content id
+        if attachments.parts:
+            msg.mixed_subtype = "related"
+            for part in attachments.parts:
+                msg.attach(part)
+
+        self.timings.record(time.perf_counter() - started)
+        return msg
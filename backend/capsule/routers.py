@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+
+# Alias that reads in the current context are routed to, if any
+_read_alias = ContextVar("capsule_read_alias", default=None)
+
+
+def _pin_key(user_id):
+    return f"capsule:pin-primary:{user_id}"
+
+
+def pin_to_primary(user_ids):
+    """
+    Sends the reads of these users to the primary until the replica has
+    had time to receive their latest writes.
+    """
+    if not getattr(settings, "CAPSULE_READ_REPLICA", None):
+        return
+    cache.set_many(
+        {_pin_key(user_id): 1 for user_id in user_ids},
+        timeout=getattr(settings, "CAPSULE_REPLICA_PIN_SECONDS", 5),
+    )
+
+
+def is_pinned_to_primary(user_id):
+    return cache.get(_pin_key(user_id)) is not None
+
+
+@contextmanager
+def replica_reads(user_id=None):
+    """
+    Routes the reads made inside the block to the read replica, if one is
+    configured. Reads on behalf of `user_id` stay on the primary while the
+    user is pinned to it.
+    """
+    alias = getattr(settings, "CAPSULE_READ_REPLICA", None)
+    if alias and user_id is not None and is_pinned_to_primary(user_id):
+        alias = None
+
+    token = _read_alias.set(alias)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+class PrimaryReplicaRouter():
+    """
+    Reads go to the replica only inside replica_reads(); everything else,
+    and every write, uses the default (primary) database.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        return True
@@ -1,74 +1,410 @@
+import logging
+import random
 import smtplib
-from django.urls import reverse
-from django.core.mail import EmailMultiAlternatives, get_connection
+import uuid
+from datetime import timedelta
 from django.db import transaction
+from django.db.models import F, Q
+from .connection_pool import MailConnectionPool, PooledConnection
+from .domain_limits import DomainScheduler
 from .models import Capsule, DeliveryLog
+from .rendering import CapsuleEmailRenderer
+from .routers import replica_reads
+from .staging import DeliveryStaging
+from .timers import DeliveryTimers
+from .versioning import bump_capsule_owners, bump_list_versions
 from django.utils import timezone
+from django.utils.module_loading import import_string
 from django.conf import settings
-from django.template.loader import render_to_string
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryClaim(list):
+    """
+    Ids of the capsules leased by one claim, with the claim's token. Only
+    the holder of the token may send them or record their result.
+    """
+
+    def __init__(self, capsule_ids=(), token=None):
+        super().__init__(capsule_ids)
+        self.token = token
+
 
 class MailDelivery():
     """
     Handles the processing and email delivery of due time capsules.
     """
 
+    @classmethod
+    def due_capsules(cls):
+        """
+        Queryset of the capsules that are due to be delivered. Capsules
+        whose delivery failed wait for their next attempt.
+        """
+        now = timezone.now()
+        return Capsule.objects.filter(
+            deliver_on__lte=now,
+            status=Capsule.Status.PENDING,
+        ).filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+
+    @classmethod
+    def has_due_capsules(cls):
+        """
+        Whether any capsule is due, as seen by the read replica.
+        Claiming still happens on the primary.
+        """
+        with replica_reads():
+            return cls.due_capsules().exists()
+
+    @classmethod
+    def reclaim_expired_leases(cls):
+        """
+        Puts capsules whose delivery lease ran out (e.g. the worker died
+        mid-batch) back in the pending queue. The lost delivery counts as a
+        failed attempt, so a capsule that keeps crashing its worker ends up
+        FAILED instead of being retried forever.
+        Returns how many were reclaimed.
+        """
+        max_attempts = getattr(settings, "CAPSULE_DELIVERY_MAX_ATTEMPTS", 8)
+        with transaction.atomic():
+            capsule_ids = list(
+                Capsule.objects.filter(
+                    status=Capsule.Status.SENDING,
+                    lease_expires_at__lte=timezone.now(),
+                )
+                .select_for_update(skip_locked=True)
+                .values_list('id', flat=True)
+            )
+            if capsule_ids:
+                expired = Capsule.objects.filter(id__in=capsule_ids, status=Capsule.Status.SENDING)
+                released = dict(lease_expires_at=None, claim_token=None, delivery_attempts=F('delivery_attempts') + 1)
+                failed = list(
+                    expired.filter(delivery_attempts__gte=max_attempts - 1).values_list('id', flat=True)
+                )
+                Capsule.objects.filter(id__in=failed).update(
+                    status=Capsule.Status.FAILED, next_attempt_at=None, **released
+                )
+                retried = list(expired.values_list('id', flat=True))
+                expired.update(status=Capsule.Status.PENDING, **released)
+
+                bump_capsule_owners(capsule_ids)
+                DeliveryStaging.discard(failed)
+                DeliveryTimers.schedule({capsule_id: timezone.now() for capsule_id in retried})
+        return len(capsule_ids)
+
+    @classmethod
+    def claim_due_capsules(cls, limit=None, capsule_ids=None):
+        """
+        Atomically moves up to `limit` due capsules to SENDING and leases
+        them to the caller under a new claim token. Rows locked by another
+        worker are skipped, so concurrent workers never claim the same capsule.
+        The claim lease covers the time the capsules may wait in the task
+        queue; each send then extends it (see _hold_lease).
+        `capsule_ids` restricts the claim to those capsules, e.g. the ones
+        the delivery scheduler found due.
+        Returns a DeliveryClaim with the ids of the claimed capsules.
+        """
+        limit = limit or getattr(settings, "CAPSULE_DELIVERY_CLAIM_BATCH_SIZE", 100)
+        lease_seconds = getattr(settings, "CAPSULE_DELIVERY_CLAIM_LEASE_SECONDS", 60 * 60)
+        token = uuid.uuid4()
+
+        due = cls.due_capsules()
+        if capsule_ids is not None:
+            due = due.filter(id__in=capsule_ids)
+
+        with transaction.atomic():
+            capsule_ids = list(
+                due
+                .select_for_update(skip_locked=True)
+                .order_by('deliver_on', 'id')
+                .values_list('id', flat=True)[:limit]
+            )
+            if capsule_ids:
+                Capsule.objects.filter(id__in=capsule_ids).update(
+                    status=Capsule.Status.SENDING,
+                    lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds),
+                    claim_token=token,
+                )
+                bump_capsule_owners(capsule_ids)
+        return DeliveryClaim(capsule_ids, token)
+
     @classmethod
     def send_due_capsules(cls):
         """
-        Fetches all capsules that are due to be delivered and sends them.
+        Claims the capsules that are due to be delivered batch by batch and
+        sends them over a shared pool of mail connections.
+        Returns a summary with the number of sent and failed capsules.
         """
-        # Use prefetch_related with the correct related_name to avoid N+1 queries.
-        due_capsules = Capsule.objects.filter(
-            deliver_on__lte=timezone.now(),
+        cls.reclaim_expired_leases()
+
+        summary = {"sent": 0, "failed": 0, "deferred": 0, "render_seconds": 0.0}
+        engine = get_delivery_engine()
+        # only the capsules that were due when the run started, so that
+        # capsules put back by this run never keep it going
+        remaining = cls.due_capsules().count()
+        while remaining > 0 and (claim := cls.claim_due_capsules(limit=min(
+            remaining, getattr(settings, "CAPSULE_DELIVERY_CLAIM_BATCH_SIZE", 100)
+        ))):
+            remaining -= len(claim)
+            result = engine.send_capsules(claim)
+            for key in summary:
+                summary[key] += result[key]
+        return summary
+
+    @classmethod
+    def send_capsules(cls, claim: DeliveryClaim):
+        """
+        Sends the capsules of a claim made with claim_due_capsules.
+        Used by the delivery workers that each handle one chunk of ids.
+        Capsules whose lease ran out or that were claimed again are skipped.
+        """
+        return cls._send_capsules(cls.stream_capsules(cls.claimed_capsules(claim)))
+
+    @classmethod
+    def claimed_capsules(cls, claim: DeliveryClaim):
+        return Capsule.objects.filter(
+            id__in=claim,
+            status=Capsule.Status.SENDING,
+            claim_token=claim.token,
+            lease_expires_at__gt=timezone.now(),
+        ).select_related('staged_delivery')
+
+    @classmethod
+    def stage_upcoming_capsules(cls, window_seconds=None):
+        """
+        Builds and stores the emails of the pending capsules due within the
+        look-ahead window, so rendering and attachment reads happen ahead
+        of time rather than in the minute the capsules are due.
+        Capsules whose staged email is still current are skipped.
+        Returns how many emails were staged.
+        """
+        window_seconds = window_seconds or getattr(settings, "CAPSULE_STAGING_WINDOW_SECONDS", 24 * 60 * 60)
+        now = timezone.now()
+        upcoming = Capsule.objects.filter(
             status=Capsule.Status.PENDING,
-        ).prefetch_related('capsule_items')
+            deliver_on__gt=now,
+            deliver_on__lte=now + timedelta(seconds=window_seconds),
+        ).select_related('staged_delivery')
 
-        for capsule in due_capsules:
-            cls._send_single_capsule(capsule)
+        renderer = CapsuleEmailRenderer()
+        staged = 0
+        for capsule in cls.stream_capsules(upcoming):
+            if DeliveryStaging.is_current(capsule):
+                continue
+            try:
+                DeliveryStaging.stage(capsule, renderer)
+                staged += 1
+            except Exception as e:
+                # the email is built at delivery time instead
+                logger.warning(f"Could not stage capsule {capsule.pk}: {e}")
+        return staged
 
     @classmethod
-    def _send_single_capsule(cls, capsule: Capsule):
+    def stream_capsules(cls, queryset, page_size=None):
+        """
+        Yields the capsules of `queryset` one page at a time using keyset
+        pagination on (deliver_on, id). Items are prefetched per page and a
+        page is released before the next one is fetched, so memory stays
+        flat however many capsules are due.
+        """
+        page_size = page_size or getattr(settings, "CAPSULE_DELIVERY_PAGE_SIZE", 50)
+        queryset = queryset.order_by('deliver_on', 'id')
+
+        last_key = None
+        while True:
+            page_queryset = queryset
+            if last_key is not None:
+                deliver_on, capsule_id = last_key
+                page_queryset = page_queryset.filter(
+                    Q(deliver_on__gt=deliver_on) | Q(deliver_on=deliver_on, id__gt=capsule_id)
+                )
+
+            # Use prefetch_related with the correct related_name to avoid N+1 queries.
+            page = list(page_queryset.prefetch_related('capsule_items')[:page_size])
+            if not page:
+                return
+
+            last_key = (page[-1].deliver_on, page[-1].pk)
+            is_last_page = len(page) < page_size
+            yield from page
+            del page
+
+            if is_last_page:
+                return
+
+    # Recipient domains take turns within the chunk and are rate limited
+    # (see DomainScheduler); the capsules of one turn share a connection.
+    @classmethod
+    def _send_capsules(cls, capsules):
+        summary = {"sent": 0, "failed": 0, "deferred": 0}
+        renderer = CapsuleEmailRenderer()
+        scheduler = DomainScheduler(capsules)
+        with MailConnectionPool() as pool:
+            for domain, batch in scheduler.batches():
+                with pool.connection() as conn:
+                    for capsule in batch:
+                        sent = cls._send_single_capsule(capsule, conn, renderer)
+                        if sent is not None:
+                            summary["sent" if sent else "failed"] += 1
+
+        cls._defer(scheduler.deferred)
+        summary["deferred"] = len(scheduler.deferred)
+        summary["render_seconds"] = renderer.timings.total_seconds
+        logger.info(f"Rendered capsule emails: {renderer.timings.as_dict()}")
+        return summary
+
+    @classmethod
+    def _send_single_capsule(
+        cls,
+        capsule: Capsule,
+        pool: MailConnectionPool | PooledConnection | None = None,
+        renderer: CapsuleEmailRenderer | None = None,
+    ):
         """
         Builds and sends a single capsule email, ensuring files are read
         correctly and attachments are formatted properly.
+        The message goes over `pool` (or one of its connections) and is built by the
+        batch's `renderer`; single-use ones are created when the capsule is
+        sent on its own.
+        Returns True if the capsule was delivered, or None if its claim was
+        lost before it was sent.
         """
-        conn = get_connection(fail_silently=False)
-        conn.open()
+        owns_pool = pool is None
+        if owns_pool:
+            pool = MailConnectionPool(size=1)
+        renderer = renderer or CapsuleEmailRenderer()
         try:
             with transaction.atomic():
-                relative_url = reverse('capsule_api:register')
-                url = f"{settings.SITE_URL}{relative_url}"
-                context = {
-                    'capsule': capsule,
-                    'url': url
-                }
-
-                html_content = render_to_string('emails/capsule_notification.html', context=context)
-                text_content = render_to_string('emails/capsule_notification.txt', context=context)
-
-                # Create and send the email
-                capsule_date = capsule.created_at.strftime('%B %d %Y')
-                subject = f"Your time capsule from {capsule_date} has arrived: {capsule.title}"
-                msg = EmailMultiAlternatives(
-                    subject=subject,
-                    body=text_content,
-                    to=[capsule.delivery_email],
-                    from_email=settings.DEFAULT_FROM_EMAIL
-                )
-                msg.attach_alternative(html_content, "text/html")
-                msg.send()
+                # keeps the row locked while sending, so the lease cannot be
+                # reclaimed under us
+                if not cls._hold_lease(capsule):
+                    logger.warning(f"Lost the claim on capsule {capsule.pk}, not sending it")
+                    return None
 
-                # Update the capsule status
-                capsule.status = Capsule.Status.SENT
-                capsule.delivered_at = timezone.now()
-                capsule.save(update_fields=["status", "delivered_at"])
-                DeliveryLog.objects.create(capsule=capsule, result=DeliveryLog.ResultStatus.SENT)
+                # Send the staged email, or create it now
+                msg = DeliveryStaging.load(capsule) or renderer.render(capsule)
+                pool.send_messages([msg])
+                cls._record_success(capsule)
+            return True
 
         except smtplib.SMTPException as e:
             print(f"SMTP error for capsule '{capsule.title}': {e}")
-            DeliveryLog.objects.create(capsule=capsule, result=DeliveryLog.ResultStatus.FAILED)
+            cls._record_failure(capsule)
         except Exception as e:
             print(f"Failed to send capsule {capsule.title}: {e}")
-            DeliveryLog.objects.create(capsule=capsule, result=DeliveryLog.ResultStatus.FAILED)
+            cls._record_failure(capsule)
         finally:
-            conn.close()
+            if owns_pool:
+                pool.close()
+        return False
+
+    @classmethod
+    def retry_delay(cls, attempts):
+        """
+        Seconds to wait before the next attempt after `attempts` failures:
+        doubles with every failure up to a cap, and is randomly shortened by
+        up to half so that capsules that failed together are not all
+        retried together.
+        """
+        base = getattr(settings, "CAPSULE_DELIVERY_RETRY_BASE_SECONDS", 60)
+        cap = getattr(settings, "CAPSULE_DELIVERY_RETRY_MAX_SECONDS", 6 * 60 * 60)
+        delay = min(cap, base * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    # Extends the lease of a capsule about to be sent, if it is still held
+    # under the capsule's claim. Returns whether it was.
+    @classmethod
+    def _hold_lease(cls, capsule: Capsule):
+        lease_seconds = getattr(settings, "CAPSULE_DELIVERY_LEASE_SECONDS", 600)
+        now = timezone.now()
+        return bool(cls._claimed(capsule).filter(lease_expires_at__gt=now).update(
+            lease_expires_at=now + timedelta(seconds=lease_seconds)
+        ))
+
+    @classmethod
+    def _claimed(cls, capsule: Capsule):
+        return Capsule.objects.filter(
+            pk=capsule.pk, status=Capsule.Status.SENDING, claim_token=capsule.claim_token
+        )
+
+    @classmethod
+    def _record_success(cls, capsule: Capsule):
+        delivered_at = timezone.now()
+        recorded = cls._claimed(capsule).update(
+            status=Capsule.Status.SENT,
+            delivered_at=delivered_at,
+            lease_expires_at=None,
+            claim_token=None,
+            next_attempt_at=None,
+        )
+        if not recorded:
+            logger.warning(f"Capsule {capsule.pk} was sent after its claim was lost")
+            return
+
+        capsule.status = Capsule.Status.SENT
+        capsule.delivered_at = delivered_at
+        DeliveryLog.objects.create(capsule=capsule, result=DeliveryLog.ResultStatus.SENT)
+        DeliveryTimers.unschedule([capsule.pk])
+        DeliveryStaging.discard([capsule.pk])
+
+    # Releases capsules held back by the domain rate limits, each with the
+    # seconds until it may be claimed again. Not a failed attempt.
+    @classmethod
+    def _defer(cls, deferred):
+        if not deferred:
+            return
+        now = timezone.now()
+        due = {}
+        with transaction.atomic():
+            for capsule, seconds in deferred:
+                next_attempt_at = now + timedelta(seconds=seconds)
+                released = cls._claimed(capsule).update(
+                    status=Capsule.Status.PENDING,
+                    lease_expires_at=None,
+                    claim_token=None,
+                    next_attempt_at=next_attempt_at,
+                )
+                if released:
+                    due[capsule.pk] = next_attempt_at
+            bump_list_versions({capsule.owner_id for capsule, _ in deferred})
+            DeliveryTimers.schedule(due)
+        logger.info(f"Deferred {len(due)} capsules to stay within recipient domain rate limits")
+
+    # Logs the failed attempt and releases the capsule's lease. The capsule
+    # is retried after a backoff, or marked FAILED once it has used up its
+    # attempts.
+    @classmethod
+    def _record_failure(cls, capsule: Capsule):
+        attempts = capsule.delivery_attempts + 1
+        if attempts >= getattr(settings, "CAPSULE_DELIVERY_MAX_ATTEMPTS", 8):
+            status, next_attempt_at = Capsule.Status.FAILED, None
+        else:
+            status = Capsule.Status.PENDING
+            next_attempt_at = timezone.now() + timedelta(seconds=cls.retry_delay(attempts))
+
+        recorded = cls._claimed(capsule).update(
+            status=status,
+            lease_expires_at=None,
+            claim_token=None,
+            delivery_attempts=attempts,
+            next_attempt_at=next_attempt_at,
+        )
+        if not recorded:
+            # the capsule was reclaimed and belongs to another claim now
+            return
+        if status == Capsule.Status.FAILED:
+            logger.warning(f"Giving up on capsule {capsule.pk} after {attempts} failed attempts")
+            DeliveryStaging.discard([capsule.pk])
+
+        DeliveryLog.objects.create(capsule=capsule, result=DeliveryLog.ResultStatus.FAILED)
+        bump_list_versions([capsule.owner_id])
+        if next_attempt_at:
+            DeliveryTimers.schedule({capsule.pk: next_attempt_at})
+
+
+# The class that sends claimed capsules, see CAPSULE_DELIVERY_ENGINE
+def get_delivery_engine():
+    return import_string(
+        getattr(settings, "CAPSULE_DELIVERY_ENGINE", "capsule.services.MailDelivery")
+    )
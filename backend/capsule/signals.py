@@ -0,0 +1,79 @@
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Capsule, CapsuleItem, DeliveryLog, StagedDelivery
+from .staging import DeliveryStaging
+from .tasks import generate_item_thumbnails_task
+from .timers import DeliveryTimers, due_at
+from .versioning import bump_capsule_owners, bump_list_versions
+
+THUMBNAIL_KINDS = (CapsuleItem.Kind.VIDEO, CapsuleItem.Kind.GIF)
+
+
+# Generate thumbnails in the background once the new item is committed,
+# so the upload request never waits on ffmpeg.
+# Called directly for items created with bulk_append, which sends no signals.
+def queue_item_thumbnails(item: CapsuleItem):
+    if item.kind not in THUMBNAIL_KINDS or not item.file:
+        return
+    transaction.on_commit(lambda: generate_item_thumbnails_task.delay(item.pk))
+
+
+@receiver(post_save, sender=CapsuleItem)
+def capsule_item_saved(sender, instance, created, **kwargs):
+    if created:
+        queue_item_thumbnails(instance)
+
+
+# Any change to a capsule, an item or a delivery invalidates the owner's
+# cached lists and list ETags
+@receiver(post_save, sender=Capsule)
+@receiver(post_delete, sender=Capsule)
+def capsule_changed(sender, instance, **kwargs):
+    bump_list_versions([instance.owner_id])
+
+
+@receiver(post_save, sender=CapsuleItem)
+@receiver(post_delete, sender=CapsuleItem)
+def capsule_item_changed(sender, instance, **kwargs):
+    bump_capsule_owners([instance.capsule_id])
+
+
+@receiver(post_save, sender=DeliveryLog)
+def delivery_logged(sender, instance, **kwargs):
+    bump_list_versions([instance.capsule.owner_id])
+
+
+# Pending capsules get a delivery timer; any other change removes it,
+# except for the claim that moves a capsule to sending
+@receiver(post_save, sender=Capsule)
+def capsule_scheduled(sender, instance, **kwargs):
+    if instance.status == Capsule.Status.PENDING:
+        DeliveryTimers.schedule({instance.pk: due_at(instance)})
+    elif instance.status != Capsule.Status.SENDING:
+        DeliveryTimers.unschedule([instance.pk])
+
+
+@receiver(post_delete, sender=Capsule)
+def capsule_unscheduled(sender, instance, **kwargs):
+    DeliveryTimers.unschedule([instance.pk])
+
+
+# A staged email no longer matches a capsule once it or its items change
+@receiver(post_save, sender=Capsule)
+@receiver(post_delete, sender=Capsule)
+def capsule_staging_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        DeliveryStaging.discard([instance.pk])
+
+
+@receiver(post_save, sender=CapsuleItem)
+@receiver(post_delete, sender=CapsuleItem)
+def capsule_item_staging_changed(sender, instance, **kwargs):
+    DeliveryStaging.discard([instance.capsule_id])
+
+
+@receiver(post_delete, sender=StagedDelivery)
+def staged_delivery_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: default_storage.delete(instance.file_name))
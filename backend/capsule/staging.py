@@ -0,0 +1,161 @@
+import email
+import hashlib
+import logging
+from email.message import Message
+from datetime import timedelta
+from email.utils import formatdate
+from functools import lru_cache
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage
+from django.utils import timezone
+from .models import Capsule, StagedDelivery
+from .rendering import CapsuleEmailRenderer, compiled_template
+
+logger = logging.getLogger(__name__)
+
+
+# Digest of the notification templates, so that staged emails built from an
+# older version of them are not sent
+@lru_cache(maxsize=None)
+def template_digest():
+    sources = [
+        compiled_template(name).template.source
+        for name in (CapsuleEmailRenderer.HTML_TEMPLATE, CapsuleEmailRenderer.TEXT_TEMPLATE)
+    ]
+    return hashlib.sha256(repr(sources).encode()).hexdigest()
+
+
+@receiver(setting_changed)
+def _clear_template_digest(*, setting, **kwargs):
+    if setting == "TEMPLATES":
+        template_digest.cache_clear()
+
+
+class StagedMIMEMessage(Message):
+    # Django's mail backends serialize with as_bytes(linesep=...)
+    def as_bytes(self, unixfrom=False, linesep="\n"):
+        return super().as_bytes(unixfrom, policy=self.policy.clone(linesep=linesep))
+
+
+class StagedEmailMessage(EmailMessage):
+    """
+    An email whose MIME message was built when the capsule was staged.
+    Only the Date header is set at send time.
+    """
+
+    def __init__(self, staged: StagedDelivery, raw):
+        super().__init__(subject=staged.subject, from_email=staged.from_email, to=staged.recipients)
+        self.raw = raw
+
+    def message(self):
+        msg = email.message_from_bytes(self.raw, _class=StagedMIMEMessage)
+        msg.replace_header("Date", formatdate(localtime=settings.EMAIL_USE_LOCALTIME))
+        return msg
+
+
+class DeliveryStaging():
+    """
+    Stores the fully built notification emails of capsules before they are
+    due, under staged-deliveries/<capsule id>/.
+    A staged email is used only if the capsule still has the fingerprint it
+    was built from and its signed links have not expired; edits also discard
+    it right away (see signals).
+    """
+    # Bump when a change to the email building code alters staged emails
+    VERSION = 1
+
+    @classmethod
+    def fingerprint(cls, capsule: Capsule):
+        # capsule_items is prefetched by the delivery workers
+        items = sorted(capsule.capsule_items.all(), key=lambda item: item.position)
+        content = repr((
+            cls.VERSION,
+            template_digest(),
+            getattr(settings, "CAPSULE_MAIL_INLINE_BUDGET_BYTES", 10 * 1024 * 1024),
+            getattr(settings, "CAPSULE_MAIL_POSTER_VARIANT", "640.jpg"),
+            capsule.title,
+            capsule.delivery_email,
+            capsule.created_at,
+            settings.SITE_URL,
+            settings.DEFAULT_FROM_EMAIL,
+            [
+                (item.pk, item.position, item.kind, item.file.name, item.text, item.url,
+                 item.size_in_bytes, sorted(item.thumbnails.items()))
+                for item in items
+            ],
+        ))
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    @classmethod
+    def _staged(cls, capsule: Capsule):
+        # select_related by the delivery workers
+        return getattr(capsule, "staged_delivery", None)
+
+    @classmethod
+    def is_expired(cls, staged: StagedDelivery):
+        # the signed links in the email expire this long after staging
+        max_age = timedelta(
+            seconds=getattr(settings, "CAPSULE_MAIL_LINK_EXPIRY_SECONDS", 7 * 24 * 60 * 60)
+        )
+        return staged.staged_at <= timezone.now() - max_age
+
+    @classmethod
+    def is_current(cls, capsule: Capsule):
+        staged = cls._staged(capsule)
+        return (
+            staged is not None
+            and not cls.is_expired(staged)
+            and staged.fingerprint == cls.fingerprint(capsule)
+        )
+
+    @classmethod
+    def stage(cls, capsule: Capsule, renderer: CapsuleEmailRenderer | None = None):
+        renderer = renderer or CapsuleEmailRenderer()
+        msg = renderer.render(capsule)
+        fingerprint = cls.fingerprint(capsule)
+
+        file_name = default_storage.save(
+            f"staged-deliveries/{capsule.pk}/{fingerprint}.eml",
+            ContentFile(msg.message().as_bytes(linesep="\r\n")),
+        )
+        previous = cls._staged(capsule)
+        staged, _ = StagedDelivery.objects.update_or_create(
+            capsule=capsule,
+            defaults={
+                "file_name": file_name,
+                "fingerprint": fingerprint,
+                "subject": msg.subject,
+                "from_email": msg.from_email,
+                "recipients": msg.recipients(),
+            },
+        )
+        if previous is not None and previous.file_name != file_name:
+            default_storage.delete(previous.file_name)
+        capsule.staged_delivery = staged
+        return staged
+
+    @classmethod
+    def load(cls, capsule: Capsule):
+        """
+        The staged email of the capsule, or None if there is none, the
+        capsule changed since it was staged or its links have expired.
+        """
+        if not cls.is_current(capsule):
+            return None
+
+        staged = cls._staged(capsule)
+        try:
+            with default_storage.open(staged.file_name, "rb") as f:
+                return StagedEmailMessage(staged, f.read())
+        except OSError as e:
+            logger.warning(f"Staged email of capsule {capsule.pk} could not be read: {e}")
+            return None
+
+    @classmethod
+    def discard(cls, capsule_ids):
+        # the files are removed by the StagedDelivery post_delete receiver
+        StagedDelivery.objects.filter(capsule_id__in=capsule_ids).delete()
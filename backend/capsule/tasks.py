@@ -1,10 +1,22 @@
-from celery import shared_task
-from capsule.services import MailDelivery
+from celery import chord, group, shared_task
+from django.conf import settings
+from capsule.db_pool import pool_stats
+from capsule.models import CapsuleItem
+from capsule.services import DeliveryClaim, MailDelivery, get_delivery_engine
+from capsule.thumbnails import ThumbnailError, generate_thumbnails
+from capsule.timers import DeliveryTimers
+from capsule.uploads import ChunkedUploads
+from capsule.versioning import bump_capsule_owners
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+# Splits a list of ids into lists of at most `size` ids
+def _chunked(ids, size):
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
 @shared_task
 def send_due_capsules_task():
     logger.info("Starting capsule delivery task...")
@@ -16,3 +28,116 @@ def send_due_capsules_task():
         logger.error(f"Error sending capsules: {e}")
         raise e
 
+
+@shared_task
+def dispatch_due_capsules_task():
+    """
+    Claims a bounded batch of due capsules, splits it into chunks and
+    delivers the chunks in parallel across the workers.
+    The chord callback reports the aggregate result.
+    """
+    reclaimed = MailDelivery.reclaim_expired_leases()
+    # most runs find nothing due; the check runs on the replica so that
+    # those runs never take locks on the primary
+    if not reclaimed and not MailDelivery.has_due_capsules():
+        return None
+
+    claim = MailDelivery.claim_due_capsules(
+        limit=getattr(settings, "CAPSULE_DELIVERY_DISPATCH_LIMIT", 5000)
+    )
+    return _dispatch(claim)
+
+
+@shared_task
+def deliver_scheduled_capsules_task(capsule_ids):
+    """
+    Claims and delivers the capsules the delivery scheduler found due.
+    Capsules that are no longer due (sent, rescheduled or claimed by
+    someone else) are skipped by the claim.
+    """
+    claim = MailDelivery.claim_due_capsules(limit=len(capsule_ids), capsule_ids=capsule_ids)
+    return _dispatch(claim)
+
+
+@shared_task
+def reconcile_delivery_timers_task():
+    """
+    Repairs the timer index against the database, then delivers anything
+    that is already due but was missed, e.g. because its timer was lost.
+    """
+    scheduled = DeliveryTimers.reconcile()
+    logger.info(f"Reconciled {scheduled} delivery timers")
+    return dispatch_due_capsules_task()
+
+
+@shared_task
+def stage_upcoming_capsules_task():
+    staged = MailDelivery.stage_upcoming_capsules()
+    logger.info(f"Staged {staged} upcoming capsule emails")
+    return staged
+
+
+# Splits claimed capsules into chunks that are delivered in parallel across
+# the workers. The chord callback reports the aggregate result.
+def _dispatch(claim: DeliveryClaim):
+    if not claim:
+        return None
+
+    chunk_size = getattr(settings, "CAPSULE_DELIVERY_CHUNK_SIZE", 50)
+    chunks = _chunked(claim, chunk_size)
+    logger.info(f"Dispatching {len(claim)} due capsules in {len(chunks)} chunks")
+
+    token = str(claim.token)
+    header = group(send_capsule_chunk_task.s(chunk, token) for chunk in chunks)
+    result = chord(header)(summarize_delivery_task.s())
+    return result.id
+
+
+@shared_task
+def send_capsule_chunk_task(capsule_ids, claim_token):
+    summary = get_delivery_engine().send_capsules(DeliveryClaim(capsule_ids, claim_token))
+
+    stats = pool_stats()
+    if stats is not None:
+        logger.info(f"Database pool after delivery chunk: {stats}")
+    return summary
+
+
+@shared_task
+def summarize_delivery_task(results):
+    summary = {"sent": 0, "failed": 0, "deferred": 0, "render_seconds": 0.0}
+    for result in results:
+        for key in summary:
+            summary[key] += result.get(key, 0)
+
+    logger.info(
+        f"Capsule delivery finished: {summary['sent']} sent, {summary['failed']} failed, "
+        f"{summary['deferred']} deferred, "
+        f"{summary['render_seconds']:.3f}s spent rendering"
+    )
+    return summary
+
+
+@shared_task
+def generate_item_thumbnails_task(item_id):
+    item = CapsuleItem.objects.filter(pk=item_id).first()
+    if item is None or not item.file:
+        return None
+
+    try:
+        thumbnails = generate_thumbnails(item)
+    except ThumbnailError as e:
+        logger.warning(f"Skipping thumbnails for capsule item {item_id}: {e}")
+        return None
+
+    # update() so the item's save() validation and position logic is not re-run
+    CapsuleItem.objects.filter(pk=item_id).update(thumbnails=thumbnails)
+    bump_capsule_owners([item.capsule_id])
+    return thumbnails
+
+
+@shared_task
+def abort_stale_upload_sessions_task():
+    aborted = ChunkedUploads.abort_stale()
+    logger.info(f"Aborted {aborted} stale upload sessions")
+    return aborted
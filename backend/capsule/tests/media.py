@@ -0,0 +1,35 @@
+import shutil
+import tempfile
+from django.test import override_settings
+
+
+class TemporaryMediaRootMixin():
+    """
+    Gives the test class a MEDIA_ROOT of its own, so the files its tests
+    write never end up in the real media directory, and removes it with
+    everything in it once the class is done.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp(prefix="capsule-tests-")
+        cls._media_root_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls._media_root_override.enable()
+        try:
+            super().setUpClass()  # pyright: ignore
+        except Exception:
+            # tearDownClass is not called when setUpClass fails
+            cls._remove_media_root()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            super().tearDownClass()  # pyright: ignore
+        finally:
+            cls._remove_media_root()
+
+    @classmethod
+    def _remove_media_root(cls):
+        cls._media_root_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
@@ -0,0 +1,143 @@
+import asyncio
+import smtplib
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from ..async_delivery import AsyncMailDelivery
+from ..connection_pool import PooledConnection
+from ..models import Capsule, DeliveryLog
+from ..services import MailDelivery
+
+User = get_user_model()
+
+
+class FakeSMTP():
+    """
+    The aiosmtplib.SMTP calls used by AioSMTPSession, recording what was sent.
+    `stall` makes sends and QUIT hang, like an unresponsive server.
+    """
+    sent = []
+    connections = 0
+    closed = 0
+    stall = False
+
+    def __init__(self, **kwargs):
+        self.options = kwargs
+
+    async def connect(self):
+        FakeSMTP.connections += 1
+
+    async def send_message(self, message, sender, recipients):
+        if FakeSMTP.stall:
+            await asyncio.sleep(3600)
+        FakeSMTP.sent.append((sender, recipients, message["Subject"]))
+
+    async def quit(self):
+        if FakeSMTP.stall:
+            await asyncio.sleep(3600)
+
+    def close(self):
+        FakeSMTP.closed += 1
+
+    @classmethod
+    def reset(cls, stall=False):
+        cls.sent, cls.connections, cls.closed, cls.stall = [], 0, 0, stall
+
+
+FAKE_AIOSMTPLIB = SimpleNamespace(SMTP=FakeSMTP, SMTPServerDisconnected=ConnectionError)
+
+
+# The loader and database threads use their own connections, which only see
+# committed data
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    CAPSULE_DELIVERY_ENGINE="capsule.async_delivery.AsyncMailDelivery",
+    CAPSULE_ASYNC_DELIVERY_CONCURRENCY=4,
+)
+class AsyncMailDeliveryTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        Capsule.objects.bulk_create([
+            Capsule(
+                owner=self.user,
+                title=f"capsule {i}",
+                deliver_on=timezone.now() - timedelta(minutes=1),
+                status=Capsule.Status.PENDING,
+                delivery_email=f"user{i}@example{i % 2}.com",
+            )
+            for i in range(6)
+        ])
+
+    def test_send_due_capsules_uses_the_async_engine(self):
+        summary = MailDelivery.send_due_capsules()
+
+        self.assertEqual((summary["sent"], summary["failed"], summary["deferred"]), (6, 0, 0))
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(Capsule.objects.filter(status=Capsule.Status.SENT).count(), 6)
+        self.assertEqual(DeliveryLog.objects.filter(result=DeliveryLog.ResultStatus.SENT).count(), 6)
+
+    def test_failed_sends_are_recorded(self):
+        def send_messages(connection, messages):
+            if messages[0].to == ["user0@example0.com"]:
+                raise smtplib.SMTPException("rejected")
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        with patch.object(PooledConnection, "send_messages", send_messages):
+            summary = AsyncMailDelivery.send_capsules(MailDelivery.claim_due_capsules())
+
+        self.assertEqual((summary["sent"], summary["failed"]), (5, 1))
+        failed = Capsule.objects.get(delivery_email="user0@example0.com")
+        self.assertEqual(failed.status, Capsule.Status.PENDING)
+        self.assertEqual(failed.delivery_attempts, 1)
+
+    @override_settings(CAPSULE_ASYNC_DELIVERY_TIMEOUT_SECONDS=0.05)
+    def test_threaded_sends_are_recorded_by_their_outcome(self):
+        # the backend's socket timeout bounds threaded sends; a slow send
+        # that still succeeds is not recorded as failed and sent again
+        def send_messages(connection, messages):
+            time.sleep(0.1)
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        with patch.object(PooledConnection, "send_messages", send_messages):
+            summary = AsyncMailDelivery.send_capsules(MailDelivery.claim_due_capsules())
+
+        self.assertEqual((summary["sent"], summary["failed"]), (6, 0))
+        self.assertEqual(len(mail.outbox), 6)
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend")
+    def test_threaded_connections_get_the_timeout(self):
+        connection = PooledConnection(10, timeout=5)
+        self.assertEqual(connection.backend.timeout, 5)
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend")
+    def test_smtp_backend_uses_aiosmtplib_sessions(self):
+        FakeSMTP.reset()
+        with patch("capsule.async_delivery.aiosmtplib", FAKE_AIOSMTPLIB):
+            summary = AsyncMailDelivery.send_capsules(MailDelivery.claim_due_capsules())
+
+        self.assertEqual(summary["sent"], 6)
+        self.assertEqual(len(FakeSMTP.sent), 6)
+        # sessions are reused across messages
+        self.assertLessEqual(FakeSMTP.connections, 4)
+
+    @override_settings(
+        EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+        CAPSULE_ASYNC_DELIVERY_TIMEOUT_SECONDS=0.05,
+    )
+    def test_stalled_smtp_sessions_time_out_and_are_dropped(self):
+        FakeSMTP.reset(stall=True)
+        with patch("capsule.async_delivery.aiosmtplib", FAKE_AIOSMTPLIB):
+            summary = AsyncMailDelivery.send_capsules(MailDelivery.claim_due_capsules())
+
+        self.assertEqual((summary["sent"], summary["failed"]), (0, 6))
+        self.assertEqual(FakeSMTP.closed, 6)
+        self.assertFalse(Capsule.objects.filter(status=Capsule.Status.SENDING).exists())
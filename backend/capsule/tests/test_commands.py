@@ -1,7 +1,12 @@
 from io import StringIO
+from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from unittest.mock import patch
+from capsule.models import Capsule
+
+User = get_user_model()
 
 class SendDueCapsulesCommandTest(TestCase):
     @patch('capsule.management.commands.send_capsules.MailDelivery')
@@ -16,3 +21,34 @@ class SendDueCapsulesCommandTest(TestCase):
         text = out.getvalue()
         self.assertIn("Capsule delivery process finished", text)
         self.assertIn("Starting the capsule delivery process", text)
+
+
+class ListCacheStatsCommandTest(TestCase):
+    @patch('capsule.management.commands.list_cache_stats.ListResponseCache')
+    def test_writes_stats_and_resets(self, mock_cache):
+        mock_cache.stats.return_value = {"hits": 3, "misses": 1, "coalesced": 0, "hit_rate": 0.75}
+        out = StringIO()
+        call_command('list_cache_stats', '--reset', stdout=out)
+
+        self.assertIn("hits: 3, misses: 1, coalesced: 0, hit rate: 75.0%", out.getvalue())
+        mock_cache.reset_stats.assert_called_once()
+
+
+class BenchmarkDueScanCommandTest(TestCase):
+    def test_reports_both_indexes_and_leaves_no_data(self):
+        out = StringIO()
+        call_command(
+            'benchmark_due_scan', '--capsules', '200', '--due', '5', '--runs', '2',
+            '--i-know-this-locks-the-table', stdout=out,
+        )
+
+        text = out.getvalue()
+        self.assertIn("partial index:", text)
+        self.assertIn("composite (deliver_on, status):", text)
+        self.assertIn("5 due found", text)
+        self.assertFalse(Capsule.objects.exists())
+        self.assertFalse(User.objects.filter(username__startswith="benchmark-").exists())
+
+    def test_refuses_to_lock_the_table_without_debug(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_due_scan', '--capsules', '10', stdout=StringIO())
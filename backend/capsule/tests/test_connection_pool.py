@@ -0,0 +1,58 @@
+import smtplib
+from unittest.mock import MagicMock, patch
+from django.test import SimpleTestCase
+
+from ..connection_pool import MailConnectionPool
+
+
+@patch('capsule.connection_pool.get_connection')
+class MailConnectionPoolTest(SimpleTestCase):
+    def test_reuses_one_connection_for_many_messages(self, mock_get_connection):
+        backend = MagicMock()
+        mock_get_connection.return_value = backend
+
+        with MailConnectionPool(size=2, max_messages_per_connection=10) as pool:
+            for _ in range(5):
+                pool.send_messages([MagicMock()])
+
+        # a single backend connection is opened and carries every message
+        self.assertEqual(mock_get_connection.call_count, 1)
+        self.assertEqual(backend.open.call_count, 1)
+        self.assertEqual(backend.send_messages.call_count, 5)
+        backend.close.assert_called_once()
+
+    def test_recycles_connection_after_max_messages(self, mock_get_connection):
+        backend = MagicMock()
+        mock_get_connection.return_value = backend
+
+        with MailConnectionPool(size=1, max_messages_per_connection=2) as pool:
+            for _ in range(5):
+                pool.send_messages([MagicMock()])
+
+        # opened for messages 1-2, 3-4 and 5
+        self.assertEqual(backend.open.call_count, 3)
+
+    def test_reconnects_when_connection_drops(self, mock_get_connection):
+        backend = MagicMock()
+        backend.send_messages.side_effect = [smtplib.SMTPServerDisconnected(), 1]
+        mock_get_connection.return_value = backend
+
+        with MailConnectionPool(size=1) as pool:
+            sent = pool.send_messages([MagicMock()])
+
+        self.assertEqual(sent, 1)
+        self.assertEqual(backend.open.call_count, 2)
+        self.assertEqual(backend.send_messages.call_count, 2)
+
+    def test_messages_accepted_before_a_drop_are_not_resent(self, mock_get_connection):
+        backend = MagicMock()
+        backend.send_messages.side_effect = [1, smtplib.SMTPServerDisconnected(), 1, 1]
+        mock_get_connection.return_value = backend
+        messages = [MagicMock(), MagicMock(), MagicMock()]
+
+        with MailConnectionPool(size=1) as pool:
+            sent = pool.send_messages(messages)
+
+        self.assertEqual(sent, 3)
+        sent_messages = [call.args[0] for call in backend.send_messages.call_args_list]
+        self.assertEqual(sent_messages, [[messages[0]], [messages[1]], [messages[1]], [messages[2]]])
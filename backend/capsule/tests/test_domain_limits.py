@@ -0,0 +1,201 @@
+from datetime import timedelta
+from itertools import count
+from types import SimpleNamespace
+from unittest import skipIf
+from unittest.mock import patch
+import redis
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from ..domain_limits import DomainRateLimiter, DomainScheduler, LocalTokenBuckets
+from ..models import Capsule
+from ..services import MailDelivery
+
+User = get_user_model()
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401, fakeredis runs Lua scripts with it
+except ImportError:
+    fakeredis = None
+
+_capsule_ids = count(1)
+
+
+def _capsule(email):
+    return SimpleNamespace(pk=next(_capsule_ids), claim_token=None, owner_id=1, delivery_email=email)
+
+
+class LocalTokenBucketsTest(TestCase):
+    def test_bucket_refills_over_time(self):
+        clock = FakeClock()
+        buckets = LocalTokenBuckets(clock=clock)
+
+        self.assertEqual(buckets.take("example.com", 1, 3, 5), (3, 0.0))
+        granted, wait = buckets.take("example.com", 1, 3, 1)
+        self.assertEqual(granted, 0)
+        self.assertAlmostEqual(wait, 1.0)
+
+        clock.sleep(2)
+        self.assertEqual(buckets.take("example.com", 1, 3, 5)[0], 2)
+        # other domains have their own bucket
+        self.assertEqual(buckets.take("example.org", 1, 3, 1)[0], 1)
+
+
+@override_settings(
+    CAPSULE_MAIL_DOMAIN_RATE_PER_MINUTE=60,
+    CAPSULE_MAIL_DOMAIN_BURST=2,
+    CAPSULE_MAIL_DOMAIN_RATES={"big.example": (600, 10)},
+)
+class DomainSchedulerTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = DomainRateLimiter(local_buckets=LocalTokenBuckets(clock=self.clock))
+
+    def _scheduler(self, capsules, **kwargs):
+        return DomainScheduler(capsules, limiter=self.limiter, sleep=self.clock.sleep, clock=self.clock, **kwargs)
+
+    def test_domains_take_turns(self):
+        capsules = [_capsule(f"user{i}@big.example") for i in range(4)] + [_capsule("a@Small.example")]
+        scheduler = self._scheduler(capsules, batch_size=2)
+
+        domains = [(domain, len(batch)) for domain, batch in scheduler.batches()]
+
+        self.assertEqual(domains, [("big.example", 2), ("small.example", 1), ("big.example", 2)])
+        self.assertEqual(self.clock.now, 0)
+
+    def test_limited_domain_waits_for_tokens(self):
+        capsules = [_capsule(f"user{i}@small.example") for i in range(3)]
+        scheduler = self._scheduler(capsules, batch_size=5, max_wait=10)
+
+        sizes = [len(batch) for domain, batch in scheduler.batches()]
+
+        self.assertEqual(sizes, [2, 1])
+        self.assertAlmostEqual(self.clock.now, 1.0)
+        self.assertEqual(scheduler.deferred, [])
+
+    def test_capsules_over_the_wait_budget_are_deferred(self):
+        capsules = [_capsule(f"user{i}@small.example") for i in range(4)]
+        scheduler = self._scheduler(capsules, batch_size=5, max_wait=0)
+
+        sizes = [len(batch) for domain, batch in scheduler.batches()]
+
+        self.assertEqual(sizes, [2])
+        self.assertEqual([capsule.pk for capsule, _ in scheduler.deferred], [c.pk for c in capsules[2:]])
+        self.assertEqual([round(seconds) for _, seconds in scheduler.deferred], [1, 2])
+
+    def test_capsules_are_read_one_window_at_a_time(self):
+        read = []
+
+        def stream():
+            for i in range(6):
+                read.append(i)
+                yield _capsule(f"user{i}@big.example")
+
+        scheduler = self._scheduler(stream(), batch_size=2, window=2)
+        batches = scheduler.batches()
+
+        self.assertEqual(len(next(batches)[1]), 2)
+        self.assertEqual(read, [0, 1])
+        self.assertEqual(sum(len(batch) for _, batch in batches), 4)
+        self.assertEqual(read, list(range(6)))
+
+    def test_unread_capsules_are_deferred_too(self):
+        capsules = [_capsule(f"user{i}@small.example") for i in range(5)]
+        scheduler = self._scheduler(iter(capsules), batch_size=5, max_wait=0, window=3)
+
+        sizes = [len(batch) for domain, batch in scheduler.batches()]
+
+        self.assertEqual(sizes, [2])
+        self.assertEqual([capsule.pk for capsule, _ in scheduler.deferred], [c.pk for c in capsules[2:]])
+        self.assertEqual([round(seconds) for _, seconds in scheduler.deferred], [1, 2, 3])
+
+    def test_rates_must_allow_sending(self):
+        for rates in ({"small.example": (0, 5)}, {"small.example": (60, 0)}):
+            with self.subTest(rates=rates), override_settings(CAPSULE_MAIL_DOMAIN_RATES=rates):
+                with self.assertRaises(ImproperlyConfigured):
+                    DomainRateLimiter()
+
+    def test_redis_errors_fall_back_to_local_buckets(self):
+        client = SimpleNamespace(register_script=lambda script: self._failing_script)
+        with override_settings(CAPSULE_MAIL_DOMAIN_LIMITS_REDIS_URL="redis://unused"), \
+                patch("capsule.domain_limits.get_client", return_value=client):
+            self.assertEqual(self.limiter.acquire("small.example", 5), (2, 0.0))
+
+    def _failing_script(self, keys, args):
+        raise redis.ConnectionError("down")
+
+
+@skipIf(fakeredis is None, "fakeredis with Lua support is not installed")
+@override_settings(
+    CAPSULE_MAIL_DOMAIN_LIMITS_REDIS_URL="redis://unused",
+    CAPSULE_MAIL_DOMAIN_RATE_PER_MINUTE=60,
+    CAPSULE_MAIL_DOMAIN_BURST=2,
+)
+class TokenBucketScriptTest(TestCase):
+    def setUp(self):
+        patcher = patch("capsule.domain_limits.get_client", return_value=fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = DomainRateLimiter()
+
+    def test_script_grants_the_burst_then_waits_for_the_rate(self):
+        self.assertEqual(self.limiter.acquire("small.example", 5), (2, 0.0))
+
+        granted, wait = self.limiter.acquire("small.example", 1)
+        self.assertEqual(granted, 0)
+        self.assertGreater(wait, 0.9)
+        self.assertLessEqual(wait, 1.0)
+
+        # other domains have their own bucket
+        self.assertEqual(self.limiter.acquire("other.example", 1), (1, 0.0))
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    CAPSULE_MAIL_DOMAIN_BURST=1,
+    CAPSULE_MAIL_DOMAIN_MAX_WAIT_SECONDS=0,
+)
+class DomainLimitedDeliveryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        Capsule.objects.bulk_create([
+            Capsule(
+                owner=self.user,
+                title=f"capsule {i}",
+                deliver_on=timezone.now() - timedelta(minutes=1),
+                status=Capsule.Status.PENDING,
+                delivery_email=email,
+            )
+            for i, email in enumerate(["a@one.example", "b@one.example", "c@two.example"])
+        ])
+
+    def test_capsules_over_the_domain_rate_are_deferred_without_failing(self):
+        limiter = DomainRateLimiter(local_buckets=LocalTokenBuckets())
+        with patch("capsule.domain_limits.DomainRateLimiter", return_value=limiter):
+            capsule_ids = MailDelivery.claim_due_capsules()
+            summary = MailDelivery.send_capsules(capsule_ids)
+
+        self.assertEqual((summary["sent"], summary["failed"], summary["deferred"]), (2, 0, 1))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ["a@one.example", "c@two.example"])
+
+        deferred = Capsule.objects.get(delivery_email="b@one.example")
+        self.assertEqual(deferred.status, Capsule.Status.PENDING)
+        self.assertEqual(deferred.delivery_attempts, 0)
+        self.assertGreater(deferred.next_attempt_at, timezone.now())
@@ -4,6 +4,7 @@ from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 from mymemorabelia.settings import MEDIA_ROOT
+from .media import TemporaryMediaRootMixin
 from ..models import (Capsule, CapsuleItem,
                     DeliveryLog, path_to_capsule_item_file)
 from django.utils import timezone
@@ -193,3 +194,47 @@ class CapsuleItemTests(TestCase):
 
 
 ## TODO DELIVERY LOG TESTS
+
+class CapsuleItemPositionTests(TemporaryMediaRootMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+        username="TestUser", email="test@example.com", password="pass", timezone="UTC")
+
+        self.capsule = Capsule.objects.create(
+            owner = self.user,
+            title = "First Capsule",
+            deliver_on = timezone.now() + timedelta(days=1),
+        )
+
+    # Test that bulk_append reserves contiguous positions after existing items
+    def test_bulk_append_assigns_contiguous_positions(self):
+        CapsuleItem.objects.create(capsule=self.capsule, kind=CapsuleItem.Kind.TEXT, text="first")
+
+        items = [
+            CapsuleItem(kind=CapsuleItem.Kind.TEXT, text="text {}".format(i))
+            for i in range(3)
+        ]
+        # savepoint, counter update + read, one insert, release savepoint
+        with self.assertNumQueries(5):
+            created = CapsuleItem.objects.bulk_append(self.capsule, items)
+
+        self.assertEqual([item.position for item in created], [1, 2, 3])
+        self.capsule.refresh_from_db()
+        self.assertEqual(self.capsule.next_item_position, 4)
+
+        f = SimpleUploadedFile("image.png", b"1234", content_type="image/png")
+        [image] = CapsuleItem.objects.bulk_append(
+            self.capsule, [CapsuleItem(kind=CapsuleItem.Kind.IMAGE, file=f)]
+        )
+        self.assertEqual(image.position, 4)
+        self.assertEqual(image.size_in_bytes, 4)
+
+    # Test that the counter moves past explicitly chosen positions
+    def test_explicit_position_advances_counter(self):
+        CapsuleItem.objects.create(
+            capsule=self.capsule, kind=CapsuleItem.Kind.TEXT, text="explicit", position=5
+        )
+        item = CapsuleItem.objects.create(
+            capsule=self.capsule, kind=CapsuleItem.Kind.TEXT, text="next"
+        )
+        self.assertEqual(item.position, 6)
@@ -0,0 +1,67 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+from ..models import Capsule
+from ..routers import replica_reads
+from ..services import MailDelivery
+
+User = get_user_model()
+
+
+# The test "replica" is a separate database that nothing replicates to,
+# so it behaves like a replica lagging behind every write of the test
+@override_settings(CAPSULE_READ_REPLICA="replica")
+class PrimaryReplicaRouterTest(APITestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        Capsule.objects.create(
+            owner=self.user, title="First Capsule", deliver_on=timezone.now() + timedelta(days=1)
+        )
+
+    def test_lists_read_the_replica_until_the_user_writes(self):
+        url = reverse("capsule_api:list_capsules")
+        self.assertEqual(self.client.get(url).data["results"], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("capsule_api:create_capsule"),
+                {"title": "Second", "deliver_on": (timezone.now() + timedelta(days=2)).isoformat()},
+            )
+
+        # pinned to the primary, the user sees both capsules
+        titles = [capsule["title"] for capsule in self.client.get(url).data["results"]]
+        self.assertEqual(titles, ["First Capsule", "Second"])
+
+    def test_writes_inside_replica_reads_go_to_the_primary(self):
+        with replica_reads() as alias:
+            Capsule.objects.update(title="Renamed")
+        self.assertEqual(alias, "replica")
+
+        self.assertTrue(Capsule.objects.using("default").filter(title="Renamed").exists())
+        self.assertFalse(Capsule.objects.using("replica").exists())
+
+    def test_due_capsule_check_uses_the_replica(self):
+        # bulk_create skips the future delivery date validation
+        Capsule.objects.bulk_create([Capsule(
+            owner=self.user,
+            title="Due",
+            status=Capsule.Status.PENDING,
+            deliver_on=timezone.now() - timedelta(minutes=1),
+            delivery_email=self.user.email,
+        )])
+        self.assertFalse(MailDelivery.has_due_capsules())
+
+        # claiming reads the primary
+        self.assertEqual(len(MailDelivery.claim_due_capsules()), 1)
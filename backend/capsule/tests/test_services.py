@@ -1,10 +1,19 @@
+import smtplib
 from datetime import timedelta
+from unittest.mock import patch
 from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.core import mail
-from ..models import Capsule, DeliveryLog
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from .media import TemporaryMediaRootMixin
+from ..models import Capsule, CapsuleItem, DeliveryLog
 from ..services import MailDelivery
+from ..versioning import list_version
+from ..rendering import CapsuleEmailRenderer
+from ..attachments import CapsuleAttachmentBuilder, read_within_limit
 
 
 User = get_user_model()
@@ -81,3 +90,216 @@ class MailDeliveryTest(TestCase):
         self.sent_capsule.refresh_from_db()
         self.assertEqual(self.sent_capsule.status, Capsule.Status.SENT)
 
+
+    def test_claim_due_capsules_leases_each_capsule_once(self):
+        claimed = MailDelivery.claim_due_capsules()
+        self.assertEqual(claimed, [self.due_capsule.pk])
+
+        self.due_capsule.refresh_from_db()
+        self.assertEqual(self.due_capsule.status, Capsule.Status.SENDING)
+        self.assertIsNotNone(self.due_capsule.lease_expires_at)
+
+        # a second worker finds nothing left to claim
+        self.assertEqual(MailDelivery.claim_due_capsules(), [])
+
+    def test_expired_leases_are_reclaimed(self):
+        MailDelivery.claim_due_capsules()
+        Capsule.objects.filter(pk=self.due_capsule.pk).update(
+            lease_expires_at=timezone.now() - timedelta(minutes=1)
+        )
+
+        self.assertEqual(MailDelivery.reclaim_expired_leases(), 1)
+        self.assertEqual(MailDelivery.claim_due_capsules(), [self.due_capsule.pk])
+
+    def test_stale_claim_sends_nothing(self):
+        stale = MailDelivery.claim_due_capsules()
+        Capsule.objects.filter(pk=self.due_capsule.pk).update(
+            lease_expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        MailDelivery.reclaim_expired_leases()
+        current = MailDelivery.claim_due_capsules()
+        self.assertEqual(current, stale)
+        self.assertNotEqual(current.token, stale.token)
+
+        # the chunk of the expired claim runs late, after the capsule was
+        # claimed again
+        self.assertEqual(MailDelivery.send_capsules(stale)["sent"], 0)
+        self.assertEqual(MailDelivery.send_capsules(current)["sent"], 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(CAPSULE_DELIVERY_MAX_ATTEMPTS=2)
+    def test_reclaimed_leases_count_as_failed_attempts(self):
+        for expected_status in (Capsule.Status.PENDING, Capsule.Status.FAILED):
+            MailDelivery.claim_due_capsules()
+            Capsule.objects.filter(pk=self.due_capsule.pk).update(
+                lease_expires_at=timezone.now() - timedelta(minutes=1)
+            )
+            MailDelivery.reclaim_expired_leases()
+
+            self.due_capsule.refresh_from_db()
+            self.assertEqual(self.due_capsule.status, expected_status)
+            self.assertIsNone(self.due_capsule.claim_token)
+        self.assertEqual(self.due_capsule.delivery_attempts, 2)
+
+    @override_settings(CAPSULE_DELIVERY_RETRY_BASE_SECONDS=0)
+    @patch('capsule.services.PooledConnection.send_messages', side_effect=smtplib.SMTPException("down"))
+    def test_send_due_capsules_ends_when_failures_are_due_again_at_once(self, send_messages):
+        summary = MailDelivery.send_due_capsules()
+
+        self.assertEqual(summary["failed"], 1)
+        self.due_capsule.refresh_from_db()
+        self.assertEqual(self.due_capsule.delivery_attempts, 1)
+
+    def test_delivery_status_changes_bump_the_owners_list_version(self):
+        before = list_version(self.user1.pk)
+        other_user = list_version(self.user2.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MailDelivery.claim_due_capsules()
+        claimed = list_version(self.user1.pk)
+        self.assertNotEqual(claimed, before)
+
+        self.due_capsule.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            MailDelivery._record_failure(self.due_capsule)
+        self.assertNotEqual(list_version(self.user1.pk), claimed)
+        self.assertEqual(list_version(self.user2.pk), other_user)
+
+    @patch('capsule.services.PooledConnection.send_messages', side_effect=smtplib.SMTPException("down"))
+    def test_failed_delivery_is_retried_after_a_backoff(self, send_messages):
+        self.assertEqual(MailDelivery.send_due_capsules()["failed"], 1)
+
+        self.due_capsule.refresh_from_db()
+        self.assertEqual(self.due_capsule.status, Capsule.Status.PENDING)
+        self.assertEqual(self.due_capsule.delivery_attempts, 1)
+        self.assertGreater(self.due_capsule.next_attempt_at, timezone.now())
+
+        # the next runs skip it until the backoff has passed
+        self.assertEqual(MailDelivery.send_due_capsules()["failed"], 0)
+        Capsule.objects.filter(pk=self.due_capsule.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(MailDelivery.send_due_capsules()["failed"], 1)
+        self.assertEqual(DeliveryLog.objects.filter(capsule=self.due_capsule).count(), 2)
+
+    @override_settings(CAPSULE_DELIVERY_MAX_ATTEMPTS=2)
+    @patch('capsule.services.PooledConnection.send_messages', side_effect=smtplib.SMTPException("down"))
+    def test_capsule_fails_after_the_last_attempt(self, send_messages):
+        Capsule.objects.filter(pk=self.due_capsule.pk).update(delivery_attempts=1)
+        MailDelivery.send_due_capsules()
+
+        self.due_capsule.refresh_from_db()
+        self.assertEqual(self.due_capsule.status, Capsule.Status.FAILED)
+        self.assertEqual(self.due_capsule.delivery_attempts, 2)
+        self.assertIsNone(self.due_capsule.next_attempt_at)
+
+    @override_settings(CAPSULE_DELIVERY_RETRY_BASE_SECONDS=60, CAPSULE_DELIVERY_RETRY_MAX_SECONDS=3600)
+    def test_retry_delay_doubles_with_jitter_up_to_the_cap(self):
+        for attempts, delay in ((1, 60), (2, 120), (4, 480), (10, 3600)):
+            self.assertTrue(delay / 2 <= MailDelivery.retry_delay(attempts) <= delay)
+
+    def test_stream_capsules_pages_by_deliver_on_and_id(self):
+        extra = [
+            Capsule(
+                owner=self.user1,
+                title=f"extra capsule {i}",
+                deliver_on=self.due_capsule.deliver_on,
+                status=Capsule.Status.PENDING,
+                delivery_email=self.user1.email # pyright: ignore
+            )
+            for i in range(4)
+        ]
+        Capsule.objects.bulk_create(extra)
+        expected = list(
+            MailDelivery.due_capsules().order_by('deliver_on', 'id').values_list('id', flat=True)
+        )
+
+        # 5 capsules in pages of 2: three pages, each with one prefetch query
+        with self.assertNumQueries(6):
+            streamed = [
+                capsule.pk
+                for capsule in MailDelivery.stream_capsules(MailDelivery.due_capsules(), page_size=2)
+            ]
+
+        self.assertEqual(streamed, expected)
+
+    def test_renderer_reuses_compiled_templates_and_records_timings(self):
+        first = CapsuleEmailRenderer()
+        second = CapsuleEmailRenderer()
+        self.assertIs(first.html_template, second.html_template)
+        self.assertIs(first.text_template, second.text_template)
+
+        msg = first.render(self.due_capsule)
+        self.assertIn(first.url, msg.body) # pyright: ignore
+        self.assertEqual(first.timings.count, 1)
+        self.assertGreater(first.timings.total_seconds, 0)
+
+
+class CapsuleAttachmentBuilderTest(TemporaryMediaRootMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        self.capsule = Capsule.objects.create(
+            owner=self.user,
+            title="capsule with media",
+            deliver_on=timezone.now() + timedelta(days=1),
+        )
+        self.image = CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.IMAGE,
+            file=SimpleUploadedFile("photo.png", b"x" * 100, content_type="image/png"),
+            mime_type="image/png",
+        )
+        self.video = CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.VIDEO,
+            file=SimpleUploadedFile("clip.mp4", b"x" * 100, content_type="video/mp4"),
+            mime_type="video/mp4",
+        )
+
+    def test_images_are_inlined_and_videos_linked(self):
+        msg = CapsuleEmailRenderer().render(self.capsule)
+
+        self.assertEqual(msg.mixed_subtype, "related")
+        self.assertEqual(len(msg.attachments), 1)
+        part = msg.attachments[0]
+        self.assertEqual(part["Content-ID"], f"<capsule-item-{self.image.pk}>")
+
+        html_body = msg.alternatives[0][0] # pyright: ignore
+        self.assertIn(f"cid:capsule-item-{self.image.pk}", html_body)
+        self.assertIn(self.video.file.name, html_body)
+
+    def test_video_poster_thumbnail_is_inlined(self):
+        poster = default_storage.save(
+            f"capsules/{self.capsule.pk}/thumbnails/clip_640.jpg", ContentFile(b"jpeg")
+        )
+        self.video.thumbnails = {"640.jpg": poster}
+        self.video.save(update_fields=["thumbnails"])
+        self.capsule.refresh_from_db()
+
+        attachments = CapsuleAttachmentBuilder().build(self.capsule)
+
+        cids = [media["cid"] for media in attachments.inline]
+        self.assertIn(f"capsule-item-{self.video.pk}-poster", cids)
+        self.assertEqual(attachments.parts[-1].get_content_type(), "image/jpeg")
+        self.assertEqual([media["item"] for media in attachments.linked], [self.video])
+
+    def test_items_over_the_budget_fall_back_to_links(self):
+        builder = CapsuleAttachmentBuilder(budget_bytes=50, chunk_size=10)
+        attachments = builder.build(self.capsule)
+
+        self.assertEqual(attachments.parts, [])
+        self.assertEqual(
+            [media["item"] for media in attachments.linked], [self.image, self.video]
+        )
+
+    def test_budget_counts_the_base64_encoded_size(self):
+        # the 100 byte image takes 136 bytes once encoded
+        attachments = CapsuleAttachmentBuilder(budget_bytes=120, chunk_size=10).build(self.capsule)
+        self.assertEqual(attachments.parts, [])
+
+        attachments = CapsuleAttachmentBuilder(budget_bytes=136, chunk_size=10).build(self.capsule)
+        self.assertEqual([media["item"] for media in attachments.inline], [self.image])
+
+    def test_read_stops_once_the_limit_is_exceeded(self):
+        self.assertIsNone(read_within_limit(self.image.file.name, 99, 10))
+        self.assertEqual(read_within_limit(self.image.file.name, 100, 10), b"x" * 100)
@@ -0,0 +1,130 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.core import mail
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from unittest.mock import patch
+from .media import TemporaryMediaRootMixin
+from ..models import Capsule, CapsuleItem, StagedDelivery
+from ..services import MailDelivery
+from ..staging import DeliveryStaging, StagedEmailMessage
+
+User = get_user_model()
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class DeliveryStagingTest(TemporaryMediaRootMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        self.capsule = Capsule.objects.create(
+            owner=self.user,
+            title="staged capsule",
+            deliver_on=timezone.now() + timedelta(hours=2),
+            status=Capsule.Status.PENDING,
+            delivery_email=self.user.email, # pyright: ignore
+        )
+        self.image = CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.IMAGE,
+            file=SimpleUploadedFile("photo.png", b"x" * 100, content_type="image/png"),
+            mime_type="image/png",
+        )
+        self.later = Capsule.objects.create(
+            owner=self.user,
+            title="later capsule",
+            deliver_on=timezone.now() + timedelta(days=3),
+            status=Capsule.Status.PENDING,
+            delivery_email=self.user.email, # pyright: ignore
+        )
+
+    def _make_due(self):
+        Capsule.objects.filter(pk=self.capsule.pk).update(deliver_on=timezone.now() - timedelta(minutes=1))
+
+    def test_only_capsules_within_the_window_are_staged(self):
+        self.assertEqual(MailDelivery.stage_upcoming_capsules(), 1)
+        staged = StagedDelivery.objects.get()
+        self.assertEqual(staged.capsule, self.capsule)
+        self.assertTrue(default_storage.exists(staged.file_name))
+
+        # already staged and unchanged
+        self.assertEqual(MailDelivery.stage_upcoming_capsules(), 0)
+
+    def test_delivery_sends_the_staged_email(self):
+        MailDelivery.stage_upcoming_capsules()
+        self._make_due()
+
+        MailDelivery.send_due_capsules()
+
+        self.assertEqual(len(mail.outbox), 1)
+        sent_email = mail.outbox[0]
+        self.assertIsInstance(sent_email, StagedEmailMessage)
+        self.assertEqual(sent_email.to, [self.user.email]) # pyright: ignore
+        message = sent_email.message()
+        self.assertIn("staged capsule", message["Subject"])
+        self.assertIn(f"capsule-item-{self.image.pk}", message.as_string())
+
+        self.capsule.refresh_from_db()
+        self.assertEqual(self.capsule.status, Capsule.Status.SENT)
+        self.assertFalse(StagedDelivery.objects.exists())
+
+    def test_editing_a_capsule_discards_its_staged_email(self):
+        MailDelivery.stage_upcoming_capsules()
+        file_name = StagedDelivery.objects.get().file_name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.image.delete()
+
+        self.assertFalse(StagedDelivery.objects.exists())
+        self.assertFalse(default_storage.exists(file_name))
+
+    def test_stale_staged_email_is_rendered_again(self):
+        MailDelivery.stage_upcoming_capsules()
+        # bypasses the signals, as a concurrent edit racing the staging would
+        Capsule.objects.filter(pk=self.capsule.pk).update(title="renamed capsule")
+        self._make_due()
+
+        MailDelivery.send_due_capsules()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertNotIsInstance(mail.outbox[0], StagedEmailMessage)
+        self.assertIn("renamed capsule", mail.outbox[0].subject)
+
+    def test_load_without_staged_email(self):
+        self.assertIsNone(DeliveryStaging.load(self.capsule))
+
+    def test_changed_email_version_is_not_current(self):
+        MailDelivery.stage_upcoming_capsules()
+        capsule = Capsule.objects.select_related("staged_delivery").get(pk=self.capsule.pk)
+        self.assertTrue(DeliveryStaging.is_current(capsule))
+
+        with patch.object(DeliveryStaging, "VERSION", DeliveryStaging.VERSION + 1):
+            self.assertFalse(DeliveryStaging.is_current(capsule))
+        with patch("capsule.staging.template_digest", return_value="edited"):
+            self.assertFalse(DeliveryStaging.is_current(capsule))
+
+    def test_staged_email_with_expired_links_is_not_loaded(self):
+        MailDelivery.stage_upcoming_capsules()
+        StagedDelivery.objects.update(staged_at=timezone.now() - timedelta(days=8))
+        capsule = Capsule.objects.select_related("staged_delivery").get(pk=self.capsule.pk)
+
+        with override_settings(CAPSULE_MAIL_LINK_EXPIRY_SECONDS=7 * 24 * 60 * 60):
+            self.assertIsNone(DeliveryStaging.load(capsule))
+
+        # and it is staged again
+        self.assertEqual(MailDelivery.stage_upcoming_capsules(), 1)
+
+    @override_settings(CAPSULE_DELIVERY_MAX_ATTEMPTS=1)
+    def test_failed_capsule_discards_its_staged_email(self):
+        MailDelivery.stage_upcoming_capsules()
+        self._make_due()
+
+        with patch("capsule.services.PooledConnection.send_messages", side_effect=OSError("down")):
+            MailDelivery.send_due_capsules()
+
+        self.capsule.refresh_from_db()
+        self.assertEqual(self.capsule.status, Capsule.Status.FAILED)
+        self.assertFalse(StagedDelivery.objects.exists())
@@ -0,0 +1,67 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.core import mail
+
+from mymemorabelia.celery import app
+from ..models import Capsule
+from ..tasks import (
+    _chunked,
+    deliver_scheduled_capsules_task,
+    dispatch_due_capsules_task,
+    summarize_delivery_task,
+)
+
+
+User = get_user_model()
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    CAPSULE_DELIVERY_CHUNK_SIZE=2,
+)
+class DispatchDueCapsulesTaskTest(TestCase):
+    def setUp(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        Capsule.objects.bulk_create([
+            Capsule(
+                owner=self.user,
+                title=f"capsule {i}",
+                deliver_on=timezone.now() - timedelta(days=1),
+                status=Capsule.Status.PENDING,
+                delivery_email=self.user.email, # pyright: ignore
+            )
+            for i in range(5)
+        ])
+
+    def test_chunks_ids(self):
+        self.assertEqual(_chunked([1, 2, 3, 4, 5], 2), [[1, 2], [3, 4], [5]])
+
+    def test_dispatch_sends_every_due_capsule(self):
+        dispatch_due_capsules_task.apply()
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(
+            Capsule.objects.filter(status=Capsule.Status.PENDING).exists()
+        )
+
+    def test_scheduled_delivery_sends_only_the_given_capsules(self):
+        capsule_ids = list(Capsule.objects.order_by("id").values_list("id", flat=True)[:2])
+        deliver_scheduled_capsules_task.apply(args=[capsule_ids])
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(
+            set(Capsule.objects.filter(status=Capsule.Status.SENT).values_list("id", flat=True)),
+            set(capsule_ids),
+        )
+
+    def test_summarize_aggregates_chunk_results(self):
+        summary = summarize_delivery_task([
+            {"sent": 2, "failed": 0, "render_seconds": 0.5},
+            {"sent": 1, "failed": 1, "render_seconds": 0.25},
+        ])
+        self.assertEqual(summary, {"sent": 3, "failed": 1, "deferred": 0, "render_seconds": 0.75})
@@ -0,0 +1,98 @@
+import io
+from datetime import timedelta
+from unittest.mock import patch
+from PIL import Image
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from .media import TemporaryMediaRootMixin
+from ..models import Capsule, CapsuleItem
+from ..tasks import generate_item_thumbnails_task
+
+User = get_user_model()
+
+
+def make_gif(size=(800, 600)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "red").save(buffer, "GIF")
+    return buffer.getvalue()
+
+
+@override_settings(CAPSULE_THUMBNAIL_WIDTHS=(160, 320))
+class GenerateThumbnailsTest(TemporaryMediaRootMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        self.capsule = Capsule.objects.create(
+            owner=self.user,
+            title="First Capsule",
+            deliver_on=timezone.now() + timedelta(days=1),
+        )
+
+    def test_new_gif_item_queues_thumbnail_task_on_commit(self):
+        with patch("capsule.signals.generate_item_thumbnails_task") as mock_task:
+            with self.captureOnCommitCallbacks(execute=True):
+                item = CapsuleItem.objects.create(
+                    capsule=self.capsule,
+                    kind=CapsuleItem.Kind.GIF,
+                    file=SimpleUploadedFile("dance.gif", make_gif(), content_type="image/gif"),
+                )
+
+        mock_task.delay.assert_called_once_with(item.pk)
+
+    def test_generates_sized_variants_beside_the_original(self):
+        item = CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.GIF,
+            file=SimpleUploadedFile("dance.gif", make_gif(), content_type="image/gif"),
+        )
+
+        generate_item_thumbnails_task(item.pk)
+        item.refresh_from_db()
+
+        self.assertEqual(set(item.thumbnails), {"160.jpg", "160.webp", "320.jpg", "320.webp"})
+        for name in item.thumbnails.values():
+            self.assertTrue(name.startswith(f"capsules/{self.capsule.pk}/thumbnails/dance_"))
+
+        with default_storage.open(item.thumbnails["320.webp"]) as f:
+            with Image.open(f) as image:
+                self.assertEqual(image.size, (320, 240))
+
+    def test_unreadable_video_is_skipped(self):
+        item = CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.VIDEO,
+            file=SimpleUploadedFile("clip.mp4", b"not a video", content_type="video/mp4"),
+        )
+
+        with patch("capsule.thumbnails._read_video_frame", side_effect=OSError("no ffmpeg")):
+            self.assertIsNone(generate_item_thumbnails_task(item.pk))
+
+        item.refresh_from_db()
+        self.assertEqual(item.thumbnails, {})
+
+    def test_corrupt_gif_is_skipped(self):
+        item = CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.GIF,
+            file=SimpleUploadedFile("dance.gif", make_gif()[:40], content_type="image/gif"),
+        )
+
+        self.assertIsNone(generate_item_thumbnails_task(item.pk))
+
+        item.refresh_from_db()
+        self.assertEqual(item.thumbnails, {})
+
+    def test_undecodable_video_frame_is_skipped(self):
+        item = CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.VIDEO,
+            file=SimpleUploadedFile("clip.mp4", b"not a video", content_type="video/mp4"),
+        )
+
+        with patch("capsule.thumbnails._read_video_frame", return_value=b"not a jpeg"):
+            self.assertIsNone(generate_item_thumbnails_task(item.pk))
@@ -0,0 +1,139 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from kombu.exceptions import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+from ..models import Capsule
+from ..services import MailDelivery
+from ..timers import TIMERS_KEY, DeliveryTimers
+
+
+User = get_user_model()
+
+
+class FakeSortedSets():
+    """
+    The sorted set commands used by the timer index, kept in memory.
+    """
+
+    def __init__(self):
+        self.sets = {}
+
+    def zadd(self, key, mapping):
+        self.sets.setdefault(key, {}).update({member.encode(): score for member, score in mapping.items()})
+
+    def zrem(self, key, *members):
+        entries = self.sets.get(key, {})
+        removed = [entries.pop(m if isinstance(m, bytes) else m.encode(), None) for m in members]
+        return sum(1 for score in removed if score is not None)
+
+    def _sorted(self, key):
+        return sorted(self.sets.get(key, {}).items(), key=lambda entry: entry[1])
+
+    def zrangebyscore(self, key, low, high, start=0, num=None):
+        members = [member for member, score in self._sorted(key) if score <= high]
+        return members[start:start + num if num else None]
+
+    def zrange(self, key, start, end, withscores=False):
+        entries = self._sorted(key)[start:end + 1]
+        return entries if withscores else [member for member, _ in entries]
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline():
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def zrem(self, key, member):
+        self.commands.append(lambda: self.client.zrem(key, member))
+
+    def execute(self):
+        return [command() for command in self.commands]
+
+
+class DeliveryTimersTest(TestCase):
+    def setUp(self):
+        self.redis = FakeSortedSets()
+        patcher = patch("capsule.timers.get_client", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        self.capsule = Capsule.objects.create(
+            owner=self.user, title="Capsule", deliver_on=timezone.now() + timedelta(hours=1)
+        )
+
+    def scheduled(self):
+        return {int(member): score for member, score in self.redis.sets.get(TIMERS_KEY, {}).items()}
+
+    def test_pending_capsules_get_a_timer_at_their_delivery_date(self):
+        self.assertEqual(self.scheduled(), {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.capsule.status = Capsule.Status.PENDING
+            self.capsule.save()
+        self.assertEqual(self.scheduled(), {self.capsule.pk: self.capsule.deliver_on.timestamp()})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.capsule.delete()
+        self.assertEqual(self.scheduled(), {})
+
+    def test_pop_due_returns_only_due_capsules_once(self):
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            DeliveryTimers.schedule({1: now - timedelta(seconds=1), 2: now + timedelta(minutes=5)})
+
+        self.assertEqual(DeliveryTimers.pop_due(now), [1])
+        self.assertEqual(DeliveryTimers.pop_due(now), [])
+        self.assertAlmostEqual(DeliveryTimers.seconds_until_next(now), 300, places=3)
+
+    def test_failed_delivery_is_rescheduled_at_its_next_attempt(self):
+        Capsule.objects.filter(pk=self.capsule.pk).update(status=Capsule.Status.SENDING)
+        self.capsule.refresh_from_db()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MailDelivery._record_failure(self.capsule)
+
+        self.capsule.refresh_from_db()
+        self.assertEqual(self.scheduled(), {self.capsule.pk: self.capsule.next_attempt_at.timestamp()})
+
+    def test_reconcile_restores_lost_timers_within_the_horizon(self):
+        later = Capsule.objects.create(
+            owner=self.user, title="Later", deliver_on=timezone.now() + timedelta(days=30)
+        )
+        Capsule.objects.update(status=Capsule.Status.PENDING)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(DeliveryTimers.reconcile(horizon_seconds=2 * 60 * 60), 1)
+        self.assertIn(self.capsule.pk, self.scheduled())
+        self.assertNotIn(later.pk, self.scheduled())
+
+    @patch("capsule.management.commands.run_delivery_scheduler.deliver_scheduled_capsules_task")
+    def test_scheduler_dispatches_due_timers(self, task):
+        with self.captureOnCommitCallbacks(execute=True):
+            DeliveryTimers.schedule({self.capsule.pk: timezone.now() - timedelta(seconds=1)})
+
+        out = StringIO()
+        call_command("run_delivery_scheduler", "--once", stdout=out)
+
+        task.delay.assert_called_once_with([self.capsule.pk])
+        self.assertIn("Dispatched 1 due capsules", out.getvalue())
+
+    @patch("capsule.management.commands.run_delivery_scheduler.deliver_scheduled_capsules_task")
+    def test_scheduler_restores_timers_when_the_broker_is_down(self, task):
+        task.delay.side_effect = OperationalError("broker down")
+        with self.captureOnCommitCallbacks(execute=True):
+            DeliveryTimers.schedule({self.capsule.pk: timezone.now() - timedelta(seconds=1)})
+
+        call_command("run_delivery_scheduler", "--once", stdout=StringIO())
+
+        self.assertIn(self.capsule.pk, self.scheduled())
+        self.assertEqual(DeliveryTimers.pop_due(), [self.capsule.pk])
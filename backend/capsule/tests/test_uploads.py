@@ -0,0 +1,105 @@
+from datetime import timedelta
+from unittest.mock import patch
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from ..models import Capsule, CapsuleItem, UploadSession
+from ..uploads import ChunkedUploads, S3UploadBackend
+
+
+class ClientError(Exception):
+    pass
+
+User = get_user_model()
+
+
+@override_settings(CAPSULE_UPLOAD_BACKEND="capsule.uploads.S3UploadBackend")
+class S3ChunkedUploadTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        self.capsule = Capsule.objects.create(
+            owner=self.user,
+            title="First Capsule",
+            deliver_on=timezone.now() + timedelta(days=1),
+        )
+
+        patcher = patch("capsule.uploads.default_storage")
+        self.storage = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage.bucket_name = "bucket"
+        self.storage.generate_filename.side_effect = lambda name: name
+        self.storage._normalize_name.side_effect = lambda name: f"media/{name}"
+        self.client = self.storage.connection.meta.client
+        self.client.exceptions.ClientError = ClientError
+        self.client.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+        self.client.upload_part.side_effect = lambda **kwargs: {"ETag": f"etag-{kwargs['PartNumber']}"}
+        self.client.head_object.return_value = {"ContentLength": 12}
+
+    def test_open_sessions_for_one_filename_get_distinct_keys(self):
+        first = ChunkedUploads.start(self.capsule, CapsuleItem.Kind.VIDEO, "clip.mp4", "video/mp4")
+        second = ChunkedUploads.start(self.capsule, CapsuleItem.Kind.VIDEO, "clip.mp4", "video/mp4")
+        self.assertNotEqual(first.file_name, second.file_name)
+
+    # the chunks are far below S3's minimum part size
+    @patch.object(S3UploadBackend, "MIN_PART_BYTES", 1)
+    def test_session_maps_to_s3_multipart_upload(self):
+        session = ChunkedUploads.start(self.capsule, CapsuleItem.Kind.VIDEO, "clip.mp4", "video/mp4")
+        self.assertEqual(session.storage_upload_id, "upload-1")
+
+        ChunkedUploads.upload_chunk(session, 2, b"second")
+        ChunkedUploads.upload_chunk(session, 1, b"first!")
+        item = ChunkedUploads.complete(session)
+
+        self.assertRegex(session.file_name, rf"^capsules/{self.capsule.pk}/[0-9a-f]{{32}}/clip.mp4$")
+        key = f"media/{session.file_name}"
+        self.client.complete_multipart_upload.assert_called_once_with(
+            Bucket="bucket",
+            Key=key,
+            UploadId="upload-1",
+            MultipartUpload={"Parts": [
+                {"PartNumber": 1, "ETag": "etag-1"},
+                {"PartNumber": 2, "ETag": "etag-2"},
+            ]},
+        )
+        # the object S3 assembled is registered as-is
+        self.assertEqual(item.file.name, session.file_name)
+        self.assertEqual(item.size_in_bytes, 12)
+
+    def test_only_the_last_chunk_may_be_below_the_minimum_part_size(self):
+        session = ChunkedUploads.start(self.capsule, CapsuleItem.Kind.VIDEO, "clip.mp4", "video/mp4")
+        session = ChunkedUploads.upload_chunk(session, 2, b"tail")
+
+        with self.assertRaises(ValidationError):
+            ChunkedUploads.upload_chunk(session, 1, b"small")
+        with self.assertRaises(ValidationError):
+            ChunkedUploads.upload_chunk(session, 3, b"tail")
+        self.client.upload_part.assert_called_once()
+
+    @patch.object(S3UploadBackend, "MIN_PART_BYTES", 1)
+    def test_s3_errors_become_validation_errors(self):
+        session = ChunkedUploads.start(self.capsule, CapsuleItem.Kind.VIDEO, "clip.mp4", "video/mp4")
+        ChunkedUploads.upload_chunk(session, 1, b"first!")
+        self.client.complete_multipart_upload.side_effect = ClientError("EntityTooSmall")
+
+        with self.assertRaises(ValidationError):
+            ChunkedUploads.complete(session)
+        session.refresh_from_db()
+        self.assertEqual(session.status, UploadSession.Status.OPEN)
+        self.assertFalse(CapsuleItem.objects.exists())
+
+    def test_stale_sessions_are_aborted(self):
+        stale = ChunkedUploads.start(self.capsule, CapsuleItem.Kind.VIDEO, "old.mp4", "video/mp4")
+        UploadSession.objects.filter(pk=stale.pk).update(created_at=timezone.now() - timedelta(days=2))
+        fresh = ChunkedUploads.start(self.capsule, CapsuleItem.Kind.VIDEO, "new.mp4", "video/mp4")
+
+        self.assertEqual(ChunkedUploads.abort_stale(), 1)
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(stale.status, UploadSession.Status.ABORTED)
+        self.assertEqual(fresh.status, UploadSession.Status.OPEN)
+        self.client.abort_multipart_upload.assert_called_once()
@@ -0,0 +1,87 @@
+import io
+import os
+import ffmpeg
+from PIL import Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from .models import CapsuleItem
+
+# Pillow format name and file extension of each stored variant
+THUMBNAIL_FORMATS = (("JPEG", "jpg"), ("WEBP", "webp"))
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+# ffmpeg reads the video straight from local disk, or over http from a
+# signed url so that only the bytes around the poster frame are fetched.
+def _video_source(name):
+    try:
+        return default_storage.path(name)
+    except NotImplementedError:
+        return default_storage.url(name)
+
+
+def _read_video_frame(name, seconds):
+    out, _ = (
+        ffmpeg
+        .input(_video_source(name), ss=seconds)
+        .output("pipe:", vframes=1, format="image2", vcodec="mjpeg")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return out
+
+
+def extract_poster_frame(item: CapsuleItem):
+    """
+    Returns the poster frame of a video or GIF item as an RGB image.
+    Videos use the frame one second in, falling back to the first frame
+    for clips shorter than that.
+    """
+    if item.kind == CapsuleItem.Kind.GIF:
+        try:
+            with default_storage.open(item.file.name, "rb") as f:
+                with Image.open(f) as image:
+                    image.seek(0)
+                    return image.convert("RGB")
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ThumbnailError(f"Could not read {item.file.name}: {e}") from e
+
+    try:
+        frame = _read_video_frame(item.file.name, 1) or _read_video_frame(item.file.name, 0)
+    except (ffmpeg.Error, OSError) as e:
+        raise ThumbnailError(f"Could not read a frame from {item.file.name}: {e}") from e
+    if not frame:
+        raise ThumbnailError(f"{item.file.name} has no video frames")
+
+    try:
+        with Image.open(io.BytesIO(frame)) as image:
+            return image.convert("RGB")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ThumbnailError(f"Could not decode the frame of {item.file.name}: {e}") from e
+
+
+def generate_thumbnails(item: CapsuleItem):
+    """
+    Stores sized JPEG and WebP variants of the item's poster frame next to
+    the original file, e.g. capsules/<id>/thumbnails/clip_320.webp.
+    Returns a mapping of variant ("320.webp") to stored file name.
+    """
+    poster = extract_poster_frame(item)
+    directory, filename = os.path.split(item.file.name)
+    stem = os.path.splitext(filename)[0]
+
+    variants = {}
+    for width in getattr(settings, "CAPSULE_THUMBNAIL_WIDTHS", (160, 320, 640)):
+        image = poster.copy()
+        image.thumbnail((width, width * 4))
+        for image_format, extension in THUMBNAIL_FORMATS:
+            buffer = io.BytesIO()
+            image.save(buffer, image_format, quality=80)
+            name = f"{directory}/thumbnails/{stem}_{width}.{extension}"
+            variants[f"{width}.{extension}"] = default_storage.save(
+                name, ContentFile(buffer.getvalue())
+            )
+    return variants
@@ -0,0 +1,132 @@
+import logging
+import redis
+from django.conf import settings
+from django.db import transaction
+from datetime import timedelta
+from django.utils import timezone
+from .models import Capsule
+
+logger = logging.getLogger(__name__)
+
+TIMERS_KEY = "capsule:delivery-timers"
+
+_client = None
+
+
+def get_client():
+    """
+    Redis client for the timer index, or None when no timer index is
+    configured (delivery then relies on the periodic database scan).
+    """
+    global _client
+    url = getattr(settings, "CAPSULE_TIMERS_REDIS_URL", None)
+    if not url:
+        return None
+    if _client is None:
+        _client = redis.Redis.from_url(url)
+    return _client
+
+
+class DeliveryTimers():
+    """
+    Redis sorted set of pending capsules scored by when they are due, so
+    the delivery scheduler can wake up exactly when the next capsule is due
+    without querying the database in between.
+    The database stays the source of truth: an entry only prompts a claim,
+    and entries lost or left over are repaired by reconcile().
+    """
+
+    @classmethod
+    def schedule(cls, due):
+        """
+        Adds or moves the timers of {capsule_id: due datetime} once the
+        current transaction commits.
+        """
+        if not due or get_client() is None:
+            return
+        mapping = {str(capsule_id): when.timestamp() for capsule_id, when in due.items()}
+        transaction.on_commit(lambda: cls._call("schedule", lambda client: client.zadd(TIMERS_KEY, mapping)))
+
+    @classmethod
+    def unschedule(cls, capsule_ids):
+        if not capsule_ids or get_client() is None:
+            return
+        members = [str(capsule_id) for capsule_id in capsule_ids]
+        transaction.on_commit(lambda: cls._call("unschedule", lambda client: client.zrem(TIMERS_KEY, *members)))
+
+    @classmethod
+    def pop_due(cls, now=None, limit=1000):
+        """
+        Removes and returns the ids of up to `limit` capsules due by `now`.
+        When schedulers race, each entry is returned to only one of them.
+        """
+        now = (now or timezone.now()).timestamp()
+        client = get_client()
+        members = client.zrangebyscore(TIMERS_KEY, "-inf", now, start=0, num=limit)
+        if not members:
+            return []
+
+        pipe = client.pipeline()
+        for member in members:
+            pipe.zrem(TIMERS_KEY, member)
+        removed = pipe.execute()
+        return [int(member) for member, was_removed in zip(members, removed) if was_removed]
+
+    @classmethod
+    def restore(cls, capsule_ids, now=None):
+        """
+        Puts back popped timers whose capsules could not be dispatched, due
+        at once so the next check retries them.
+        """
+        now = (now or timezone.now()).timestamp()
+        get_client().zadd(TIMERS_KEY, {str(capsule_id): now for capsule_id in capsule_ids})
+
+    @classmethod
+    def seconds_until_next(cls, now=None):
+        """
+        Seconds until the earliest timer is due (0 if one is overdue), or
+        None when no capsule is scheduled.
+        """
+        earliest = get_client().zrange(TIMERS_KEY, 0, 0, withscores=True)
+        if not earliest:
+            return None
+        now = (now or timezone.now()).timestamp()
+        return max(0.0, earliest[0][1] - now)
+
+    @classmethod
+    def reconcile(cls, horizon_seconds=None):
+        """
+        Re-adds the timers of every pending capsule due within the horizon,
+        repairing entries that were lost (e.g. Redis was unavailable when
+        the capsule was saved, or capsules were bulk-created).
+        Returns how many timers were written.
+        """
+        if get_client() is None:
+            return 0
+        horizon_seconds = horizon_seconds or getattr(
+            settings, "CAPSULE_TIMERS_RECONCILE_HORIZON_SECONDS", 60 * 60
+        )
+        pending = Capsule.objects.filter(
+            status=Capsule.Status.PENDING,
+            deliver_on__lte=timezone.now() + timedelta(seconds=horizon_seconds),
+        ).only("id", "deliver_on", "next_attempt_at")
+
+        due = {capsule.pk: due_at(capsule) for capsule in pending.iterator()}
+        cls.schedule(due)
+        return len(due)
+
+    @classmethod
+    def _call(cls, action, command):
+        # a failed write is repaired by the next reconcile(), so it must not
+        # fail the request or delivery that triggered it
+        try:
+            command(get_client())
+        except redis.RedisError as e:
+            logger.warning(f"Could not {action} delivery timers: {e}")
+
+
+# When a pending capsule should next be attempted
+def due_at(capsule):
+    if capsule.next_attempt_at and capsule.next_attempt_at > capsule.deliver_on:
+        return capsule.next_attempt_at
+    return capsule.deliver_on
@@ -0,0 +1,446 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Capsule, CapsuleItem, UploadSession, path_to_capsule_item_file
+
+logger = logging.getLogger(__name__)
+
+
+class UploadBackendError(Exception):
+    pass
+
+
+class LocalUploadBackend():
+    """
+    Filesystem stand-in for S3 multipart uploads, used in development.
+    Chunks are kept as part files under uploads/<session id>/ and are
+    streamed into the final file when the upload is completed.
+    """
+    # smallest size of every chunk but the last
+    MIN_PART_BYTES = 0
+
+    def _part_name(self, session: UploadSession, number):
+        return f"uploads/{session.pk}/{number}.part"
+
+    def start(self, session: UploadSession):
+        return ""
+
+    def upload_part(self, session: UploadSession, number, data):
+        # a resent chunk replaces the earlier copy
+        name = self._part_name(session, number)
+        default_storage.delete(name)
+        default_storage.save(name, ContentFile(data))
+        return hashlib.md5(data).hexdigest()
+
+    def complete(self, session: UploadSession, part_numbers):
+        """
+        Writes the parts, in order, into the final file and returns its size.
+        """
+        path = default_storage.path(session.file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path, "wb") as destination:
+                for number in part_numbers:
+                    with default_storage.open(self._part_name(session, number), "rb") as part:
+                        shutil.copyfileobj(part, destination)
+        except OSError as e:
+            raise UploadBackendError(str(e)) from e
+
+        self.abort(session)
+        return default_storage.size(session.file_name)
+
+    def abort(self, session: UploadSession):
+        for number in session.parts:
+            default_storage.delete(self._part_name(session, number))
+
+    def presign_upload(self, name, content_type, max_bytes, token, expires):
+        """
+        Direct uploads go to the local stand-in endpoint, authorized by the
+        signed token in its url.
+        """
+        return {
+            "method": "PUT",
+            "url": reverse("capsule_api:direct_upload", args=[token]),
+            "headers": {"Content-Type": content_type},
+        }
+
+    def stat(self, name):
+        """
+        Size and content type of a stored file, or None if it is missing.
+        """
+        if not default_storage.exists(name):
+            return None
+        return default_storage.size(name), mimetypes.guess_type(name)[0]
+
+
+class S3UploadBackend():
+    """
+    Maps upload sessions onto S3 multipart uploads of the final object, so
+    the file is assembled by S3 and never copied again once uploaded.
+    Every chunk but the last must be at least 5 MB.
+    S3 errors are raised as UploadBackendError.
+    """
+    MIN_PART_BYTES = 5 * 1024 * 1024
+
+    def __init__(self):
+        self.client = default_storage.connection.meta.client
+        self.bucket = default_storage.bucket_name
+
+    def _key(self, name):
+        return default_storage._normalize_name(name)
+
+    def _call(self, method, **kwargs):
+        try:
+            return getattr(self.client, method)(Bucket=self.bucket, **kwargs)
+        except self.client.exceptions.ClientError as e:
+            raise UploadBackendError(str(e)) from e
+
+    def start(self, session: UploadSession):
+        response = self._call(
+            "create_multipart_upload",
+            Key=self._key(session.file_name),
+            ContentType=session.mime_type or "application/octet-stream",
+        )
+        return response["UploadId"]
+
+    def upload_part(self, session: UploadSession, number, data):
+        response = self._call(
+            "upload_part",
+            Key=self._key(session.file_name),
+            UploadId=session.storage_upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        return response["ETag"]
+
+    def complete(self, session: UploadSession, part_numbers):
+        key = self._key(session.file_name)
+        self._call(
+            "complete_multipart_upload",
+            Key=key,
+            UploadId=session.storage_upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": number, "ETag": session.parts[str(number)]["etag"]}
+                    for number in part_numbers
+                ]
+            },
+        )
+        return self._call("head_object", Key=key)["ContentLength"]
+
+    def abort(self, session: UploadSession):
+        self._call(
+            "abort_multipart_upload",
+            Key=self._key(session.file_name),
+            UploadId=session.storage_upload_id,
+        )
+
+    def presign_upload(self, name, content_type, max_bytes, token, expires):
+        """
+        A presigned POST that S3 only accepts for this key, with the
+        declared content type and at most `max_bytes` bytes.
+        """
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=self._key(name),
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 1, max_bytes],
+            ],
+            ExpiresIn=expires,
+        )
+        return {"method": "POST", "url": post["url"], "fields": post["fields"]}
+
+    def stat(self, name):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+        except self.client.exceptions.ClientError:
+            return None
+        return head["ContentLength"], head.get("ContentType")
+
+
+def get_upload_backend_class():
+    return import_string(
+        getattr(settings, "CAPSULE_UPLOAD_BACKEND", "capsule.uploads.LocalUploadBackend")
+    )
+
+
+def get_upload_backend():
+    return get_upload_backend_class()()
+
+
+FILE_KINDS = (
+    CapsuleItem.Kind.IMAGE,
+    CapsuleItem.Kind.VIDEO,
+    CapsuleItem.Kind.AUDIO,
+    CapsuleItem.Kind.GIF,
+)
+
+
+def validate_file_kind(kind):
+    if kind not in FILE_KINDS:
+        raise ValidationError("A {} cannot be uploaded as a file".format(kind))
+
+
+# The main mime type every upload of a kind must have
+KIND_MIME_TYPES = {
+    CapsuleItem.Kind.IMAGE: "image/",
+    CapsuleItem.Kind.GIF: "image/gif",
+    CapsuleItem.Kind.VIDEO: "video/",
+    CapsuleItem.Kind.AUDIO: "audio/",
+}
+
+
+def validate_mime_type(kind, mime_type):
+    if not mime_type or not mime_type.startswith(KIND_MIME_TYPES[kind]):
+        raise ValidationError("A {} cannot have the type {}".format(kind, mime_type))
+
+
+# Storage name for a new file of `capsule`, in the folder used by
+# CapsuleItem.file (capsules/<capsule_id>/). Nothing reserves a name until
+# its file is stored, so every upload gets its own random folder; uploads of
+# the same filename that are open at once never share a key.
+def new_item_file_name(capsule: Capsule, filename):
+    path = path_to_capsule_item_file(CapsuleItem(capsule=capsule), f"{uuid.uuid4().hex}/{filename}")
+    name = default_storage.generate_filename(path)
+
+    max_length = CapsuleItem._meta.get_field("file").max_length
+    if len(name) > max_length:
+        stem, extension = os.path.splitext(name)
+        name = stem[:max_length - len(extension)] + extension
+    return name
+
+
+class ChunkedUploads():
+    """
+    Resumable uploads of capsule item files: a session is started, numbered
+    chunks are sent (and may be resent) in any order, and completing the
+    session creates the CapsuleItem from the assembled file.
+    The mime type must match the kind. When the client does not send one it
+    is guessed from the filename, or taken from the stored file on completion.
+    """
+
+    @classmethod
+    def start(cls, capsule: Capsule, kind, filename, mime_type=""):
+        validate_file_kind(kind)
+        mime_type = mime_type or mimetypes.guess_type(filename)[0] or ""
+        if mime_type:
+            validate_mime_type(kind, mime_type)
+
+        session = UploadSession(
+            capsule=capsule,
+            kind=kind,
+            filename=filename,
+            mime_type=mime_type,
+            file_name=new_item_file_name(capsule, filename),
+        )
+        session.storage_upload_id = cls._call_backend("start", session)
+        session.save()
+        return session
+
+    # Backend failures are reported to the client like any invalid upload
+    @classmethod
+    def _call_backend(cls, method, *args):
+        try:
+            return getattr(get_upload_backend(), method)(*args)
+        except UploadBackendError as e:
+            logger.warning(f"Upload backend {method} failed: {e}")
+            raise ValidationError("Upload storage rejected the request: {}".format(e))
+
+    # Every chunk but the last must have the backend's minimum size, so a
+    # small chunk may only be the highest numbered one.
+    @classmethod
+    def _validate_part_sizes(cls, parts):
+        min_bytes = get_upload_backend().MIN_PART_BYTES
+        last = max(parts)
+        for number, size in parts.items():
+            if number != last and size < min_bytes:
+                raise ValidationError(
+                    "Chunk {} has {} bytes, every chunk but the last needs at least {}".format(number, size, min_bytes)
+                )
+
+    @classmethod
+    def upload_chunk(cls, session: UploadSession, number, data):
+        max_parts = getattr(settings, "CAPSULE_UPLOAD_MAX_PARTS", 10000)
+        if not 1 <= number <= max_parts:
+            raise ValidationError("Chunk number must be between 1 and {}".format(max_parts))
+        if not data:
+            raise ValidationError("Chunk is empty")
+
+        sizes = {int(n): part["size"] for n, part in session.parts.items()}
+        cls._validate_part_sizes({**sizes, number: len(data)})
+
+        etag = cls._call_backend("upload_part", session, number, data)
+
+        # lock the session so chunks uploaded in parallel don't overwrite
+        # each other's entry in `parts`
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            session.parts[str(number)] = {"size": len(data), "etag": etag}
+            session.save(update_fields=["parts"])
+        return session
+
+    @classmethod
+    @transaction.atomic
+    def complete(cls, session: UploadSession):
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if session.status != UploadSession.Status.OPEN:
+            raise ValidationError("Upload is already {}".format(session.status))
+
+        part_numbers = sorted(int(number) for number in session.parts)
+        if not part_numbers or part_numbers != list(range(1, len(part_numbers) + 1)):
+            raise ValidationError("Every chunk from 1 to the last one must be uploaded")
+        # chunks uploaded in parallel are only checked against each other here
+        cls._validate_part_sizes({int(n): part["size"] for n, part in session.parts.items()})
+
+        size = cls._call_backend("complete", session, part_numbers)
+
+        mime_type = session.mime_type
+        if not mime_type:
+            stored = get_upload_backend().stat(session.file_name)
+            mime_type = stored[1] if stored else None
+            try:
+                validate_mime_type(session.kind, mime_type)
+            except ValidationError:
+                default_storage.delete(session.file_name)
+                raise
+
+        # the file is already in place, only its name is recorded
+        item = CapsuleItem(
+            capsule=session.capsule,
+            kind=session.kind,
+            file=session.file_name,
+            mime_type=mime_type,
+            size_in_bytes=size,
+        )
+        item.save()
+
+        session.status = UploadSession.Status.COMPLETE
+        session.item = item
+        session.save(update_fields=["status", "item"])
+        return item
+
+    @classmethod
+    def abort(cls, session: UploadSession):
+        """
+        Cancels an open upload and discards the chunks received so far.
+        """
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            if session.status != UploadSession.Status.OPEN:
+                raise ValidationError("Upload is already {}".format(session.status))
+            session.status = UploadSession.Status.ABORTED
+            session.save(update_fields=["status"])
+
+        try:
+            get_upload_backend().abort(session)
+        except UploadBackendError as e:
+            # S3 also drops incomplete multipart uploads by bucket lifecycle rule
+            logger.warning(f"Could not discard the chunks of upload {session.pk}: {e}")
+        return session
+
+    @classmethod
+    def abort_stale(cls, max_age_seconds=None):
+        """
+        Aborts the uploads left open for longer than
+        CAPSULE_UPLOAD_SESSION_MAX_AGE_SECONDS. Returns how many were aborted.
+        """
+        max_age_seconds = max_age_seconds or getattr(settings, "CAPSULE_UPLOAD_SESSION_MAX_AGE_SECONDS", 24 * 60 * 60)
+        stale = UploadSession.objects.filter(
+            status=UploadSession.Status.OPEN,
+            created_at__lt=timezone.now() - timedelta(seconds=max_age_seconds),
+        )
+        aborted = 0
+        for session in stale.iterator():
+            try:
+                cls.abort(session)
+                aborted += 1
+            except ValidationError:
+                # completed or aborted in the meantime
+                pass
+        return aborted
+
+
+class DirectUploads():
+    """
+    Uploads that go straight from the client to storage, bypassing the
+    Django workers. `presign` hands out a presigned upload for a file under
+    capsules/<capsule_id>/ and a signed token describing it; `confirm`
+    checks the stored object against the token and registers the item.
+    """
+    TOKEN_SALT = "capsule.uploads.direct"
+
+    @classmethod
+    def _expires(cls):
+        return getattr(settings, "CAPSULE_DIRECT_UPLOAD_EXPIRY_SECONDS", 60 * 60)
+
+    @classmethod
+    def _max_bytes(cls):
+        return getattr(settings, "CAPSULE_DIRECT_UPLOAD_MAX_BYTES", 1024 * 1024 * 1024)
+
+    @classmethod
+    def presign(cls, capsule: Capsule, kind, filename, mime_type, size):
+        validate_file_kind(kind)
+        validate_mime_type(kind, mime_type)
+        if not 0 < size <= cls._max_bytes():
+            raise ValidationError("File size must be between 1 and {} bytes".format(cls._max_bytes()))
+
+        name = new_item_file_name(capsule, filename)
+        token = signing.dumps(
+            {"capsule": capsule.pk, "name": name, "kind": kind, "mime_type": mime_type, "size": size},
+            salt=cls.TOKEN_SALT,
+        )
+        upload = get_upload_backend().presign_upload(name, mime_type, size, token, cls._expires())
+        return {"upload": upload, "upload_token": token, "expires_in": cls._expires()}
+
+    @classmethod
+    def load_token(cls, token):
+        try:
+            return signing.loads(token, salt=cls.TOKEN_SALT, max_age=cls._expires())
+        except signing.BadSignature:
+            raise ValidationError("Upload token is invalid or expired")
+
+    @classmethod
+    @transaction.atomic
+    def confirm(cls, capsule: Capsule, token):
+        upload = cls.load_token(token)
+        if upload["capsule"] != capsule.pk:
+            raise ValidationError("Upload token belongs to another capsule")
+        # confirms of one capsule wait for each other, so a token sent twice
+        # at once still registers one item
+        Capsule.objects.select_for_update().get(pk=capsule.pk)
+        if CapsuleItem.objects.filter(capsule=capsule, file=upload["name"]).exists():
+            raise ValidationError("Upload was already registered")
+
+        stored = get_upload_backend().stat(upload["name"])
+        if stored is None:
+            raise ValidationError("Upload has not been received")
+        size, content_type = stored
+        if size != upload["size"]:
+            raise ValidationError("Uploaded {} bytes but {} were declared".format(size, upload["size"]))
+        if content_type:
+            validate_mime_type(upload["kind"], content_type)
+
+        item = CapsuleItem(
+            capsule=capsule,
+            kind=upload["kind"],
+            file=upload["name"],
+            mime_type=upload["mime_type"],
+            size_in_bytes=size,
+        )
+        item.save()
+        return item
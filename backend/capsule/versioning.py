@@ -0,0 +1,55 @@
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from .models import Capsule
+from .routers import pin_to_primary
+
+
+# Every user has a version stamp for their capsule and item lists. It is
+# replaced whenever one of their capsules or items changes, so list views
+# can tell a client its copy is current without querying anything.
+# Stamps are random rather than counters, so a stamp lost from the cache is
+# replaced by one no client has seen.
+
+def _version_key(user_id):
+    return f"capsule:list-version:{user_id}"
+
+
+def list_version(user_id):
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_list_versions(user_ids):
+    """
+    Replaces the version stamp of the given users once the current
+    transaction commits, so a stamp is never paired with uncommitted data,
+    and pins their reads to the primary database.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def bump():
+        # the users' next reads must see this change, which the replica
+        # may not have received yet
+        pin_to_primary(user_ids)
+        cache.set_many(
+            {_version_key(user_id): uuid.uuid4().hex for user_id in user_ids},
+            timeout=None,
+        )
+
+    transaction.on_commit(bump)
+
+
+def bump_capsule_owners(capsule_ids):
+    """
+    For changes made with queryset update(), which sends no signals.
+    """
+    bump_list_versions(
+        Capsule.objects.filter(id__in=capsule_ids).values_list("owner_id", flat=True).distinct()
+    )
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CapsuleApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "capsule_api"
+
+    def ready(self):
+        from . import authentication  # noqa: F401
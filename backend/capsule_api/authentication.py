@@ -0,0 +1,115 @@
+import hashlib
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+# Tokens resolved by this process, as {key: (expires_at, snapshot)}
+_local_tokens = {}
+_local_lock = threading.Lock()
+
+# User fields kept for a resolved token. Anything else (and never the
+# password hash) is loaded from the database on first access.
+SNAPSHOT_FIELDS = ("id", "email", "is_active", "is_staff", "is_superuser")
+
+# Left in the shared cache by forget_token so that a request which read the
+# token before it was forgotten cannot put it back
+_FORGOTTEN = "forgotten"
+
+
+def _cache_key(key):
+    # the raw token never ends up in the cache
+    return "capsule:auth-token:" + hashlib.sha256(key.encode()).hexdigest()
+
+
+def _snapshot(user):
+    return {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+
+
+def _credentials(key, snapshot):
+    """
+    Builds a fresh (user, token) pair from a snapshot without a query, so no
+    two requests ever share a User instance.
+    """
+    User = get_user_model()
+    fields = [f.attname for f in User._meta.concrete_fields if f.attname in snapshot]
+    user = User.from_db(None, fields, [snapshot[field] for field in fields])
+    token = Token.from_db(None, ["key", "user_id"], [key, user.pk])
+    token.user = user
+    return user, token
+
+
+def forget_token(key):
+    """
+    Drops a token from the shared cache and from this process.
+    Other processes keep their copy for at most
+    CAPSULE_AUTH_TOKEN_LOCAL_SECONDS.
+    """
+    cache.set(
+        _cache_key(key),
+        _FORGOTTEN,
+        timeout=getattr(settings, "CAPSULE_AUTH_TOKEN_TOMBSTONE_SECONDS", 10),
+    )
+    with _local_lock:
+        _local_tokens.pop(key, None)
+
+
+def clear_local_tokens():
+    with _local_lock:
+        _local_tokens.clear()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that remembers which user a token belongs to, first
+    in process for a few seconds and then in the shared cache, so most
+    requests resolve their token without a query.
+    Uses the same Token model and Authorization header as TokenAuthentication.
+    """
+
+    def authenticate_credentials(self, key):
+        now = time.monotonic()
+        with _local_lock:
+            cached = _local_tokens.get(key)
+        if cached and cached[0] > now:
+            return _credentials(key, cached[1])
+
+        snapshot = cache.get(_cache_key(key))
+        if not isinstance(snapshot, dict):
+            # raises AuthenticationFailed for unknown tokens and inactive users
+            user, token = super().authenticate_credentials(key)
+            snapshot = _snapshot(user)
+            # add() leaves a tombstone from forget_token in place
+            cache.add(
+                _cache_key(key),
+                snapshot,
+                timeout=getattr(settings, "CAPSULE_AUTH_TOKEN_CACHE_SECONDS", 60),
+            )
+
+        local_seconds = getattr(settings, "CAPSULE_AUTH_TOKEN_LOCAL_SECONDS", 5)
+        max_entries = getattr(settings, "CAPSULE_AUTH_TOKEN_LOCAL_MAX_ENTRIES", 10000)
+        with _local_lock:
+            if len(_local_tokens) >= max_entries:
+                # evict the oldest entry
+                _local_tokens.pop(next(iter(_local_tokens)))
+            _local_tokens[key] = (now + local_seconds, snapshot)
+        return _credentials(key, snapshot)
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    forget_token(instance.key)
+
+
+# The cached user must not outlive a deactivation or any other change
+@receiver(post_save, sender=get_user_model())
+def user_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    for key in Token.objects.filter(user_id=instance.pk).values_list("key", flat=True):
+        forget_token(key)
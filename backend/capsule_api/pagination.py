@@ -0,0 +1,10 @@
+from rest_framework.pagination import CursorPagination
+
+
+# Pages through a user's capsules by (deliver_on, id), so each page costs
+# the same however many capsules the user has
+class CapsuleCursorPagination(CursorPagination):
+    ordering = ("deliver_on", "id")
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
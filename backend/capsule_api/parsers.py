@@ -0,0 +1,42 @@
+import re
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, MultiPartParser
+
+INDEXED_FIELD = re.compile(r"^items\[(\d+)\]\[(\w+)\]$")
+
+
+# Reads a raw upload chunk from the request body, refusing chunks larger
+# than CAPSULE_UPLOAD_MAX_CHUNK_BYTES
+class ChunkParser(BaseParser):
+    media_type = "application/octet-stream"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        max_bytes = getattr(settings, "CAPSULE_UPLOAD_MAX_CHUNK_BYTES", 8 * 1024 * 1024)
+        if stream is None:
+            return b""
+
+        data = stream.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise ParseError("Chunk is larger than {} bytes".format(max_bytes))
+        return data
+
+
+# Parses a multipart payload of many items, sent as fields named
+# items[<index>][<field>] (e.g. items[0][kind], items[0][file]),
+# into {"items": [{...}, ...]} ordered by index
+class IndexedItemsMultiPartParser(MultiPartParser):
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parsed = super().parse(stream, media_type, parser_context)
+
+        items = {}
+        for values in (parsed.data, parsed.files):
+            for key in values:
+                match = INDEXED_FIELD.match(key)
+                if not match:
+                    raise ParseError("Unexpected field {}".format(key))
+                index, field = match.groups()
+                items.setdefault(int(index), {})[field] = values.get(key)
+
+        return {"items": [items[index] for index in sorted(items)]}
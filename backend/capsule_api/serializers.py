@@ -1,12 +1,48 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.utils import timezone
-from capsule.models import Capsule, CapsuleItem, DeliveryLog, CustomUser
+from capsule.models import Capsule, CapsuleItem, DeliveryLog, CustomUser, UploadSession
+from capsule.signals import queue_item_thumbnails
+from capsule.versioning import bump_list_versions
+from django.db.models import Count, Prefetch
 from rest_framework import serializers
 
+
+# Serializers declare the relations they read, so that the views returning
+# them load those relations up front instead of once per object.
+class EagerLoadingMixin():
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        return queryset
+
+# Creates many items of one capsule together: positions are reserved at once
+# and the items are inserted with a single bulk_create
+class CapsuleItemListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        capsule = validated_data[0]["capsule"]
+        items = [
+            CapsuleItem(**{field: value for field, value in attrs.items() if field != "capsule"})
+            for attrs in validated_data
+        ]
+        items = CapsuleItem.objects.bulk_append(capsule, items)
+        for item in items:
+            queue_item_thumbnails(item)
+        bump_list_versions([capsule.owner_id])
+        return items
+
 class CapsuleItemSerializer(serializers.ModelSerializer):
     class Meta:
         model =  CapsuleItem
         exclude = ["capsule", "id", "size_in_bytes"]
         read_only_fields = ["uploaded_at"]
+        list_serializer_class = CapsuleItemListSerializer
 
     # Ensures that a url and no file is present if item is a music link
     # and ensures that a file and no url is present if item is not a music link
@@ -46,8 +82,9 @@ class CapsuleItemSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(errors)
         return attrs
 
-class CapsuleSerializer(serializers.ModelSerializer):
+class CapsuleSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     capsule_items = CapsuleItemSerializer(many=True, read_only=True)
+    prefetch_related_fields = ("capsule_items",)
 
     class Meta:
         model = Capsule
@@ -61,6 +98,62 @@ class CapsuleSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Date to be delivered must be in the future.")
         return attrs
 
+# A resumable upload; chunks and completion go through their own endpoints
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ["id", "kind", "filename", "mime_type", "status", "parts", "created_at"]
+        read_only_fields = ["id", "status", "parts", "created_at"]
+
+# Describes a file the client wants to upload straight to storage
+class DirectUploadRequestSerializer(serializers.Serializer):
+    kind = serializers.ChoiceField(choices=CapsuleItem.Kind.choices)
+    filename = serializers.CharField(max_length=255)
+    mime_type = serializers.CharField(max_length=50)
+    size = serializers.IntegerField(min_value=1)
+
+class DirectUploadConfirmSerializer(serializers.Serializer):
+    upload_token = serializers.CharField()
+
+# Slim representation for capsule lists: an item count and a thumbnail
+# instead of every nested item
+class CapsuleListSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    item_count = serializers.IntegerField(read_only=True)
+    thumbnail = serializers.SerializerMethodField()
+
+    # the first image, GIF or video of each capsule is used as its thumbnail
+    COVER_KINDS = (CapsuleItem.Kind.IMAGE, CapsuleItem.Kind.GIF, CapsuleItem.Kind.VIDEO)
+
+    class Meta:
+        model = Capsule
+        fields = ["id", "title", "deliver_on", "status", "delivered_at",
+                  "delivery_email", "item_count", "thumbnail"]
+        read_only_fields = fields
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        cover_items = CapsuleItem.objects.filter(
+            kind__in=cls.COVER_KINDS
+        ).order_by("position")[:1]
+        return queryset.annotate(
+            item_count=Count("capsule_items")
+        ).prefetch_related(
+            Prefetch("capsule_items", queryset=cover_items, to_attr="cover_items")
+        )
+
+    def get_thumbnail(self, capsule):
+        if not capsule.cover_items:
+            return None
+
+        item = capsule.cover_items[0]
+        variant = getattr(settings, "CAPSULE_LIST_THUMBNAIL_VARIANT", "320.webp")
+        name = item.thumbnails.get(variant)
+        if name:
+            return default_storage.url(name)
+        if item.kind == CapsuleItem.Kind.IMAGE:
+            return item.file.url
+        return None
+
 # System generated, never writable
 class DeliveryLogSerializer(serializers.ModelSerializer):
     class Meta:
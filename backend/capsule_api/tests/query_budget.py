@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetMixin():
+    """
+    Asserts an upper bound on the queries an endpoint runs, so that a
+    relation read once per object fails the suite instead of slipping in.
+    """
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+
+        executed = len(context.captured_queries)
+        if executed > budget:
+            queries = "\n".join(
+                f"{i}. {query['sql']}" for i, query in enumerate(context.captured_queries, start=1)
+            )
+            self.fail(  # pyright: ignore
+                f"{executed} queries executed, the budget is {budget}\nCaptured queries were:\n{queries}"
+            )
@@ -0,0 +1,30 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+
+from capsule.models import Capsule, CapsuleItem
+from capsule_api.serializers import CapsuleSerializer
+
+User = get_user_model()
+
+
+class CapsuleSerializerEagerLoadingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        for day in range(1, 6):
+            capsule = Capsule.objects.create(
+                owner=self.user, title=f"Capsule {day}", deliver_on=timezone.now() + timedelta(days=day)
+            )
+            CapsuleItem.objects.create(capsule=capsule, kind=CapsuleItem.Kind.TEXT, text="Hi")
+
+    def test_nested_items_are_prefetched(self):
+        queryset = CapsuleSerializer.setup_eager_loading(Capsule.objects.filter(owner=self.user))
+
+        # capsules, then every capsule's items at once
+        with self.assertNumQueries(2):
+            data = CapsuleSerializer(queryset, many=True).data
+
+        self.assertEqual([len(capsule["capsule_items"]) for capsule in data], [1] * 5)
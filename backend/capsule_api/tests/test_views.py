@@ -0,0 +1,546 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from unittest.mock import Mock, patch
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+
+from capsule.list_cache import ListResponseCache
+from capsule_api.authentication import CachedTokenAuthentication, _cache_key, clear_local_tokens
+from capsule_api.throttling import LoginEmailThrottle, _password_checks
+from capsule.models import Capsule, CapsuleItem, DeliveryLog, UploadSession
+from capsule.tests.media import TemporaryMediaRootMixin
+from .query_budget import QueryBudgetMixin
+
+User = get_user_model()
+
+
+class AuthenticatedAPITestCase(APITestCase):
+    # Create a user with a token and a capsule before each test.
+    # Cached lists and tokens are dropped, as user ids are reused between tests.
+    def setUp(self):
+        cache.clear()
+        clear_local_tokens()
+        self.user = User.objects.create(
+            username="TestUser", email="test@example.com", password="pass", timezone="UTC"
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+        self.capsule = Capsule.objects.create(
+            owner=self.user,
+            title="First Capsule",
+            deliver_on=timezone.now() + timedelta(days=1),
+        )
+
+
+@override_settings(CAPSULE_UPLOAD_BACKEND="capsule.uploads.LocalUploadBackend")
+class ChunkedUploadViewsTest(TemporaryMediaRootMixin, AuthenticatedAPITestCase):
+    def start_upload(self, **data):
+        url = reverse("capsule_api:create_upload_session", args=[self.capsule.pk])
+        return self.client.post(
+            url, {"kind": "video", "filename": "clip.mp4", "mime_type": "video/mp4", **data}
+        )
+
+    def put_chunk(self, session_id, number, data):
+        url = reverse("capsule_api:upload_chunk", args=[self.capsule.pk, session_id, number])
+        return self.client.put(url, data, content_type="application/octet-stream")
+
+    def test_chunked_upload_creates_item(self):
+        response = self.start_upload()
+        self.assertEqual(response.status_code, 201)
+        session_id = response.data["id"]
+
+        # chunks may arrive out of order and be resent
+        self.assertEqual(self.put_chunk(session_id, 2, b"world").status_code, 200)
+        self.assertEqual(self.put_chunk(session_id, 1, b"HELLO ").status_code, 200)
+        self.assertEqual(self.put_chunk(session_id, 1, b"hello ").status_code, 200)
+
+        response = self.client.get(
+            reverse("capsule_api:upload_session", args=[self.capsule.pk, session_id])
+        )
+        self.assertEqual(set(response.data["parts"]), {"1", "2"})
+
+        response = self.client.post(
+            reverse("capsule_api:complete_upload_session", args=[self.capsule.pk, session_id])
+        )
+        self.assertEqual(response.status_code, 201)
+
+        item = CapsuleItem.objects.get(capsule=self.capsule)
+        self.assertEqual(item.kind, CapsuleItem.Kind.VIDEO)
+        self.assertEqual(item.size_in_bytes, 11)
+        self.assertEqual(item.mime_type, "video/mp4")
+        with default_storage.open(item.file.name) as f:
+            self.assertEqual(f.read(), b"hello world")
+
+        session = UploadSession.objects.get(pk=session_id)
+        self.assertEqual(session.status, UploadSession.Status.COMPLETE)
+        self.assertEqual(session.item, item)
+
+    def test_complete_requires_every_chunk(self):
+        session_id = self.start_upload().data["id"]
+        self.put_chunk(session_id, 2, b"world")
+
+        response = self.client.post(
+            reverse("capsule_api:complete_upload_session", args=[self.capsule.pk, session_id])
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CapsuleItem.objects.exists())
+
+    def test_delete_aborts_the_upload(self):
+        session_id = self.start_upload().data["id"]
+        self.put_chunk(session_id, 1, b"hello")
+        url = reverse("capsule_api:upload_session", args=[self.capsule.pk, session_id])
+
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        session = UploadSession.objects.get(pk=session_id)
+        self.assertEqual(session.status, UploadSession.Status.ABORTED)
+        self.assertFalse(default_storage.exists(f"uploads/{session_id}/1.part"))
+
+        self.assertEqual(self.client.delete(url).status_code, 400)
+        self.assertEqual(self.put_chunk(session_id, 2, b"world").status_code, 404)
+
+    def test_rejects_a_mime_type_that_does_not_match_the_kind(self):
+        response = self.start_upload(mime_type="application/pdf")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_missing_mime_type_is_guessed_from_the_filename(self):
+        session_id = self.start_upload(mime_type="").data["id"]
+        self.put_chunk(session_id, 1, b"hello")
+
+        self.client.post(reverse("capsule_api:complete_upload_session", args=[self.capsule.pk, session_id]))
+
+        self.assertEqual(CapsuleItem.objects.get(capsule=self.capsule).mime_type, "video/mp4")
+
+    def test_upload_of_unknown_type_is_rejected_on_completion(self):
+        session_id = self.start_upload(filename="clip", mime_type="").data["id"]
+        self.put_chunk(session_id, 1, b"hello")
+
+        response = self.client.post(
+            reverse("capsule_api:complete_upload_session", args=[self.capsule.pk, session_id])
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CapsuleItem.objects.exists())
+        self.assertFalse(default_storage.exists(UploadSession.objects.get(pk=session_id).file_name))
+
+    @override_settings(CAPSULE_UPLOAD_MAX_CHUNK_BYTES=4)
+    def test_rejects_oversized_chunks_and_text_kinds(self):
+        session_id = self.start_upload().data["id"]
+        self.assertEqual(self.put_chunk(session_id, 1, b"too big").status_code, 400)
+
+        self.assertEqual(self.start_upload(kind="text").status_code, 400)
+
+
+@override_settings(CAPSULE_UPLOAD_BACKEND="capsule.uploads.LocalUploadBackend")
+class DirectUploadViewsTest(TemporaryMediaRootMixin, AuthenticatedAPITestCase):
+    def presign(self, **data):
+        url = reverse("capsule_api:presign_capsule_item_upload", args=[self.capsule.pk])
+        return self.client.post(
+            url, {"kind": "image", "filename": "photo.png", "mime_type": "image/png", "size": 4, **data}
+        )
+
+    def confirm(self, token):
+        url = reverse("capsule_api:confirm_capsule_item_upload", args=[self.capsule.pk])
+        return self.client.post(url, {"upload_token": token})
+
+    def test_presigned_upload_is_confirmed_as_item(self):
+        response = self.presign()
+        self.assertEqual(response.status_code, 200)
+        upload = response.data["upload"]
+        token = response.data["upload_token"]
+        self.assertEqual(upload["method"], "PUT")
+
+        # the upload itself needs no api token, only the signed url
+        self.client.credentials()
+        response = self.client.put(upload["url"], b"\x89PNG", content_type="image/png")
+        self.assertEqual(response.status_code, 204)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+        response = self.confirm(token)
+        self.assertEqual(response.status_code, 201)
+
+        item = CapsuleItem.objects.get(capsule=self.capsule)
+        self.assertEqual(item.kind, CapsuleItem.Kind.IMAGE)
+        self.assertEqual(item.size_in_bytes, 4)
+        self.assertRegex(item.file.name, rf"^capsules/{self.capsule.pk}/[0-9a-f]{{32}}/photo")
+
+        # a token registers one item only
+        self.assertEqual(self.confirm(token).status_code, 400)
+
+    def test_local_upload_endpoint_is_not_served_with_s3(self):
+        upload = self.presign().data["upload"]
+
+        with override_settings(CAPSULE_UPLOAD_BACKEND="capsule.uploads.S3UploadBackend"):
+            response = self.client.put(upload["url"], b"\x89PNG", content_type="image/png")
+        self.assertEqual(response.status_code, 404)
+
+    def test_concurrent_uploads_of_one_filename_are_kept_apart(self):
+        first, second = self.presign().data, self.presign().data
+        for presigned in (first, second):
+            response = self.client.put(presigned["upload"]["url"], b"\x89PNG", content_type="image/png")
+            self.assertEqual(response.status_code, 204)
+        for presigned in (first, second):
+            self.assertEqual(self.confirm(presigned["upload_token"]).status_code, 201)
+
+        names = set(CapsuleItem.objects.filter(capsule=self.capsule).values_list("file", flat=True))
+        self.assertEqual(len(names), 2)
+
+    def test_confirm_checks_the_stored_size(self):
+        response = self.presign(size=10)
+        upload, token = response.data["upload"], response.data["upload_token"]
+        self.client.put(upload["url"], b"\x89PNG", content_type="image/png")
+
+        self.assertEqual(self.confirm(token).status_code, 400)
+        self.assertFalse(CapsuleItem.objects.exists())
+
+    def test_presign_rejects_mismatched_types(self):
+        self.assertEqual(self.presign(mime_type="video/mp4").status_code, 400)
+        self.assertEqual(self.presign(kind="text").status_code, 400)
+
+
+class BulkCreateCapsuleItemsViewTest(TemporaryMediaRootMixin, AuthenticatedAPITestCase):
+    def post_items(self, data):
+        url = reverse("capsule_api:bulk_create_capsule_items", args=[self.capsule.pk])
+        return self.client.post(url, data, format="multipart")
+
+    def test_creates_all_items_with_contiguous_positions(self):
+        response = self.post_items({
+            "items[0][kind]": "image",
+            "items[0][file]": SimpleUploadedFile("a.png", b"1234", content_type="image/png"),
+            "items[1][kind]": "text",
+            "items[1][text]": "a note",
+            "items[2][kind]": "music_link",
+            "items[2][url]": "https://open.spotify.com/track/sample",
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([item["position"] for item in response.data], [0, 1, 2])
+
+        items = CapsuleItem.objects.filter(capsule=self.capsule).order_by("position")
+        self.assertEqual(
+            [item.kind for item in items],
+            [CapsuleItem.Kind.IMAGE, CapsuleItem.Kind.TEXT, CapsuleItem.Kind.MUSIC_LINK],
+        )
+        self.assertEqual(items[0].size_in_bytes, 4)
+
+    def test_reports_errors_per_item_and_creates_nothing(self):
+        response = self.post_items({
+            "items[0][kind]": "text",
+            "items[0][text]": "fine",
+            "items[1][kind]": "image",
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["items"][0], {})
+        self.assertIn("file", response.data["items"][1])
+        self.assertFalse(CapsuleItem.objects.exists())
+
+    def test_other_users_capsule_is_not_found(self):
+        other = User.objects.create(
+            username="Other", email="other@example.com", password="pass", timezone="UTC"
+        )
+        self.capsule.owner = other
+        self.capsule.save()
+
+        response = self.post_items({"items[0][kind]": "text", "items[0][text]": "x"})
+        self.assertEqual(response.status_code, 404)
+
+
+class ListCapsulesViewTest(AuthenticatedAPITestCase):
+    url = reverse("capsule_api:list_capsules")
+
+    def test_lists_slim_capsules_with_item_count_and_thumbnail(self):
+        CapsuleItem.objects.create(capsule=self.capsule, kind=CapsuleItem.Kind.TEXT, text="Hello")
+        CapsuleItem.objects.create(
+            capsule=self.capsule,
+            kind=CapsuleItem.Kind.VIDEO,
+            file="capsules/clip.mp4",
+            size_in_bytes=1024,
+            thumbnails={"320.webp": "capsules/thumbnails/clip_320.webp"},
+        )
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        capsule = response.data["results"][0]
+        self.assertEqual(capsule["item_count"], 2)
+        self.assertTrue(capsule["thumbnail"].endswith("capsules/thumbnails/clip_320.webp"))
+        self.assertNotIn("capsule_items", capsule)
+
+    def test_pages_with_a_cursor(self):
+        for day in range(2, 5):
+            Capsule.objects.create(
+                owner=self.user, title=f"Capsule {day}", deliver_on=timezone.now() + timedelta(days=day)
+            )
+
+        first = self.client.get(self.url, {"page_size": 2})
+        second = self.client.get(first.data["next"])
+
+        titles = [c["title"] for c in first.data["results"] + second.data["results"]]
+        self.assertEqual(titles, ["First Capsule", "Capsule 2", "Capsule 3", "Capsule 4"])
+        self.assertIsNone(second.data["next"])
+
+
+# Query budgets of the read and create endpoints, checked against a user
+# with many capsules and items so that per-object queries exceed them
+class EndpointQueryBudgetTest(QueryBudgetMixin, AuthenticatedAPITestCase):
+    def setUp(self):
+        super().setUp()
+        for day in range(2, 12):
+            capsule = Capsule.objects.create(
+                owner=self.user, title=f"Capsule {day}", deliver_on=timezone.now() + timedelta(days=day)
+            )
+            for _ in range(3):
+                CapsuleItem.objects.create(capsule=capsule, kind=CapsuleItem.Kind.TEXT, text="Hi")
+
+    def test_list_capsules(self):
+        # token, capsule page, cover items
+        with self.assertMaxQueries(3):
+            response = self.client.get(reverse("capsule_api:list_capsules"))
+        self.assertEqual(len(response.data["results"]), 11)
+
+    def test_list_capsule_items(self):
+        capsule = Capsule.objects.filter(owner=self.user).last()
+        # token, capsule, items
+        with self.assertMaxQueries(3):
+            response = self.client.get(reverse("capsule_api:list_capsule_items", args=[capsule.pk]))
+        self.assertEqual(len(response.data), 3)
+
+    def test_create_capsule(self):
+        data = {"title": "New", "deliver_on": (timezone.now() + timedelta(days=3)).isoformat()}
+        # token, insert (in a savepoint), items of the new capsule
+        with self.assertMaxQueries(5):
+            response = self.client.post(reverse("capsule_api:create_capsule"), data)
+        self.assertEqual(response.status_code, 201)
+
+
+class ConditionalListViewsTest(AuthenticatedAPITestCase):
+    def test_unchanged_capsule_list_is_not_modified(self):
+        url = reverse("capsule_api:list_capsules")
+        etag = self.client.get(url)["ETag"]
+
+        # the token was resolved by the first request
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_new_item_changes_the_etag(self):
+        url = reverse("capsule_api:list_capsule_items", args=[self.capsule.pk])
+        etag = self.client.get(url)["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CapsuleItem.objects.create(capsule=self.capsule, kind=CapsuleItem.Kind.TEXT, text="Hi")
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(len(response.data), 1)
+
+    def test_missing_or_foreign_capsule_is_not_found_before_the_etag_check(self):
+        other = User.objects.create(username="Other", email="other@example.com", password="pass", timezone="UTC")
+        foreign = Capsule.objects.create(
+            owner=other, title="Foreign", deliver_on=timezone.now() + timedelta(days=3)
+        )
+        for capsule_pk in (foreign.pk, foreign.pk + 1000):
+            url = reverse("capsule_api:list_capsule_items", args=[capsule_pk])
+            with self.subTest(capsule_pk=capsule_pk):
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH="*").status_code, 404)
+
+        url = reverse("capsule_api:list_capsule_items", args=[self.capsule.pk])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH="*").status_code, 304)
+
+    def test_etag_depends_on_the_page(self):
+        url = reverse("capsule_api:list_capsules")
+        self.assertNotEqual(
+            self.client.get(url)["ETag"], self.client.get(url, {"page_size": 1})["ETag"]
+        )
+
+
+class CachedListViewsTest(AuthenticatedAPITestCase):
+    url = reverse("capsule_api:list_capsules")
+
+    def test_second_read_comes_from_the_cache(self):
+        first = self.client.get(self.url)
+
+        # the token was resolved by the first request
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+
+        self.assertEqual(second.data, first.data)
+        stats = ListResponseCache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_delivery_log_invalidates_the_cached_list(self):
+        self.client.get(self.url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Capsule.objects.filter(pk=self.capsule.pk).update(status=Capsule.Status.SENT)
+            DeliveryLog.objects.create(capsule=self.capsule, result=DeliveryLog.ResultStatus.SENT)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.data["results"][0]["status"], Capsule.Status.SENT)
+
+    @override_settings(CAPSULE_LIST_CACHE_WAIT_SECONDS=1)
+    def test_concurrent_misses_wait_for_a_single_render(self):
+        key = ListResponseCache.key(self.user.pk, "/capsules/")
+        cache.add(f"{key}:lock", 1)
+        renders = []
+
+        def render():
+            renders.append(1)
+            return ["fresh"]
+
+        # the lock holder stores its result while this request waits
+        with patch("capsule.list_cache.time.sleep", lambda seconds: cache.set(key, ["cached"])):
+            data = ListResponseCache.get_or_render(self.user.pk, "/capsules/", render)
+
+        self.assertEqual(data, ["cached"])
+        self.assertEqual(renders, [])
+        self.assertEqual(ListResponseCache.stats()["coalesced"], 1)
+
+
+class CachedTokenAuthenticationTest(AuthenticatedAPITestCase):
+    url = reverse("capsule_api:list_capsules")
+
+    def test_token_is_resolved_once(self):
+        self.client.get(self.url)
+
+        # a fresh process still finds the token in the shared cache
+        clear_local_tokens()
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get(self.url)
+        self.token.delete()
+
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+    def test_cache_holds_no_password_hash(self):
+        self.client.get(self.url)
+
+        snapshot = cache.get(_cache_key(self.token.key))
+        self.assertEqual(snapshot["id"], self.user.pk)
+        self.assertNotIn("password", snapshot)
+
+    def test_lookup_racing_a_deletion_does_not_cache_the_token(self):
+        key = self.token.key
+        lookup = CachedTokenAuthentication()
+        resolve = super(CachedTokenAuthentication, lookup).authenticate_credentials
+        stale = resolve(key)
+
+        # the token goes away while the lookup above is still in flight
+        def deleted_meanwhile(authentication, key):
+            self.token.delete()
+            return stale
+
+        with patch("rest_framework.authentication.TokenAuthentication.authenticate_credentials", deleted_meanwhile):
+            lookup.authenticate_credentials(key)
+
+        clear_local_tokens()
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+    def test_each_request_gets_its_own_user(self):
+        lookup = CachedTokenAuthentication()
+        first, _ = lookup.authenticate_credentials(self.token.key)
+        second, token = lookup.authenticate_credentials(self.token.key)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(token.user_id, self.user.pk)
+        # fields outside the snapshot are loaded on demand
+        self.assertEqual(second.timezone, self.user.timezone)
+
+
+class LoginViewTest(APITestCase):
+    url = reverse("capsule_api:login")
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(
+            username="TestUser",
+            email="login@example.com",
+            password=make_password("correct horse", hasher="pbkdf2_sha256"),
+            timezone="UTC",
+        )
+
+    def test_login_upgrades_the_password_hash(self):
+        response = self.client.post(self.url, {"email": "login@example.com", "password": "correct horse"})
+
+        self.assertEqual(response.status_code, 202)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("scrypt$"))
+
+    def test_attempts_per_email_are_limited(self):
+        with patch.object(LoginEmailThrottle, "THROTTLE_RATES", {"login_email": "2/min"}):
+            statuses = [
+                self.client.post(self.url, {"email": "LOGIN@example.com", "password": "wrong"}).status_code
+                for _ in range(3)
+            ]
+        self.assertEqual(statuses, [400, 400, 429])
+
+    def test_attempts_per_email_are_limited_across_addresses(self):
+        with patch.object(LoginEmailThrottle, "THROTTLE_RATES", {"login_email": "1/min"}):
+            statuses = [
+                self.client.post(
+                    self.url, {"email": "login@example.com", "password": "wrong"}, REMOTE_ADDR=address
+                ).status_code
+                for address in ("10.0.0.1", "10.0.0.2")
+            ]
+        self.assertEqual(statuses, [400, 429])
+
+    def test_email_must_be_a_string(self):
+        response = self.client.post(
+            self.url, {"email": ["login@example.com"], "password": "correct horse"}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CAPSULE_LOGIN_HASH_WAIT_SECONDS=0)
+    def test_busy_password_hashing_is_throttled(self):
+        _password_checks.acquire()
+        try:
+            response = self.client.post(self.url, {"email": "login@example.com", "password": "correct horse"})
+        finally:
+            _password_checks.release()
+
+        self.assertEqual(response.status_code, 429)
+
+
+class DatabasePoolStatsViewTest(AuthenticatedAPITestCase):
+    url = reverse("capsule_api:db_pool_stats")
+
+    def test_requires_staff(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_reports_the_pool_of_this_process(self):
+        self.user.is_staff = True
+        self.user.save()
+
+        # the test database is not pooled
+        response = self.client.get(self.url)
+        self.assertEqual(response.data, {"pooled": False, "stats": None})
+
+        pool = Mock()
+        pool.get_stats.return_value = {"pool_size": 2, "pool_available": 1, "requests_waiting": 0}
+        with patch("capsule.db_pool.connections") as connections:
+            connections.__getitem__.return_value.pool = pool
+            response = self.client.get(self.url)
+
+        self.assertEqual(
+            response.data["stats"],
+            {"role": "web", "pool_size": 2, "pool_available": 1, "requests_waiting": 0},
+        )
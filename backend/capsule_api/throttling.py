@@ -0,0 +1,49 @@
+import hashlib
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import SimpleRateThrottle
+
+
+# Login attempts per client address
+class LoginIPThrottle(SimpleRateThrottle):
+    scope = "login_ip"
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {"scope": self.scope, "ident": self.get_ident(request)}
+
+
+# Login attempts per account, wherever they come from
+class LoginEmailThrottle(SimpleRateThrottle):
+    scope = "login_email"
+
+    def get_cache_key(self, request, view):
+        email = request.data.get("email")
+        if not isinstance(email, str) or not email.strip():
+            # rejected by the view
+            return None
+        ident = hashlib.sha256(email.strip().lower().encode()).hexdigest()
+        return self.cache_format % {"scope": self.scope, "ident": ident}
+
+
+# Password hashing is deliberately slow, so only a few hashes run at once
+# in a process and the other threads stay free to serve the rest of the API
+_password_checks = threading.BoundedSemaphore(
+    getattr(settings, "CAPSULE_LOGIN_MAX_CONCURRENT_HASHES", 1)
+)
+
+
+@contextmanager
+def password_check_slot():
+    """
+    Waits briefly for a free password hashing slot and raises Throttled
+    (429) if the process is still busy hashing other logins.
+    """
+    wait = getattr(settings, "CAPSULE_LOGIN_HASH_WAIT_SECONDS", 2)
+    if not _password_checks.acquire(timeout=wait):
+        raise Throttled(wait=1, detail="Too many logins in progress, try again shortly.")
+    try:
+        yield
+    finally:
+        _password_checks.release()
@@ -7,6 +7,15 @@ from drf_spectacular.views import (
 
 from .views import (
     CreateCapsuleItem,
+    BulkCreateCapsuleItems,
+    CreateUploadSession,
+    RetrieveUploadSession,
+    UploadChunk,
+    CompleteUploadSession,
+    PresignCapsuleItemUpload,
+    ConfirmCapsuleItemUpload,
+    DirectUpload,
+    DatabasePoolStats,
     ListCapsuleItems,
     Register,
     Login,
@@ -32,6 +41,43 @@ urlpatterns = [
         CreateCapsuleItem.as_view(),
         name="create_capsule_item",
     ),
+    path(
+        "capsules/<int:capsule_pk>/items/bulk/",
+        BulkCreateCapsuleItems.as_view(),
+        name="bulk_create_capsule_items",
+    ),
+    path(
+        "capsules/<int:capsule_pk>/items/presign/",
+        PresignCapsuleItemUpload.as_view(),
+        name="presign_capsule_item_upload",
+    ),
+    path(
+        "capsules/<int:capsule_pk>/items/confirm/",
+        ConfirmCapsuleItemUpload.as_view(),
+        name="confirm_capsule_item_upload",
+    ),
+    path("uploads/direct/<str:token>/", DirectUpload.as_view(), name="direct_upload"),
+    path(
+        "capsules/<int:capsule_pk>/uploads/",
+        CreateUploadSession.as_view(),
+        name="create_upload_session",
+    ),
+    path(
+        "capsules/<int:capsule_pk>/uploads/<uuid:session_pk>/",
+        RetrieveUploadSession.as_view(),
+        name="upload_session",
+    ),
+    path(
+        "capsules/<int:capsule_pk>/uploads/<uuid:session_pk>/chunks/<int:number>/",
+        UploadChunk.as_view(),
+        name="upload_chunk",
+    ),
+    path(
+        "capsules/<int:capsule_pk>/uploads/<uuid:session_pk>/complete/",
+        CompleteUploadSession.as_view(),
+        name="complete_upload_session",
+    ),
+    path("health/db-pool/", DatabasePoolStats.as_view(), name="db_pool_stats"),
     path("schema/", SpectacularAPIView.as_view(), name="schema"),
     path(
         "schema/swagger-ui/",
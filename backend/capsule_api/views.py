@@ -1,16 +1,102 @@
+import hashlib
 from django.shortcuts import get_object_or_404
+from django.utils.cache import parse_etags, patch_cache_control, patch_vary_headers, quote_etag
 from rest_framework.views import APIView
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny, IsAuthenticated
-from rest_framework.authentication import TokenAuthentication
-from rest_framework import generics, mixins, parsers
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework import exceptions, generics, mixins, parsers
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from drf_spectacular.types import OpenApiTypes
-from capsule.models import Capsule, CapsuleItem
-from .serializers import CapsuleSerializer, CustomUserSerializer, CapsuleItemSerializer
+from capsule.models import Capsule, CapsuleItem, UploadSession
+from capsule.uploads import ChunkedUploads, DirectUploads, LocalUploadBackend, get_upload_backend_class
+from capsule.db_pool import pool_stats
+from capsule.list_cache import ListResponseCache
+from capsule.routers import replica_reads
+from capsule.versioning import list_version
+from .authentication import CachedTokenAuthentication
+from .parsers import ChunkParser, IndexedItemsMultiPartParser
+from .throttling import LoginEmailThrottle, LoginIPThrottle, password_check_slot
+from .pagination import CapsuleCursorPagination
+from .serializers import (
+    CapsuleListSerializer,
+    CapsuleSerializer,
+    CustomUserSerializer,
+    CapsuleItemSerializer,
+    DirectUploadConfirmSerializer,
+    DirectUploadRequestSerializer,
+    UploadSessionSerializer,
+)
 from rest_framework import status
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+
+CAPSULE_PK_PARAMETER = OpenApiParameter(
+    name="capsule_pk",
+    type=OpenApiTypes.INT,
+    location=OpenApiParameter.PATH,
+    description="The ID of the capsule this item belongs to",
+)
+
+
+# Applies the serializer's eager loading to the view's queryset, so the
+# relations it renders are fetched in a fixed number of queries
+class EagerLoadingViewMixin():
+    def eager_load(self, queryset):
+        setup = getattr(self.get_serializer_class(), "setup_eager_loading", None)  # pyright: ignore
+        return setup(queryset) if setup else queryset
+
+
+# Tags list responses with the user's list version, so a client polling
+# with If-None-Match gets a 304 before any serializer runs. Views listing
+# the children of one object check it in check_list_access first, so a 304
+# never stands in for a 404.
+class ConditionalListMixin():
+    def check_list_access(self):
+        pass
+
+    def list_etag(self, request):
+        version = list_version(request.user.pk)
+        accept = request.headers.get("Accept", "")
+        key = f"{version}:{request.get_full_path()}:{accept}"
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def list(self, request, *args, **kwargs):
+        self.check_list_access()
+        etag = self.list_etag(request)
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        if etag in if_none_match or "*" in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super().list(request, *args, **kwargs)  # pyright: ignore
+
+        response["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ["Authorization"])
+        return response
+
+
+# Lists are read from the replica, unless the user just changed something
+class ReplicaReadsMixin():
+    def list(self, request, *args, **kwargs):
+        with replica_reads(request.user.pk):
+            return super().list(request, *args, **kwargs)  # pyright: ignore
+
+
+# Serves the serialized list from the user's list cache, rendering it only
+# when the user's capsules or items changed since it was cached
+class CachedListMixin():
+    def list(self, request, *args, **kwargs):
+        data = ListResponseCache.get_or_render(
+            request.user.pk,
+            request.get_full_path(),
+            lambda: super(CachedListMixin, self).list(request, *args, **kwargs).data,  # pyright: ignore
+        )
+        return Response(data)
 
 
 # Create your views here.
@@ -33,9 +119,12 @@ class Register(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-# Uses email and password to authenticate user
+# Uses email and password to authenticate user.
+# Attempts are rate limited per address and per email, and the password
+# check waits for one of the process's few hashing slots.
 class Login(APIView):
     permission_classes = [AllowAny]
+    throttle_classes = [LoginIPThrottle, LoginEmailThrottle]
 
     @extend_schema(
         summary="Authenticate User",
@@ -52,19 +141,21 @@ class Login(APIView):
         responses={
             202: CustomUserSerializer,
             400: OpenApiTypes.OBJECT,
+            429: OpenApiTypes.OBJECT,
         },
     )
     def post(self, request):
         email = request.data.get("email")
         password = request.data.get("password")
 
-        if not email or not password:
+        if not isinstance(email, str) or not isinstance(password, str) or not email or not password:
             return Response(
                 {"detail": "Email and passord is required"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        user = authenticate(request=request, email=email, password=password)
+        with password_check_slot():
+            user = authenticate(request=request, email=email, password=password)
 
         if not user or not user.is_active:
             return Response(
@@ -84,7 +175,7 @@ class Login(APIView):
 # Creates a capsule and sets the owner to the current
 # authenticated user.
 class CreateCapsule(generics.CreateAPIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = CapsuleSerializer
 
@@ -103,7 +194,7 @@ class CreateCapsule(generics.CreateAPIView):
 
 # Creates a capsule item and attatches it to a capsule
 class CreateCapsuleItem(generics.CreateAPIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = CapsuleItemSerializer
     parser_classes = [parsers.MultiPartParser, parsers.FormParser]
@@ -131,24 +222,263 @@ class CreateCapsuleItem(generics.CreateAPIView):
         serializer.save(capsule=capsule)
 
 
+# Creates many items of a capsule in one request and one transaction.
+# Nothing is created unless every item is valid.
+class BulkCreateCapsuleItems(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    parser_classes = [IndexedItemsMultiPartParser]
+
+    @extend_schema(
+        summary="Create many items within a capsule",
+        description="Accepts a multipart payload with fields named items[<index>][<field>], e.g. items[0][kind] and items[0][file]. Errors are reported per item, in the same order.",
+        parameters=[CAPSULE_PK_PARAMETER],
+        responses={201: CapsuleItemSerializer(many=True), 400: OpenApiTypes.OBJECT},
+    )
+    def post(self, request, capsule_pk):
+        capsule = get_object_or_404(Capsule, pk=capsule_pk, owner=request.user)
+
+        items = request.data["items"]
+        max_items = getattr(settings, "CAPSULE_BULK_ITEMS_MAX", 50)
+        if not 0 < len(items) <= max_items:
+            return Response(
+                {"detail": "Send between 1 and {} items".format(max_items)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = CapsuleItemSerializer(data=items, many=True)
+        if not serializer.is_valid():
+            return Response({"items": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer.save(capsule=capsule)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
 # Lists Capsules that have already been delivered.
 # (capsules that have not yet been delivered are still buried and inaccessible)
-class ListCapsules(generics.ListAPIView):
-    authentication_classes = [TokenAuthentication]
+class ListCapsules(
+    ConditionalListMixin, CachedListMixin, ReplicaReadsMixin, EagerLoadingViewMixin, generics.ListAPIView
+):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
-    serializer_class = CapsuleSerializer
+    serializer_class = CapsuleListSerializer
+    pagination_class = CapsuleCursorPagination
 
     def get_queryset(self):  # pyright: ignore
-        return Capsule.objects.filter(owner=self.request.user)
+        return self.eager_load(Capsule.objects.filter(owner=self.request.user))
 
 
-class ListCapsuleItems(generics.ListAPIView):
-    authentication_classes = [TokenAuthentication]
+class ListCapsuleItems(ConditionalListMixin, CachedListMixin, ReplicaReadsMixin, generics.ListAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = CapsuleItemSerializer
 
+    def get_capsule(self):
+        if not hasattr(self, "capsule"):
+            self.capsule = get_object_or_404(
+                Capsule, pk=self.kwargs["capsule_pk"], owner=self.request.user
+            )
+        return self.capsule
+
+    def check_list_access(self):
+        self.get_capsule()
+
     def get_queryset(self):  # pyright: ignore
+        return CapsuleItem.objects.filter(capsule=self.get_capsule())
+
+
+# Looks up one of the current user's upload sessions
+def get_upload_session(request, capsule_pk, session_pk, **filters):
+    return get_object_or_404(
+        UploadSession,
+        pk=session_pk,
+        capsule_id=capsule_pk,
+        capsule__owner=request.user,
+        **filters,
+    )
+
+
+# Starts a resumable, chunked upload of a large capsule item file
+class CreateUploadSession(generics.CreateAPIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+
+    @extend_schema(
+        summary="Start a chunked upload",
+        description="Starts a resumable upload for a media item. Send the file in numbered chunks, then complete the upload to create the item.",
+        parameters=[CAPSULE_PK_PARAMETER],
+        responses={201: UploadSessionSerializer},
+    )
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
         capsule = get_object_or_404(
             Capsule, pk=self.kwargs["capsule_pk"], owner=self.request.user
         )
-        return CapsuleItem.objects.filter(capsule=capsule)
+        try:
+            serializer.instance = ChunkedUploads.start(capsule, **serializer.validated_data)
+        except ValidationError as e:
+            raise exceptions.ValidationError(e.messages)
+
+
+# Shows the chunks received so far, so an interrupted upload can resume.
+# Deleting the session aborts the upload and discards its chunks.
+class RetrieveUploadSession(generics.RetrieveDestroyAPIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+
+    def get_object(self):  # pyright: ignore
+        return get_upload_session(
+            self.request, self.kwargs["capsule_pk"], self.kwargs["session_pk"]
+        )
+
+    @extend_schema(
+        summary="Abort a chunked upload",
+        parameters=[CAPSULE_PK_PARAMETER],
+        responses={204: None},
+    )
+    def delete(self, request, *args, **kwargs):
+        return super().delete(request, *args, **kwargs)
+
+    def perform_destroy(self, instance):
+        try:
+            ChunkedUploads.abort(instance)
+        except ValidationError as e:
+            raise exceptions.ValidationError(e.messages)
+
+
+# Receives one numbered chunk as the raw request body.
+# Resending a chunk number replaces the earlier chunk.
+class UploadChunk(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    parser_classes = [ChunkParser]
+
+    @extend_schema(
+        summary="Upload a chunk",
+        request={"application/octet-stream": OpenApiTypes.BINARY},
+        parameters=[CAPSULE_PK_PARAMETER],
+        responses={200: UploadSessionSerializer},
+    )
+    def put(self, request, capsule_pk, session_pk, number):
+        session = get_upload_session(
+            request, capsule_pk, session_pk, status=UploadSession.Status.OPEN
+        )
+        try:
+            session = ChunkedUploads.upload_chunk(session, number, request.data)
+        except ValidationError as e:
+            raise exceptions.ValidationError(e.messages)
+        return Response(UploadSessionSerializer(session).data)
+
+
+# Assembles the uploaded chunks and creates the capsule item
+class CompleteUploadSession(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        summary="Complete a chunked upload",
+        request=None,
+        parameters=[CAPSULE_PK_PARAMETER],
+        responses={201: CapsuleItemSerializer},
+    )
+    def post(self, request, capsule_pk, session_pk):
+        session = get_upload_session(
+            request, capsule_pk, session_pk, status=UploadSession.Status.OPEN
+        )
+        try:
+            item = ChunkedUploads.complete(session)
+        except ValidationError as e:
+            raise exceptions.ValidationError(e.messages)
+        return Response(CapsuleItemSerializer(item).data, status=status.HTTP_201_CREATED)
+
+
+# Hands out a presigned url to upload a file straight to storage
+class PresignCapsuleItemUpload(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        summary="Presign a direct upload",
+        description="Returns a presigned upload for a file of the capsule and an upload token to confirm it with once the upload finished.",
+        request=DirectUploadRequestSerializer,
+        parameters=[CAPSULE_PK_PARAMETER],
+        responses={200: OpenApiTypes.OBJECT},
+    )
+    def post(self, request, capsule_pk):
+        capsule = get_object_or_404(Capsule, pk=capsule_pk, owner=request.user)
+        serializer = DirectUploadRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            presigned = DirectUploads.presign(capsule, **serializer.validated_data)
+        except ValidationError as e:
+            raise exceptions.ValidationError(e.messages)
+        presigned["upload"]["url"] = request.build_absolute_uri(presigned["upload"]["url"])
+        return Response(presigned)
+
+
+# Registers a directly uploaded file as a capsule item once storage has it
+class ConfirmCapsuleItemUpload(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        summary="Confirm a direct upload",
+        request=DirectUploadConfirmSerializer,
+        parameters=[CAPSULE_PK_PARAMETER],
+        responses={201: CapsuleItemSerializer},
+    )
+    def post(self, request, capsule_pk):
+        capsule = get_object_or_404(Capsule, pk=capsule_pk, owner=request.user)
+        serializer = DirectUploadConfirmSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            item = DirectUploads.confirm(capsule, serializer.validated_data["upload_token"])
+        except ValidationError as e:
+            raise exceptions.ValidationError(e.messages)
+        return Response(CapsuleItemSerializer(item).data, status=status.HTTP_201_CREATED)
+
+
+# Local stand-in for the storage endpoint of a presigned upload.
+# The signed token in the url authorizes the upload, as it would on S3.
+# Only served with the local upload backend; with S3 the file bodies must
+# never pass through the web workers.
+class DirectUpload(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    parser_classes = []
+
+    @extend_schema(exclude=True)
+    def put(self, request, token):
+        if not issubclass(get_upload_backend_class(), LocalUploadBackend):
+            raise exceptions.NotFound()
+        try:
+            upload = DirectUploads.load_token(token)
+        except ValidationError as e:
+            raise exceptions.PermissionDenied(e.messages[0])
+
+        if request.content_type != upload["mime_type"]:
+            raise exceptions.ValidationError("Content-Type must be {}".format(upload["mime_type"]))
+        if not 0 < int(request.META.get("CONTENT_LENGTH") or 0) <= upload["size"]:
+            raise exceptions.ValidationError("Upload must be between 1 and {} bytes".format(upload["size"]))
+        if default_storage.exists(upload["name"]):
+            return Response(status=status.HTTP_409_CONFLICT)
+
+        default_storage.save(upload["name"], File(request.stream))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+# Connection pool usage of the web process that answers the request
+class DatabasePoolStats(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(summary="Database connection pool statistics", responses={200: OpenApiTypes.OBJECT})
+    def get(self, request):
+        stats = pool_stats()
+        return Response({"pooled": stats is not None, "stats": stats})
@@ -70,7 +70,15 @@ INSTALLED_APPS = [
     "django_celery_beat",
 ]
 
-REST_FRAMEWORK = {"DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema"}
+REST_FRAMEWORK = {
+    "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
+    # nginx appends the client address to X-Forwarded-For
+    "NUM_PROXIES": env.int("NUM_PROXIES", default=1),
+    "DEFAULT_THROTTLE_RATES": {
+        "login_ip": env("LOGIN_IP_RATE", default="20/min"),
+        "login_email": env("LOGIN_EMAIL_RATE", default="5/min"),
+    },
+}
 SPECTACULAR_SETTINGS = {
     "TITLE": "E-commerce",
     "DESCRIPTION": "API for an e-commerce backend",
@@ -114,9 +122,48 @@ WSGI_APPLICATION = "mymemorabelia.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Every process keeps its own pool of Postgres connections, sized by what
+# the process does: (min, max) connections. With the docker-compose setup
+# (1 gunicorn worker, 4 celery worker processes, beat and the delivery
+# scheduler) that is at most 4 + 4 * 2 + 1 + 1 = 14 of Postgres' 20 connections.
+DB_POOL_ROLE = env("DB_POOL_ROLE", default="web")
+DB_POOL_SIZES = {
+    "web": (2, env.int("DB_POOL_WEB_MAX_SIZE", default=4)),
+    "worker": (1, env.int("DB_POOL_WORKER_MAX_SIZE", default=2)),
+    "beat": (1, 1),
+}
+
 # Use Postgres in prod and use sqlite in local dev
 if ENV == "dev":
     DATABASES = {"default": env.db("DATABASE_URL")}
+    # Connections are checked before they are handed out, so one dropped
+    # by Postgres or a proxy is replaced instead of failing the request
+    DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+    if env.bool("DB_PGBOUNCER", default=False):
+        # pgbouncer in transaction mode does the pooling; it cannot keep
+        # server-side cursors open across transactions
+        DATABASES["default"]["DISABLE_SERVER_SIDE_CURSORS"] = True
+    else:
+        DATABASES["default"].setdefault("OPTIONS", {})["pool"] = {
+            "name": DB_POOL_ROLE,
+            "min_size": DB_POOL_SIZES[DB_POOL_ROLE][0],
+            "max_size": DB_POOL_SIZES[DB_POOL_ROLE][1],
+            # seconds a request waits for a free connection before failing
+            "timeout": env.int("DB_POOL_TIMEOUT", default=10),
+            "max_idle": 300,
+        }
+
+    # Optional streaming replica, configured like the primary
+    if env("REPLICA_DATABASE_URL", default=""):
+        DATABASES["replica"] = env.db("REPLICA_DATABASE_URL")
+        for key in ("CONN_HEALTH_CHECKS", "DISABLE_SERVER_SIDE_CURSORS"):
+            if key in DATABASES["default"]:
+                DATABASES["replica"][key] = DATABASES["default"][key]
+        if "pool" in DATABASES["default"].get("OPTIONS", {}):
+            DATABASES["replica"].setdefault("OPTIONS", {})["pool"] = {
+                **DATABASES["default"]["OPTIONS"]["pool"],
+                "name": f"{DB_POOL_ROLE}-replica",
+            }
 else:
     DATABASES = {
         "default": {
@@ -124,6 +171,65 @@ else:
             "NAME": BASE_DIR / "db.sqlite3",
         }
     }
+    if ENV == "test":
+        # stands in for a replica in the router tests; nothing replicates
+        # to it, so it shows what a lagging replica would
+        DATABASES["replica"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "replica.sqlite3",
+        }
+
+# List views and the due-capsule check read from this database when it is
+# set. Writes, claims and deliveries always use the primary, and a user's
+# reads go to the primary for a few seconds after they change anything.
+CAPSULE_READ_REPLICA = "replica" if "replica" in DATABASES and ENV != "test" else None
+CAPSULE_REPLICA_PIN_SECONDS = env.int("CAPSULE_REPLICA_PIN_SECONDS", default=5)
+DATABASE_ROUTERS = ["capsule.routers.PrimaryReplicaRouter"]
+
+# Cache
+# Shared by the web and celery processes, which both change what the
+# per-user list versions describe
+if ENV == "test":
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": env("CACHE_URL", default="redis://redis:6379/1"),
+        }
+    }
+
+# Serialized capsule and item lists are cached per user. Only one request
+# renders a missing list; others wait up to CAPSULE_LIST_CACHE_WAIT_SECONDS.
+CAPSULE_LIST_CACHE_SECONDS = env.int("CAPSULE_LIST_CACHE_SECONDS", default=300)
+CAPSULE_LIST_CACHE_LOCK_SECONDS = 10
+CAPSULE_LIST_CACHE_WAIT_SECONDS = 2
+
+# Resolved API tokens are kept in the shared cache and, briefly, in each
+# process. A deleted token can be used for up to the in-process time.
+CAPSULE_AUTH_TOKEN_CACHE_SECONDS = env.int("CAPSULE_AUTH_TOKEN_CACHE_SECONDS", default=60)
+CAPSULE_AUTH_TOKEN_LOCAL_SECONDS = env.int("CAPSULE_AUTH_TOKEN_LOCAL_SECONDS", default=5)
+# How long a forgotten token stays marked in the shared cache. Must outlast
+# the slowest token lookup, which could otherwise cache it again.
+CAPSULE_AUTH_TOKEN_TOMBSTONE_SECONDS = env.int("CAPSULE_AUTH_TOKEN_TOMBSTONE_SECONDS", default=10)
+
+
+# Password hashing
+# https://docs.djangoproject.com/en/5.2/topics/auth/passwords/
+# New passwords use memory-hard scrypt; older PBKDF2 hashes keep working and
+# are rehashed with scrypt on the user's next successful login.
+PASSWORD_HASHERS = [
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+]
+
+# Password checks that may run at once in a web process, and how long a
+# login waits for a free slot before it is answered with a 429
+CAPSULE_LOGIN_MAX_CONCURRENT_HASHES = env.int("CAPSULE_LOGIN_MAX_CONCURRENT_HASHES", default=1)
+CAPSULE_LOGIN_HASH_WAIT_SECONDS = 2
 
 
 # Password validation
@@ -204,6 +310,24 @@ else:
     STATICFILES_DIRS = [BASE_DIR / "static"]
     MEDIA_ROOT = BASE_DIR / "files"
 
+# Chunked uploads of capsule item files: S3 multipart uploads in production,
+# part files on the local filesystem otherwise
+if ENV == "prod":
+    CAPSULE_UPLOAD_BACKEND = "capsule.uploads.S3UploadBackend"
+else:
+    CAPSULE_UPLOAD_BACKEND = "capsule.uploads.LocalUploadBackend"
+CAPSULE_UPLOAD_MAX_CHUNK_BYTES = env.int("CAPSULE_UPLOAD_MAX_CHUNK_BYTES", default=8 * 1024 * 1024)
+# Chunked uploads left open this long are aborted by beat and their chunks
+# discarded
+CAPSULE_UPLOAD_SESSION_MAX_AGE_SECONDS = env.int(
+    "CAPSULE_UPLOAD_SESSION_MAX_AGE_SECONDS", default=24 * 60 * 60
+)
+# Most items accepted by one bulk item creation request
+CAPSULE_BULK_ITEMS_MAX = env.int("CAPSULE_BULK_ITEMS_MAX", default=50)
+# Presigned uploads straight to storage: largest file and url lifetime
+CAPSULE_DIRECT_UPLOAD_MAX_BYTES = env.int("CAPSULE_DIRECT_UPLOAD_MAX_BYTES", default=1024 * 1024 * 1024)
+CAPSULE_DIRECT_UPLOAD_EXPIRY_SECONDS = env.int("CAPSULE_DIRECT_UPLOAD_EXPIRY_SECONDS", default=60 * 60)
+
 # Recommended security settings from the documentation:
 if ENV == "prod":
     SECURE_SSL_REDIRECT = True
@@ -235,6 +359,49 @@ if ENV == "prod":
 else:
     EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 
+# Capsule delivery: number of long-lived mail connections shared by a batch
+# and how many messages each connection carries before it is recycled.
+CAPSULE_MAIL_POOL_SIZE = env.int("CAPSULE_MAIL_POOL_SIZE", default=2)
+CAPSULE_MAIL_MAX_MESSAGES_PER_CONNECTION = env.int(
+    "CAPSULE_MAIL_MAX_MESSAGES_PER_CONNECTION", default=100
+)
+
+# Outbound mail is rate limited per recipient domain with token buckets
+# shared through Redis (per process without it): messages per minute and
+# burst size, overridable per domain, e.g. {"gmail.com": (1200, 100)}.
+# Domains take turns sending up to CAPSULE_MAIL_DOMAIN_BATCH_SIZE messages
+# over one connection; capsules that would wait longer than
+# CAPSULE_MAIL_DOMAIN_MAX_WAIT_SECONDS are put back and retried later.
+# Rates must be over 0 and bursts at least 1. Turns are taken among the
+# next CAPSULE_MAIL_DOMAIN_WINDOW_SIZE capsules of a chunk.
+CAPSULE_MAIL_DOMAIN_LIMITS_REDIS_URL = None if ENV == "test" else env(
+    "CAPSULE_MAIL_DOMAIN_LIMITS_REDIS_URL", default="redis://redis:6379/2"
+)
+CAPSULE_MAIL_DOMAIN_RATE_PER_MINUTE = env.int("CAPSULE_MAIL_DOMAIN_RATE_PER_MINUTE", default=600)
+CAPSULE_MAIL_DOMAIN_BURST = env.int("CAPSULE_MAIL_DOMAIN_BURST", default=50)
+CAPSULE_MAIL_DOMAIN_RATES = {}
+CAPSULE_MAIL_DOMAIN_BATCH_SIZE = env.int("CAPSULE_MAIL_DOMAIN_BATCH_SIZE", default=10)
+CAPSULE_MAIL_DOMAIN_MAX_WAIT_SECONDS = env.int("CAPSULE_MAIL_DOMAIN_MAX_WAIT_SECONDS", default=60)
+CAPSULE_MAIL_DOMAIN_WINDOW_SIZE = env.int("CAPSULE_MAIL_DOMAIN_WINDOW_SIZE", default=200)
+
+# Image, GIF and audio items are embedded in the delivery email up to this
+# total size, counted after base64 encoding (a third more than the files);
+# larger items are sent as signed links that expire after a week.
+CAPSULE_MAIL_INLINE_BUDGET_BYTES = env.int(
+    "CAPSULE_MAIL_INLINE_BUDGET_BYTES", default=10 * 1024 * 1024
+)
+CAPSULE_MAIL_READ_CHUNK_BYTES = env.int("CAPSULE_MAIL_READ_CHUNK_BYTES", default=256 * 1024)
+CAPSULE_MAIL_LINK_EXPIRY_SECONDS = env.int(
+    "CAPSULE_MAIL_LINK_EXPIRY_SECONDS", default=7 * 24 * 60 * 60
+)
+
+# Widths of the thumbnails generated for video and GIF items, and the
+# variant inlined in the delivery email as a video's poster
+CAPSULE_THUMBNAIL_WIDTHS = (160, 320, 640)
+CAPSULE_MAIL_POSTER_VARIANT = "640.jpg"
+# Thumbnail variant shown for a capsule in capsule lists
+CAPSULE_LIST_THUMBNAIL_VARIANT = "320.webp"
+
 # Celery settings
 CELERY_BROKER_URL = env("CELERY_BROKER_URL", default="redis://redis:6379/0")
 CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND", default="redis://redis:6379/0")
@@ -244,12 +411,78 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
 
+# Number of due capsules handed to each delivery task by the dispatcher
+CAPSULE_DELIVERY_CHUNK_SIZE = env.int("CAPSULE_DELIVERY_CHUNK_SIZE", default=50)
+
+# Due capsules are claimed (moved to "sending") before they are delivered.
+# A claim expires after the lease so a crashed worker's capsules are retried
+# (counting as a failed attempt). The claim lease must cover the time the
+# last chunk of a dispatch waits in the queue, i.e. roughly
+# DISPATCH_LIMIT / CHUNK_SIZE / delivery workers * time per chunk; each
+# send then extends its capsule's lease by CAPSULE_DELIVERY_LEASE_SECONDS.
+CAPSULE_DELIVERY_CLAIM_BATCH_SIZE = env.int("CAPSULE_DELIVERY_CLAIM_BATCH_SIZE", default=100)
+CAPSULE_DELIVERY_DISPATCH_LIMIT = env.int("CAPSULE_DELIVERY_DISPATCH_LIMIT", default=5000)
+CAPSULE_DELIVERY_CLAIM_LEASE_SECONDS = env.int("CAPSULE_DELIVERY_CLAIM_LEASE_SECONDS", default=60 * 60)
+CAPSULE_DELIVERY_LEASE_SECONDS = env.int("CAPSULE_DELIVERY_LEASE_SECONDS", default=600)
+# A failed delivery is retried after CAPSULE_DELIVERY_RETRY_BASE_SECONDS,
+# doubling with each failure up to CAPSULE_DELIVERY_RETRY_MAX_SECONDS.
+# After CAPSULE_DELIVERY_MAX_ATTEMPTS failures the capsule is marked failed.
+CAPSULE_DELIVERY_MAX_ATTEMPTS = env.int("CAPSULE_DELIVERY_MAX_ATTEMPTS", default=8)
+CAPSULE_DELIVERY_RETRY_BASE_SECONDS = env.int("CAPSULE_DELIVERY_RETRY_BASE_SECONDS", default=60)
+CAPSULE_DELIVERY_RETRY_MAX_SECONDS = env.int("CAPSULE_DELIVERY_RETRY_MAX_SECONDS", default=6 * 60 * 60)
+# Capsules (and their items) are loaded from the database this many at a time
+CAPSULE_DELIVERY_PAGE_SIZE = env.int("CAPSULE_DELIVERY_PAGE_SIZE", default=50)
+
+# Class that sends claimed capsules. "capsule.services.MailDelivery" sends
+# them one at a time over the mail connection pool;
+# "capsule.async_delivery.AsyncMailDelivery" keeps up to
+# CAPSULE_ASYNC_DELIVERY_CONCURRENCY SMTP sessions in flight from one worker
+# (with aiosmtplib, or one thread per session for other EMAIL_BACKENDs), each
+# message getting CAPSULE_ASYNC_DELIVERY_TIMEOUT_SECONDS. A worker only has
+# CAPSULE_DELIVERY_CHUNK_SIZE capsules at a time, so raise it along with the
+# concurrency.
+CAPSULE_DELIVERY_ENGINE = env("CAPSULE_DELIVERY_ENGINE", default="capsule.services.MailDelivery")
+CAPSULE_ASYNC_DELIVERY_CONCURRENCY = env.int("CAPSULE_ASYNC_DELIVERY_CONCURRENCY", default=100)
+CAPSULE_ASYNC_DELIVERY_TIMEOUT_SECONDS = env.int("CAPSULE_ASYNC_DELIVERY_TIMEOUT_SECONDS", default=60)
+
+# Pending capsules are kept in a Redis sorted set by due time. The
+# run_delivery_scheduler process dispatches them the moment they are due,
+# and beat reconciles the set with the database every few minutes,
+# re-adding the timers of capsules due within the horizon.
+# Without a timer index, beat scans the database every minute instead.
+# Opt-in: only set CAPSULE_TIMERS_REDIS_URL (for every process) where the
+# run_delivery_scheduler service runs, as beat stops the every-minute scan.
+CAPSULE_TIMERS_REDIS_URL = None if ENV == "test" else env("CAPSULE_TIMERS_REDIS_URL", default=None)
+CAPSULE_TIMERS_RECONCILE_HORIZON_SECONDS = env.int(
+    "CAPSULE_TIMERS_RECONCILE_HORIZON_SECONDS", default=60 * 60
+)
+
+# Emails of capsules due within the staging window are built ahead of time
+# and stored, so that delivery only has to send them. The window must stay
+# shorter than CAPSULE_MAIL_LINK_EXPIRY_SECONDS, as staged emails contain
+# signed links.
+CAPSULE_STAGING_WINDOW_SECONDS = env.int("CAPSULE_STAGING_WINDOW_SECONDS", default=24 * 60 * 60)
+
 CELERY_BEAT_SCHEDULE = {
-    "send-capsules-every-minute": {
-        "task": "capsule.tasks.send_due_capsules_task",
-        "schedule": crontab(minute="*"),  # Runs every minute
+    "stage-upcoming-capsules": {
+        "task": "capsule.tasks.stage_upcoming_capsules_task",
+        "schedule": crontab(minute="*/15"),
+    },
+    "abort-stale-upload-sessions": {
+        "task": "capsule.tasks.abort_stale_upload_sessions_task",
+        "schedule": crontab(minute=0),
     },
 }
+if CAPSULE_TIMERS_REDIS_URL:
+    CELERY_BEAT_SCHEDULE["reconcile-delivery-timers"] = {
+        "task": "capsule.tasks.reconcile_delivery_timers_task",
+        "schedule": crontab(minute="*/10"),
+    }
+else:
+    CELERY_BEAT_SCHEDULE["send-capsules-every-minute"] = {
+        "task": "capsule.tasks.dispatch_due_capsules_task",
+        "schedule": crontab(minute="*"),  # Runs every minute
+    }
 
 if ENV == "dev":
     CORS_ALLOWED_ORIGINS = [
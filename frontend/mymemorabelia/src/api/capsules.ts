@@ -9,6 +9,13 @@ export interface ApiCapsule {
   status: 'pending' | 'delivered' | 'failed';
   created_at: string;
   item_count: number;
+  thumbnail: string | null;
+}
+
+export interface ApiCapsulePage {
+  next: string | null;
+  previous: string | null;
+  results: ApiCapsule[];
 }
 
 export interface ApiCapsuleItem {
@@ -21,8 +28,8 @@ export interface ApiCapsuleItem {
 }
 
 export const capsulesApi = {
-  listCapsules: async (): Promise<ApiCapsule[]> => {
-    const response = await client.get('/capsules/');
+  listCapsules: async (cursorUrl?: string): Promise<ApiCapsulePage> => {
+    const response = await client.get(cursorUrl ?? '/capsules/');
     return response.data;
   },
 